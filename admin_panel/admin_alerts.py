@@ -0,0 +1,145 @@
+import queue
+import atexit
+import logging
+import threading
+import time
+
+import config
+from database import get_admin_set, close_connection
+from .delivery import send_limiter, send_with_limits
+
+logger = logging.getLogger(__name__)
+
+# Настройки уведомлений админам (можно переопределить в config.py)
+ADMIN_ALERT_WINDOW = getattr(config, "ADMIN_ALERT_WINDOW", 60)            # сек., за которые однотипные события сводятся в одно сообщение
+ADMIN_ALERT_QUEUE_SIZE = getattr(config, "ADMIN_ALERT_QUEUE_SIZE", 1000)  # событий в очереди; сверх — отбрасываются с записью в лог
+
+_STOP = object()
+
+# Сводки для частых событий ({count} — сколько ещё событий было, {elapsed} — за сколько секунд на самом деле:
+# от первого из них до отправки сводки; с учётом лимитов это может быть дольше окна)
+NO_USERNAME_SUMMARY = "⚠️ Ещё пользователей без username не смогли активироваться по инвайту за {elapsed} сек.: {count}"
+SECOND_INVITE_SUMMARY = "⚠️ Ещё попыток активировать второй инвайт-код за {elapsed} сек.: {count}. Коды заблокированы."
+UNAUTHORIZED_SUMMARY = "⚠️ Ещё попыток использовать админ-команды без прав за {elapsed} сек.: {count}"
+
+
+class AdminAlerts:
+    """
+    Фоновая отправка уведомлений всем админам.
+    notify() только кладёт событие в очередь, поэтому обработчик пользователя не ждёт
+    рассылки по админам. Поток-отправитель шлёт сообщения через общий send_limiter —
+    тот же, что у рассылки билетов, поэтому вместе они не превышают лимит Telegram.
+
+    События с одинаковым kind сводятся: первое уходит сразу, следующие за ADMIN_ALERT_WINDOW сек.
+    только считаются, а по окончании окна уходит одна сводка summary.format(count=N, elapsed=сек.).
+    Без kind (или без summary) каждое событие отправляется отдельно.
+    """
+    def __init__(self, window=ADMIN_ALERT_WINDOW, queue_size=ADMIN_ALERT_QUEUE_SIZE, limiter=None):
+        self.window = window
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.limiter = limiter or send_limiter
+        self.windows = {}   # kind -> [bot, summary, parse_mode, конец окна, сколько событий свели, когда пришло первое из них]
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    # --- вызывается из любых потоков ---
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, name="admin-alerts", daemon=True)
+            self.thread.start()
+
+    def notify(self, bot, text, kind=None, summary=None, exclude=(), parse_mode=None):
+        """
+        Ставит уведомление text всем админам, кроме exclude, в очередь и сразу возвращается.
+        kind и summary — ключ и шаблон сводки для однотипных событий (см. описание класса).
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        try:
+            self.queue.put_nowait((bot, text, kind, summary, frozenset(exclude), parse_mode, time.monotonic()))
+        except queue.Full:
+            # Лучше потерять уведомление, чем задержать ответ пользователю
+            self.dropped += 1
+            logger.warning("Очередь уведомлений админам переполнена, событие отброшено: %s", text)
+
+    def stop(self, timeout=10.0):
+        # Отправляет накопленные сводки и останавливает поток
+        with self.lock:
+            thread = self.thread
+        if thread is None or not thread.is_alive():
+            return
+        self.queue.put(_STOP)
+        thread.join(timeout)
+
+    # --- поток-отправитель ---
+    def run(self):
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.next_timeout())
+                except queue.Empty:
+                    item = None
+
+                if item is _STOP:
+                    self.flush_windows(force=True)
+                    return
+                if item is not None:
+                    self.handle(*item)
+                self.flush_windows()
+        finally:
+            close_connection()
+
+    def next_timeout(self):
+        # Сколько ждать события до закрытия ближайшего окна сводки
+        if not self.windows:
+            return None
+        return max(0.0, min(w[3] for w in self.windows.values()) - time.monotonic())
+
+    def handle(self, bot, text, kind, summary, exclude, parse_mode, received_at):
+        if kind is not None and summary is not None:
+            window = self.windows.get(kind)
+            if window is not None:
+                if window[4] == 0:
+                    window[5] = received_at
+                window[4] += 1
+                return
+            self.windows[kind] = [bot, summary, parse_mode, time.monotonic() + self.window, 0, None]
+        self.send(bot, text, exclude, parse_mode)
+
+    def flush_windows(self, force=False):
+        now = time.monotonic()
+        for kind, window in list(self.windows.items()):
+            bot, summary, parse_mode, ends_at, count, first_at = window
+            if not force and ends_at > now:
+                continue
+            if count == 0:
+                del self.windows[kind]
+                continue
+            elapsed = max(1, round(now - first_at))
+            self.send(bot, summary.format(count=count, elapsed=elapsed), frozenset(), parse_mode)
+            # Поток событий продолжается — следующая сводка не раньше чем через окно
+            # (отсчёт после отправки: с учётом лимитов она может занять несколько секунд)
+            window[3] = time.monotonic() + self.window
+            window[4] = 0
+            if force:
+                del self.windows[kind]
+
+    def send(self, bot, text, exclude, parse_mode):
+        for admin_id in get_admin_set():
+            if admin_id in exclude or admin_id <= 0:
+                continue
+            try:
+                send_with_limits(
+                    self.limiter, admin_id,
+                    lambda: bot.send_message(admin_id, text, parse_mode=parse_mode)
+                )
+            except Exception as e:
+                # Например, админ заблокировал бота
+                logger.warning(f"Не удалось отправить уведомление админу {admin_id}: {e}")
+
+
+admin_alerts = AdminAlerts()
+atexit.register(admin_alerts.stop)
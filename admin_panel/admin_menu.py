@@ -107,6 +107,8 @@ def register_admin_menu(bot):
             InlineKeyboardButton("Дозагрузить билеты (ZIP)", callback_data="cmd_upload_zip_add"),
             InlineKeyboardButton("Подтвердить волну", callback_data="cmd_confirm_wave"),
             InlineKeyboardButton("Массовая рассылка билетов", callback_data="cmd_send_tickets"),
+            InlineKeyboardButton("План рассылки", callback_data="cmd_delivery_plan"),
+            InlineKeyboardButton("Статус рассылки", callback_data="cmd_send_status"),
             InlineKeyboardButton("Завершить волну", callback_data="cmd_end_wave"),
             InlineKeyboardButton("Статистика по волне", callback_data="cmd_stats"),
             InlineKeyboardButton("Список билетов", callback_data="cmd_list_tickets"),
@@ -251,6 +253,8 @@ def register_admin_menu(bot):
             "cmd_upload_zip_add": "/upload_zip_add",
             "cmd_confirm_wave": "/confirm_wave",
             "cmd_send_tickets": "/send_tickets",
+            "cmd_send_status": "/send_status",
+            "cmd_delivery_plan": "/delivery_plan",
             "cmd_end_wave": "/end_wave",
             "cmd_stats": "/stats",
             "cmd_list_tickets": "/list_tickets",
@@ -0,0 +1,230 @@
+import time
+import asyncio
+import logging
+
+import config
+from async_db import run_db
+from database import get_admins
+from .delivery import send_limiter, get_retry_after, MAX_RATE_LIMIT_RETRIES
+from .ticket_delivery import (
+    TicketDeliveryWorker,
+    release_active_worker,
+    find_interrupted_delivery,
+    resume_text,
+)
+
+logger = logging.getLogger(__name__)
+
+# Сколько отправок одновременно «в полёте» в асинхронном рантайме (вместо потока на каждую)
+ASYNC_SEND_CONCURRENCY = getattr(config, "ASYNC_SEND_CONCURRENCY", 50)
+
+
+async def acquire_async(limiter, chat_id=None):
+    # Как RateLimiter.acquire, но ожидание не блокирует event loop
+    while True:
+        wait = limiter.try_acquire(chat_id)
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+async def send_with_limits_async(limiter, chat_id, send):
+    """
+    Асинхронный вариант send_with_limits: send — функция без аргументов, возвращающая корутину.
+    На 429 ставит общую паузу и повторяет; остальные ошибки пробрасывает вызывающему.
+    """
+    for attempt in range(1, MAX_RATE_LIMIT_RETRIES + 1):
+        await acquire_async(limiter, chat_id)
+        try:
+            return await send()
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            limiter.pause(retry_after + 1)
+
+
+class AsyncDeliveryEngine:
+    """
+    Асинхронный аналог DeliveryEngine: items (асинхронный итератор) обрабатываются
+    корутиной handler, одновременно не больше concurrency штук (asyncio.Semaphore).
+    stop() можно вызывать из любого потока — например, из /send_cancel.
+    """
+    def __init__(self, concurrency=ASYNC_SEND_CONCURRENCY, limiter=None):
+        self.workers = max(1, int(concurrency))
+        self.limiter = limiter or send_limiter
+        self._stopped = False
+
+    def stop(self):
+        self._stopped = True
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    async def run(self, items, handler):
+        semaphore = asyncio.Semaphore(self.workers)
+        tasks = set()
+
+        async def run_one(item):
+            try:
+                await handler(item)
+            except Exception as e:
+                logger.error(f"Ошибка рассылки для {item}: {e}", exc_info=True)
+            finally:
+                semaphore.release()
+
+        try:
+            while True:
+                # Сначала ждём свободное место, потом берём задачу — иначе она зря висела бы в sending
+                await semaphore.acquire()
+                if self.stopped:
+                    break
+                try:
+                    item = await anext(items)
+                except StopAsyncIteration:
+                    break
+                task = asyncio.create_task(run_one(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            semaphore.release()
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            # Генератор задач закрываем явно, а не когда до него доберётся сборщик мусора
+            await items.aclose()
+
+
+class AsyncTicketDeliveryWorker(TicketDeliveryWorker):
+    """
+    Рассылка волны для асинхронного рантайма. Очередь, правила повторов, учёт в БД и тексты
+    общие с TicketDeliveryWorker (before_send / after_sent / after_error и т.д. выполняются
+    в пуле async_db), здесь — только отправка корутинами AsyncTeleBot. Слот активной
+    рассылки общий, поэтому /send_status и /send_cancel работают с ней как с обычной.
+    """
+    def __init__(self, bot, wave_id, wave_start, report_chat_ids):
+        super().__init__(bot, wave_id, wave_start, report_chat_ids)
+        self.engine = AsyncDeliveryEngine()
+        self.limiter = self.engine.limiter
+        self.task = None
+
+    # --- отправка ---
+    async def notify(self, chat_id, text):
+        try:
+            await send_with_limits_async(self.limiter, chat_id, lambda: self.bot.send_message(chat_id, text))
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+    async def send_notices(self, notices):
+        for chat_id, text in notices:
+            await self.notify(chat_id, text)
+
+    async def report(self, text):
+        await self.send_notices(self.report_notices(text))
+
+    async def start_progress(self):
+        text = self.progress_text()
+        for chat_id in self.report_chat_ids:
+            try:
+                sent = await send_with_limits_async(
+                    self.limiter, chat_id, lambda: self.bot.send_message(chat_id, text)
+                )
+                self.progress_messages.append((chat_id, sent.message_id))
+            except Exception as e:
+                logger.warning(f"Не удалось отправить прогресс рассылки в чат {chat_id}: {e}")
+        self.progress_updated_at = time.monotonic()
+
+    async def update_progress(self, force=False):
+        text = self.progress_update_text(force)
+        if text is None:
+            return
+        for chat_id, message_id in self.progress_messages:
+            try:
+                await send_with_limits_async(
+                    self.limiter, chat_id,
+                    lambda: self.bot.edit_message_text(text, chat_id, message_id)
+                )
+            except Exception as e:
+                if "message is not modified" not in str(e):
+                    logger.warning(f"Не удалось обновить прогресс рассылки в чате {chat_id}: {e}")
+
+    # --- очередь ---
+    async def jobs(self):
+        while not self.engine.stopped:
+            job, wait = await run_db(self.next_job)
+            if job:
+                yield job
+            elif wait is None:
+                return
+            else:
+                await asyncio.sleep(wait)
+
+    async def process(self, job):
+        try:
+            await self.deliver(job)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            await self.update_progress()
+
+    async def deliver(self, job):
+        ticket_path, user_id = job["ticket_path"], job["user_id"]
+        should_send, notices = await run_db(self.before_send, job)
+        if should_send:
+            async def send_ticket():
+                with open(ticket_path, 'rb') as pdf:
+                    return await self.bot.send_document(user_id, pdf)
+            try:
+                await send_with_limits_async(self.limiter, user_id, send_ticket)
+            except Exception as e:
+                notices = await run_db(self.after_error, job, e)
+            else:
+                await run_db(self.after_sent, job)
+        await self.send_notices(notices)
+
+    # --- запуск ---
+    def launch(self):
+        # Запускает рассылку задачей в текущем event loop (слот активной рассылки уже занят)
+        self.started_at = time.time()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            for text in await run_db(self.prepare_jobs):
+                await self.report(text)
+            logger.info(
+                "Начало рассылки %s: волна %d, задач %d, одновременных отправок до %d",
+                self.job_id, self.wave_id, self.total, self.engine.workers
+            )
+            await self.start_progress()
+            await self.engine.run(self.jobs(), self.process)
+            self.finished_at = time.time()
+            cancel_text = await run_db(self.pause_if_cancelled)
+            await self.update_progress(force=True)
+            if cancel_text:
+                await self.report(cancel_text)
+            elif not self.engine.stopped:
+                result_msg = await run_db(self.summary_text)
+                await self.report(result_msg)
+                logger.info(result_msg)
+        except Exception as e:
+            logger.error(f"Рассылка {self.job_id} прервана ошибкой: {e}", exc_info=True)
+            await self.report(self.error_text(e))
+        finally:
+            release_active_worker(self)
+            self.finished.set()
+
+
+async def resume_ticket_delivery_async(bot):
+    # Асинхронный вариант resume_ticket_delivery: продолжает прерванную рассылку задачей в event loop.
+    interrupted = await run_db(find_interrupted_delivery)
+    if interrupted is None:
+        return None
+    wave_id, wave_start, pending = interrupted
+
+    logger.info("Продолжаем прерванную рассылку волны %d: в очереди %d", wave_id, pending)
+    worker = AsyncTicketDeliveryWorker(bot, wave_id, wave_start, await run_db(get_admins))
+    if not worker.start():
+        return None
+    await worker.report(resume_text(wave_id, pending))
+    return worker
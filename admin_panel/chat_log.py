@@ -0,0 +1,361 @@
+import os
+import re
+import queue
+import sqlite3
+import pathlib
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Настройки журнала переписки (можно переопределить в config.py)
+CHAT_LOG_FOLDER = "logs"
+CHAT_LOG_DB_PATH = getattr(config, "CHAT_LOG_DB_PATH", "chat_log.db")      # индекс переписки для /chatlog
+CHAT_LOG_QUEUE_SIZE = getattr(config, "CHAT_LOG_QUEUE_SIZE", 10000)         # строк в очереди на запись
+CHAT_LOG_MAX_OPEN_FILES = getattr(config, "CHAT_LOG_MAX_OPEN_FILES", 64)    # открытых файлов logs/{user_id}.txt
+CHAT_LOG_FLUSH_INTERVAL = getattr(config, "CHAT_LOG_FLUSH_INTERVAL", 1.0)   # сек. между flush
+CHAT_LOG_FSYNC_INTERVAL = getattr(config, "CHAT_LOG_FSYNC_INTERVAL", 10.0)  # сек. между fsync
+
+_STOP = object()
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+LINE_RE = re.compile(r"^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] (\w+): ?(.*)$")
+
+
+# === ИНДЕКС ПЕРЕПИСКИ ===
+# Отдельная база: переписка только дописывается и не должна блокировать users.db.
+# chat_messages_fts — полнотекстовый индекс (FTS5) по content; если SQLite собран без FTS5,
+# поиск по словам идёт через LIKE.
+
+def open_chat_log_db(path=CHAT_LOG_DB_PATH):
+    conn = sqlite3.connect(path, timeout=5.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def open_chat_log_db_readonly(path=CHAT_LOG_DB_PATH):
+    # Только чтение (/chatlog): без DDL и блокировок на запись, не мешает потоку-писателю.
+    # None — базы ещё нет
+    if not os.path.exists(path):
+        return None
+    uri = pathlib.Path(path).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(uri, uri=True, timeout=5.0)
+
+def init_chat_log_db(conn):
+    # Создаёт таблицы индекса. Возвращает True, если база только что создана (нужно перенести старые logs/*.txt).
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='chat_messages'"
+    ).fetchone() is None
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_messages (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            ts      TEXT NOT NULL,
+            role    TEXT NOT NULL,
+            content TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_messages_user_ts ON chat_messages (user_id, ts)")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts
+            USING fts5(content, content='chat_messages', content_rowid='id')
+        """)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"FTS5 недоступен, поиск по переписке будет через LIKE: {e}")
+    conn.commit()
+    return created
+
+def has_fts(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name='chat_messages_fts'"
+    ).fetchone() is not None
+
+def parse_chat_log_file(path):
+    # Строки старого logs/{user_id}.txt -> [(ts, role, content)]; строки без заголовка — продолжение предыдущей
+    rows = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for raw in f:
+            line = raw.rstrip("\n")
+            m = LINE_RE.match(line)
+            if m:
+                rows.append([m.group(1), m.group(2), m.group(3)])
+            elif rows:
+                rows[-1][2] += "\n" + line
+    return rows
+
+def import_chat_log_files(conn, folder=CHAT_LOG_FOLDER):
+    # Разовый перенос существующих logs/*.txt в индекс (при первом создании базы)
+    if not os.path.isdir(folder):
+        return 0
+    total = 0
+    for name in os.listdir(folder):
+        user_id, ext = os.path.splitext(name)
+        if ext != ".txt" or not user_id.lstrip("-").isdigit():
+            continue
+        rows = parse_chat_log_file(os.path.join(folder, name))
+        conn.executemany(
+            "INSERT INTO chat_messages (user_id, ts, role, content) VALUES (?, ?, ?, ?)",
+            [(int(user_id), ts, role, content) for ts, role, content in rows]
+        )
+        total += len(rows)
+    conn.commit()
+    return total
+
+def fts_query(text):
+    # Каждое слово — отдельная фраза в кавычках: спецсимволы FTS5 в запросе админа не ломают поиск
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+def query_chat_log(user_id, since=None, until=None, last=None, text=None, db_path=CHAT_LOG_DB_PATH):
+    """
+    Сообщения переписки с user_id из индекса: [(ts, role, content)] по возрастанию времени.
+    since/until — datetime или строка 'YYYY-MM-DD[ HH:MM:SS]' (until включительно до конца дня, если дана дата),
+    last — только последние N сообщений, text — слова, которые должны встречаться в сообщении.
+    """
+    conn = open_chat_log_db_readonly(db_path)
+    if conn is None:
+        return []
+    try:
+        if not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='chat_messages'"
+        ).fetchone():
+            return []   # писатель ещё не создал таблицы
+        where, params = ["m.user_id = ?"], [user_id]
+        if since:
+            where.append("m.ts >= ?")
+            params.append(since.strftime(TIME_FORMAT) if isinstance(since, datetime) else since)
+        if until:
+            where.append("m.ts <= ?")
+            if isinstance(until, datetime):
+                params.append(until.strftime(TIME_FORMAT))
+            else:
+                params.append(until if len(until) > 10 else until + " 23:59:59")
+
+        if text:
+            if has_fts(conn):
+                # Подзапросом: JOIN с FTS заставляет SQLite проверять MATCH для каждой строки пользователя
+                where.append("m.id IN (SELECT rowid FROM chat_messages_fts WHERE chat_messages_fts MATCH ?)")
+                params.append(fts_query(text))
+            else:
+                for word in text.split():
+                    where.append("m.content LIKE ?")
+                    params.append(f"%{word}%")
+
+        # Порядок (ts, id) совпадает с индексом (user_id, ts), поэтому last N не сортирует всю историю
+        sql = f"SELECT m.ts, m.role, m.content, m.id FROM chat_messages m WHERE {' AND '.join(where)}"
+        if last:
+            sql = f"SELECT * FROM ({sql} ORDER BY m.ts DESC, m.id DESC LIMIT ?) ORDER BY ts, id"
+            params.append(int(last))
+        else:
+            sql += " ORDER BY m.ts, m.id"
+        return [row[:3] for row in conn.execute(sql, params)]
+    finally:
+        conn.close()
+
+
+class ChatLogWriter:
+    """
+    Фоновая запись переписки в logs/{user_id}.txt и в индекс chat_log.db.
+    write() только кладёт строку в очередь и никогда не ждёт: при переполнении строка
+    отбрасывается — это осознанный компромисс, чтобы медленный диск не задерживал ответы.
+    Потери видны админам: счётчик dropped (в /flood_stats) и предупреждения в логе,
+    в том числе итог при остановке. Поток-писатель держит LRU открытых файлов,
+    сбрасывает буферы (и пачку строк в индекс) раз в CHAT_LOG_FLUSH_INTERVAL сек.
+    и делает fsync раз в CHAT_LOG_FSYNC_INTERVAL сек.
+    """
+    def __init__(self, folder=CHAT_LOG_FOLDER, queue_size=CHAT_LOG_QUEUE_SIZE, max_open_files=CHAT_LOG_MAX_OPEN_FILES,
+                 db_path=CHAT_LOG_DB_PATH):
+        self.folder = folder
+        self.db_path = db_path
+        self.db = None
+        self.rows = []              # строки для индекса, ещё не записанные в chat_log.db
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_open_files = max(1, int(max_open_files))
+        self.files = OrderedDict()  # user_id -> файл, последний использованный — в конце
+        self.dirty = set()          # файлы с несброшенными строками
+        self.unsynced = set()       # файлы, записанные после последнего fsync
+        self.thread = None
+        self.lock = threading.Lock()
+        self.overflow_warned = False
+        self.dropped = 0            # строк, отброшенных из-за переполнения очереди
+
+    # --- вызывается из любых потоков ---
+    def start(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            os.makedirs(self.folder, exist_ok=True)
+            self.thread = threading.Thread(target=self.run, name="chat-log-writer", daemon=True)
+            self.thread.start()
+
+    def write(self, user_id, role, content, when=None):
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        item = (user_id, (when or datetime.now()).strftime(TIME_FORMAT), role.upper(), str(content).strip())
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # Писатель отстал на целую очередь (медленный диск). Ждать нельзя: write() вызывается
+            # из обработки сообщений и из event loop — строка отбрасывается и учитывается в dropped
+            with self.lock:
+                self.dropped += 1
+                warn, self.overflow_warned = not self.overflow_warned, True
+            if warn:
+                logger.warning("Очередь журнала переписки переполнена, строки отбрасываются")
+
+    def flush(self, timeout=5.0):
+        """
+        Дожидается, пока всё, что уже в очереди, будет записано на диск (например, перед отправкой /chatlog).
+        Возвращает False, если не дождались за timeout сек. (очередь переполнена или писатель отстал).
+        """
+        if self.thread is None or not self.thread.is_alive():
+            return True
+        done = threading.Event()
+        deadline = time.monotonic() + timeout
+        try:
+            self.queue.put(done, timeout=timeout)
+        except queue.Full:
+            logger.warning("Очередь журнала переписки переполнена, flush не дождался записи")
+            return False
+        return done.wait(max(0.0, deadline - time.monotonic()))
+
+    def stop(self, timeout=10.0):
+        # Дописывает очередь, закрывает файлы и останавливает поток
+        with self.lock:
+            thread = self.thread
+            dropped = self.dropped
+        if dropped:
+            logger.warning("Журнал переписки: за время работы отброшено строк из-за переполнения очереди: %d", dropped)
+        if thread is None or not thread.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Очередь журнала переписки не разобрана за %s сек., остаток не записан", timeout)
+            return
+        thread.join(timeout)
+
+    # --- поток-писатель ---
+    def run(self):
+        self.open_db()
+        last_flush = last_fsync = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=CHAT_LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self.close_all()
+                return
+            if isinstance(item, threading.Event):
+                self.flush_all(fsync=False)
+                item.set()
+            elif item is not None:
+                self.append(*item)
+
+            now = time.monotonic()
+            if now - last_flush >= CHAT_LOG_FLUSH_INTERVAL:
+                fsync = now - last_fsync >= CHAT_LOG_FSYNC_INTERVAL
+                self.flush_all(fsync=fsync)
+                last_flush = now
+                if fsync:
+                    last_fsync = now
+                if self.overflow_warned and self.queue.empty():
+                    # Очередь разобрана: итог по потерянным строкам, следующее переполнение снова попадёт в лог
+                    with self.lock:
+                        self.overflow_warned = False
+                        dropped = self.dropped
+                    logger.warning("Журнал переписки догнал очередь; всего отброшено строк: %d", dropped)
+
+    def get_file(self, user_id):
+        f = self.files.get(user_id)
+        if f is not None:
+            self.files.move_to_end(user_id)
+            return f
+        if len(self.files) >= self.max_open_files:
+            old_id, old_f = self.files.popitem(last=False)
+            self.dirty.discard(old_id)
+            self.unsynced.discard(old_id)
+            old_f.close()
+        path = os.path.join(self.folder, f"{user_id}.txt")
+        f = self.files[user_id] = open(path, "a", encoding="utf-8")
+        return f
+
+    def open_db(self):
+        try:
+            self.db = open_chat_log_db(self.db_path)
+            if init_chat_log_db(self.db):
+                imported = import_chat_log_files(self.db, self.folder)
+                if imported:
+                    logger.info("Старые логи переписки перенесены в индекс: %d сообщений", imported)
+        except Exception as e:
+            logger.error(f"Индекс переписки {self.db_path} недоступен, пишем только в {self.folder}/: {e}")
+            self.db = None
+
+    def append(self, user_id, ts, role, content):
+        self.rows.append((user_id, ts, role, content))
+        try:
+            self.get_file(user_id).write(f"[{ts}] {role}: {content}\n")
+            self.dirty.add(user_id)
+            self.unsynced.add(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка логирования в {self.folder}/{user_id}.txt: {e}")
+
+    def flush_db(self):
+        if not self.rows:
+            return
+        rows, self.rows = self.rows, []
+        if self.db is None:
+            return
+        try:
+            self.db.executemany(
+                "INSERT INTO chat_messages (user_id, ts, role, content) VALUES (?, ?, ?, ?)", rows
+            )
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            logger.error(f"Ошибка записи в индекс переписки {self.db_path}: {e}")
+
+    def flush_all(self, fsync=False):
+        self.flush_db()
+        for user_id in self.unsynced if fsync else self.dirty:
+            f = self.files.get(user_id)
+            if f is None:
+                continue
+            try:
+                f.flush()
+                if fsync:
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logger.error(f"Ошибка сброса журнала {self.folder}/{user_id}.txt: {e}")
+        self.dirty.clear()
+        if fsync:
+            self.unsynced.clear()
+
+    def close_all(self):
+        self.flush_all(fsync=True)
+        for f in self.files.values():
+            try:
+                f.close()
+            except Exception:
+                pass
+        self.files.clear()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+chat_log_writer = ChatLogWriter()
+atexit.register(chat_log_writer.stop)
+
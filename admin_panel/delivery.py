@@ -0,0 +1,157 @@
+import re
+import time
+import threading
+import logging
+
+import config
+from database import close_connection
+
+logger = logging.getLogger(__name__)
+
+# Настройки рассылки (можно переопределить в config.py)
+SEND_WORKERS = getattr(config, "SEND_WORKERS", 8)              # потоков отправки
+SEND_RATE_LIMIT = getattr(config, "SEND_RATE_LIMIT", 25)       # сообщений в секунду на весь бот (лимит Telegram ~30)
+SEND_PER_CHAT_RATE = getattr(config, "SEND_PER_CHAT_RATE", 1)  # сообщений в секунду в один чат
+MAX_RATE_LIMIT_RETRIES = 5                                     # сколько раз подряд ждём retry_after для одного сообщения
+
+
+def get_retry_after(error):
+    """
+    Возвращает retry_after (сек.) из ошибки 429 Too Many Requests или None, если это другая ошибка.
+    """
+    result_json = getattr(error, "result_json", None)
+    if getattr(error, "error_code", None) == 429 and isinstance(result_json, dict):
+        retry_after = (result_json.get("parameters") or {}).get("retry_after")
+        if retry_after is not None:
+            return int(retry_after)
+    # TelegramAPIError: Too Many Requests: retry after 27
+    m = re.search(r'retry after (\d+)', str(error).lower())
+    return int(m.group(1)) if m else None
+
+
+class RateLimiter:
+    """
+    Общий для всех потоков ограничитель отправки:
+    - token bucket на весь бот (global_rate сообщений в секунду);
+    - не чаще per_chat_rate сообщений в секунду в один чат;
+    - пауза после 429: retry_after применяется сразу ко всем потокам, а не только к тому, кто его получил.
+    """
+    def __init__(self, global_rate=SEND_RATE_LIMIT, per_chat_rate=SEND_PER_CHAT_RATE):
+        self.global_rate = float(global_rate)
+        self.capacity = max(1.0, self.global_rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.per_chat_interval = 1.0 / per_chat_rate
+        self.chat_next_at = {}   # chat_id -> время, раньше которого в чат слать нельзя
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Глобальная пауза для всех потоков (ответ 429 с retry_after)
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning("Получен лимит Telegram: пауза рассылки на %s сек.", seconds)
+
+    def try_acquire(self, chat_id=None):
+        # Занимает слот отправки в chat_id и возвращает 0 либо, если лимиты не пускают,
+        # сколько секунд подождать до следующей попытки
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.global_rate)
+            self.updated_at = now
+
+            wait = self.paused_until - now
+            if chat_id is not None:
+                wait = max(wait, self.chat_next_at.get(chat_id, 0.0) - now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.global_rate)
+
+            if wait > 0:
+                return wait
+            self.tokens -= 1
+            if chat_id is not None:
+                self.chat_next_at[chat_id] = now + self.per_chat_interval
+                if len(self.chat_next_at) > 10000:
+                    self.chat_next_at = {
+                        cid: t for cid, t in self.chat_next_at.items() if t > now
+                    }
+            return 0
+
+    def acquire(self, chat_id=None):
+        # Блокирует поток, пока отправка в chat_id не станет разрешена всеми лимитами
+        while True:
+            wait = self.try_acquire(chat_id)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+# Один ограничитель на процесс: рассылка билетов, уведомления админам (admin_alerts) и асинхронный
+# рантайм расходуют общий бюджет Telegram, а пауза после 429 останавливает всех сразу
+send_limiter = RateLimiter()
+
+
+def send_with_limits(limiter, chat_id, send):
+    """
+    Выполняет send() (вызов Bot API в chat_id) с учётом лимитов limiter.
+    На 429 ставит общую паузу и повторяет; остальные ошибки пробрасывает вызывающему.
+    send — функция без аргументов, чтобы при повторе файл можно было открыть заново.
+    """
+    for attempt in range(1, MAX_RATE_LIMIT_RETRIES + 1):
+        limiter.acquire(chat_id)
+        try:
+            return send()
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or attempt == MAX_RATE_LIMIT_RETRIES:
+                raise
+            limiter.pause(retry_after + 1)
+
+
+class DeliveryEngine:
+    """
+    Пул потоков отправки: items обрабатываются функцией handler параллельно
+    в workers потоках. Все потоки делят один RateLimiter (по умолчанию общий send_limiter).
+    """
+    def __init__(self, workers=SEND_WORKERS, limiter=None):
+        self.workers = max(1, int(workers))
+        self.limiter = limiter or send_limiter
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        # Новые элементы больше не берутся; уже начатые отправки доводятся до конца
+        self.stop_event.set()
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def run(self, items, handler):
+        # Блокирует до обработки всех items (или до stop())
+        iterator = iter(items)
+        iterator_lock = threading.Lock()
+
+        def worker():
+            try:
+                while not self.stop_event.is_set():
+                    with iterator_lock:
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                    try:
+                        handler(item)
+                    except Exception as e:
+                        logger.error(f"Ошибка рассылки для {item}: {e}", exc_info=True)
+            finally:
+                # У каждого потока своё соединение с БД — закрываем его вместе с потоком
+                close_connection()
+
+        threads = [
+            threading.Thread(target=worker, name=f"delivery-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
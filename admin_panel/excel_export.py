@@ -0,0 +1,106 @@
+import tempfile
+
+import xlsxwriter
+
+from database import get_connection, get_failed_deliveries_report
+
+# Строки из БД читаются порциями, а в файл пишутся сразу — память не растёт вместе с историей
+EXPORT_CHUNK_SIZE = 1000
+
+TICKET_HEADERS = ["File Path", "Original Name", "Status", "Assigned To", "Assigned At", "Wave ID"]
+TICKET_COLUMN_WIDTHS = [60, 28, 14, 16, 26, 10]
+
+FAILED_HEADERS = ["user_id", "username", "ticket_path", "original_name", "статус", "Не доставлено"]
+FAILED_COLUMN_WIDTHS = [14, 20, 60, 30, 20, 18]
+
+
+def iter_cursor(cur, chunk_size=EXPORT_CHUNK_SIZE):
+    # Построчно отдаёт результат запроса, забирая его из курсора по chunk_size строк.
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def create_workbook():
+    """
+    Создаёт .xlsx во временном файле и возвращает (workbook, path).
+    constant_memory: каждая строка сбрасывается на диск, как только начата следующая,
+    поэтому строки листа нужно писать строго по порядку. Файл удаляет вызывающий код.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
+        path = tmp.name
+    return xlsxwriter.Workbook(path, {"constant_memory": True}), path
+
+
+def write_sheet(workbook, name, headers, rows, column_widths=()):
+    """
+    Добавляет лист: строка заголовков, затем rows (любой итерируемый объект строк).
+    Возвращает (worksheet, число строк данных).
+    """
+    worksheet = workbook.add_worksheet(name)
+    for col, width in enumerate(column_widths):
+        worksheet.set_column(col, col, width)
+    worksheet.write_row(0, 0, headers)
+    count = 0
+    for count, row in enumerate(rows, 1):
+        worksheet.write_row(count, 0, row)
+    return worksheet, count
+
+
+def ticket_status(assigned_to, assigned_at, archived_unused, lost):
+    if lost:
+        return "LOST"
+    if assigned_to is not None and assigned_at is None:
+        return "RESERVED"
+    if assigned_to is not None:
+        return "SENT"
+    if archived_unused:
+        return "ARCHIVED"
+    return "AVAILABLE"
+
+
+def iter_ticket_rows():
+    # Строки листа билетов (/list_tickets и /full_report) в порядке TICKET_HEADERS.
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT file_path, original_name, assigned_to, assigned_at, archived_unused, lost, wave_id
+        FROM tickets
+    """)
+    for path, orig, assigned_to, assigned_at, archived_unused, lost, wave_id in iter_cursor(cur):
+        yield [
+            path,
+            orig,
+            ticket_status(assigned_to, assigned_at, archived_unused, lost),
+            assigned_to or "",
+            assigned_at or "",
+            wave_id or "",
+        ]
+
+
+def iter_failed_rows():
+    # Строки отчёта о неудачных доставках (/failed_report и /full_report) в порядке FAILED_HEADERS.
+    for user_id, username, ticket_path, ticket_found, original_name, lost, archived, assigned in iter_cursor(
+        get_failed_deliveries_report()
+    ):
+        if not ticket_found:
+            original_name = "❓ не найден"
+            status = "❌ нет данных"
+        elif lost:
+            status = "Утраченный"
+        elif archived:
+            status = "Архивный"
+        elif assigned:
+            status = "Выдан"
+        else:
+            status = "Активный"
+
+        yield [
+            user_id,
+            f"@{username}" if username else "",
+            ticket_path,
+            original_name,
+            status,
+            "Да"  # раз запись есть в failed_deliveries — значит не доставлено
+        ]
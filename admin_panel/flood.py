@@ -0,0 +1,169 @@
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+
+import config
+from database import get_admin_set
+
+logger = logging.getLogger(__name__)
+
+# Настройки защиты от флуда (можно переопределить в config.py)
+FLOOD_MAX_MESSAGES = getattr(config, "FLOOD_MAX_MESSAGES", 20)           # сообщений от одного пользователя за FLOOD_WINDOW сек.
+FLOOD_WINDOW = getattr(config, "FLOOD_WINDOW", 60)
+START_MAX_ATTEMPTS = getattr(config, "START_MAX_ATTEMPTS", 5)            # попыток /start от одного пользователя за START_WINDOW сек.
+START_WINDOW = getattr(config, "START_WINDOW", 600)
+BAD_INVITE_CACHE_SIZE = getattr(config, "BAD_INVITE_CACHE_SIZE", 10000)  # сколько несуществующих invite-кодов помнить
+BAD_INVITE_CACHE_TTL = getattr(config, "BAD_INVITE_CACHE_TTL", 3600)     # сек.
+
+# Решения FloodControl.check
+ALLOW = "allow"
+BLOCK_NOTIFY = "block_notify"   # лимит превышен впервые подряд — предупредить пользователя
+BLOCK = "block"                 # лимит превышен повторно — молча отбросить
+BAD_INVITE = "bad_invite"       # /start с кодом, который уже не нашёлся в базе
+
+FLOOD_TEXT = "⏳ Слишком много запросов. Подождите немного и попробуйте снова."
+BAD_INVITE_TEXT = "❗️ Приглашение не найдено. Свяжитесь с администратором."
+
+
+class SlidingWindowLimiter:
+    """
+    Не больше limit событий на ключ (user_id) за последние window сек.
+    Для каждого ключа хранится не больше limit отметок времени. Отклонённые события тоже
+    записываются, поэтому тот, кто продолжает слать, остаётся заблокированным.
+    """
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = max(1, int(limit))
+        self.window = window
+        self.max_keys = max_keys
+        self.entries = {}   # key -> deque отметок времени
+        self.lock = threading.Lock()
+
+    def hit(self, key):
+        # Учитывает событие. Возвращает True, если оно в пределах лимита.
+        now = time.monotonic()
+        with self.lock:
+            hits = self.entries.get(key)
+            if hits is None:
+                if len(self.entries) >= self.max_keys:
+                    self.prune(now)
+                hits = self.entries[key] = deque(maxlen=self.limit)
+            allowed = len(hits) < self.limit or hits[0] <= now - self.window
+            hits.append(now)
+            return allowed
+
+    def prune(self, now):
+        # Забывает ключи без событий в окне (вызывается под lock)
+        border = now - self.window
+        self.entries = {key: hits for key, hits in self.entries.items() if hits[-1] > border}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class FloodControl:
+    """
+    Проверка входящего сообщения до обработчиков и до БД (см. middleware.FloodControlMiddleware):
+    общий лимит сообщений на пользователя, отдельный — на /start, и кеш invite-кодов,
+    которых нет в базе (remember_bad_invite вызывает /start, когда код не найден).
+    Админы лимитами не ограничиваются. Предупреждение пользователь получает одно на серию
+    отклонений (по какому бы лимиту они ни шли): серия заканчивается, когда сообщение снова пропущено.
+    Счётчики отклонений — get_metrics().
+    """
+    def __init__(self, max_messages=FLOOD_MAX_MESSAGES, window=FLOOD_WINDOW,
+                 max_starts=START_MAX_ATTEMPTS, start_window=START_WINDOW,
+                 bad_invite_cache_size=BAD_INVITE_CACHE_SIZE, bad_invite_ttl=BAD_INVITE_CACHE_TTL):
+        self.messages = SlidingWindowLimiter(max_messages, window)
+        self.starts = SlidingWindowLimiter(max_starts, start_window)
+        self.bad_invites = OrderedDict()   # invite_code -> когда забыть
+        self.bad_invite_cache_size = bad_invite_cache_size
+        self.bad_invite_ttl = bad_invite_ttl
+        self.notified = OrderedDict()      # user_id, уже предупреждённые в текущей серии отклонений
+        self.max_notified = self.messages.max_keys
+        self.lock = threading.Lock()
+        self.metrics = {
+            "blocked_messages": 0,   # отброшено по общему лимиту
+            "blocked_starts": 0,     # отброшено /start по лимиту попыток
+            "bad_invite_hits": 0,    # /start с известным несуществующим кодом
+            "flood_episodes": 0,     # серий отклонений (одна серия — одно предупреждение пользователю)
+        }
+
+    def count(self, name):
+        with self.lock:
+            self.metrics[name] += 1
+
+    def remember_bad_invite(self, invite_code):
+        with self.lock:
+            self.bad_invites[invite_code] = time.monotonic() + self.bad_invite_ttl
+            self.bad_invites.move_to_end(invite_code)
+            while len(self.bad_invites) > self.bad_invite_cache_size:
+                self.bad_invites.popitem(last=False)
+
+    def forget_bad_invites(self, invite_codes):
+        # Коды, которые только что появились в базе (generate_invites), больше не «несуществующие»
+        with self.lock:
+            for invite_code in invite_codes:
+                self.bad_invites.pop(invite_code, None)
+
+    def is_bad_invite(self, invite_code):
+        with self.lock:
+            expires_at = self.bad_invites.get(invite_code)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self.bad_invites[invite_code]
+                return False
+            return True
+
+    def block(self, user_id, metric):
+        # Отклонение: BLOCK_NOTIFY для первого в серии, дальше — BLOCK
+        with self.lock:
+            self.metrics[metric] += 1
+            if user_id in self.notified:
+                return BLOCK
+            self.notified[user_id] = True
+            if len(self.notified) > self.max_notified:
+                self.notified.popitem(last=False)
+            self.metrics["flood_episodes"] += 1
+        logger.warning("Флуд от пользователя %d: сообщения отклоняются (%s)", user_id, metric)
+        return BLOCK_NOTIFY
+
+    def passed(self, user_id):
+        # Сообщение пропущено — серия отклонений закончилась
+        with self.lock:
+            self.notified.pop(user_id, None)
+
+    def check(self, message, admins=None):
+        """
+        Решение для входящего сообщения: ALLOW, BLOCK_NOTIFY, BLOCK или BAD_INVITE.
+        admins — множество ID админов; если не передано, берётся get_admin_set()
+        (может обратиться к БД, когда истёк кеш админов).
+        """
+        user_id = message.from_user.id
+        text = message.text or ""
+        is_start = text.startswith("/start")
+        metric = None
+        if not self.messages.hit(user_id):
+            metric = "blocked_messages"
+        elif is_start and not self.starts.hit(user_id):
+            metric = "blocked_starts"
+        if metric and user_id not in (get_admin_set() if admins is None else admins):
+            return self.block(user_id, metric)
+
+        self.passed(user_id)
+        if is_start:
+            args = text.split()
+            if len(args) > 1 and self.is_bad_invite(args[1]):
+                self.count("bad_invite_hits")
+                return BAD_INVITE
+        return ALLOW
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.metrics)
+            metrics["bad_invites_cached"] = len(self.bad_invites)
+        metrics["tracked_users"] = len(self.messages)
+        return metrics
+
+
+flood_control = FloodControl()
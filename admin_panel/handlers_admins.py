@@ -1,5 +1,7 @@
 from telebot import types
 from .utils import admin_error_catcher, admin_required
+from .flood import flood_control
+from .chat_log import chat_log_writer
 from database import (
     add_admin,
     remove_admin,
@@ -98,3 +100,20 @@ def register_admins_handlers(bot):
     @admin_error_catcher(bot)
     def handle_myid(message):
         bot.reply_to(message, f"Ваш user_id: {message.from_user.id}")
+
+    @bot.message_handler(commands=['flood_stats'])
+    @admin_required(bot)
+    @admin_error_catcher(bot)
+    def handle_flood_stats(message):
+        metrics = flood_control.get_metrics()
+        bot.reply_to(
+            message,
+            "🛡 Защита от флуда (с запуска бота):\n"
+            f"Отклонено сообщений по лимиту: {metrics['blocked_messages']}\n"
+            f"Отклонено /start по лимиту попыток: {metrics['blocked_starts']}\n"
+            f"/start с известным несуществующим кодом: {metrics['bad_invite_hits']}\n"
+            f"Срабатываний лимита: {metrics['flood_episodes']}\n"
+            f"Пользователей под наблюдением: {metrics['tracked_users']}\n"
+            f"Несуществующих кодов в кеше: {metrics['bad_invites_cached']}\n"
+            f"Строк журнала переписки отброшено (переполнение очереди): {chat_log_writer.dropped}"
+        )
@@ -20,7 +20,10 @@ def register_help_handlers(bot):
             "/upload_zip — загрузить ZIP-архив с билетами (старые архивируются)\n"
             "/upload_zip_add — дозагрузить новые билеты (старые остаются)\n"
             "/confirm_wave — подтвердить запуск волны после загрузки билетов\n"
-            "/send_tickets — массовая рассылка билетов всем пользователям (бот автоматически повторяет попытки тем, кому не удалось отправить с первого раза)\n"
+            "/send_tickets — массовая рассылка билетов всем пользователям в фоне (бот автоматически повторяет попытки тем, кому не удалось отправить с первого раза)\n"
+            "/delivery_plan — Excel-план рассылки волны: кому какой билет закреплён при /confirm_wave\n"
+            "/send_status — состояние текущей рассылки и очереди волны\n"
+            "/send_cancel — остановить рассылку (недоставленные остаются в очереди)\n"
             "/failed_report — Excel-отчет о пользователях, которым не удалось доставить билеты (контроль неудачных рассылок)\n"
             "/force_give @username — вручную выдать билет пользователю по username (обходит общую рассылку)\n"
             "/force_give user_id — вручную выдать билет по user_id\n"
@@ -36,10 +39,12 @@ def register_help_handlers(bot):
             "/remove_admin @username — удалить администратора\n"
             "/delete_user user_id @username — полностью удалить пользователя из системы и аннулировать все его билеты\n"
             "/myid — узнать свой user_id (например, для назначения админа)\n"
+            "/flood_stats — сколько сообщений и /start отсечено защитой от флуда\n"
             "\n"
             "<b>💬 Логи и аудит переписки:</b>\n"
             "/chatlog user_id — получить txt-файл всей переписки с пользователем\n"
             "/chatlog @username — то же самое по username\n"
+            "/chatlog @username last 50 — последние 50 сообщений; фильтры from/to ГГГГ-ММ-ДД и find слова\n"
             "\n"
             "<b>📢 Рассылки и уведомления:</b>\n"
             "/broadcast текст/медиа — массовая рассылка сообщения/файла всем пользователям\n"
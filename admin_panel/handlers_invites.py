@@ -1,6 +1,7 @@
 import os
 from admin_panel.invite_admin import export_users_xlsx
 from .utils import admin_error_catcher, admin_required, logger
+from .admin_alerts import admin_alerts
 from database import get_admins, is_admin, delete_user_everywhere
 from admin_panel.invite_admin import generate_invites, export_invites_xlsx
 import logging
@@ -35,19 +36,11 @@ def register_invites_handlers(bot):
 
             logger.info(f"Пользователь {message.from_user.id} сгенерировал {count} инвайт-кодов, файл: {temp_path}")
 
-            for admin_id in ADMINS:
-                try:
-                    admin_id = int(admin_id)
-                    if admin_id == message.from_user.id:
-                        continue
-                    if admin_id <= 0:
-                        continue
-                    bot.send_message(
-                        admin_id,
-                        f"🔑 @{message.from_user.username} создал {count} новых приглашений."
-                    )
-                except Exception as e:
-                    print(f"❌ Ошибка отправки админу {admin_id}: {e}")
+            admin_alerts.notify(
+                bot,
+                f"🔑 @{message.from_user.username} создал {count} новых приглашений.",
+                exclude={message.from_user.id}
+            )
 
         else:
             bot.send_message(
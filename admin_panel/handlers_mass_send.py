@@ -1,58 +1,90 @@
-import time
 import os
-import re
-import random
-import sqlite3
+import time
 import tempfile
-import xlsxwriter
 
 from database import (
-    get_all_user_ids,
-    get_user_last_ticket_time,
-    get_free_ticket,
-    assign_ticket,
-    reserve_ticket_for_user,
-    add_failed_delivery,
-    remove_failed_delivery,
-    get_admins,
-    get_all_failed_deliveries,
+    count_failed_deliveries,
     clear_failed_deliveries,
     get_wave_state,
     get_current_wave_id,
-    mark_ticket_lost,
-    release_ticket,
-    clear_user_assignments,
     resolve_user_id,
+    start_delivery_jobs,
+    get_delivery_job_counts,
+    get_delivery_plan,
+)
+from .utils import load_admins, logger, admin_required, admin_error_catcher
+from .chat_log import chat_log_writer, query_chat_log
+from .excel_export import create_workbook, write_sheet, iter_cursor, iter_failed_rows, FAILED_HEADERS, FAILED_COLUMN_WIDTHS
+from .ticket_delivery import (
+    TicketDeliveryWorker,
+    get_active_worker,
+    claim_active_worker,
+    release_active_worker,
+    busy_text,
+    format_duration,
 )
-from .utils import load_admins, logger, admin_required, admin_error_catcher, log_chat
 from datetime import datetime
 import logging
 logger = logging.getLogger(__name__)
 
-# === Telegram 429 обработка ===
-def try_send_with_telegram_limit(send_func, *args, **kwargs):
+CHATLOG_USAGE = (
+    "Использование:\n"
+    "/chatlog user_id или /chatlog @username — вся переписка файлом\n"
+    "Фильтры (можно сочетать):\n"
+    "  last N — последние N сообщений\n"
+    "  from ГГГГ-ММ-ДД / to ГГГГ-ММ-ДД — период\n"
+    "  find слова — сообщения с этими словами (в конце команды)\n"
+    "Например: /chatlog @user from 2024-05-01 last 50 find билет"
+)
+CHATLOG_MESSAGE_LIMIT = 3500  # длиннее — отправляем файлом
+
+
+def parse_chatlog_filters(tokens):
     """
-    Пытается отправить сообщение/документ, обрабатывает лимит 429 Too Many Requests.
-    send_func — функция отправки (например, bot.send_document)
-    *args, **kwargs — её параметры
+    Разбирает фильтры /chatlog: last N, from ДАТА, to ДАТА, find слова...
+    Возвращает dict для query_chat_log или None, если фильтры записаны неверно.
     """
-    for attempt in range(2):  # максимум 2 попытки (основная + одна после ожидания)
-        try:
-            return send_func(*args, **kwargs)
-        except Exception as e:
-            err = str(e)
-            # Ищем retry after в ошибке (TelegramAPIError: Too Many Requests: retry after 27)
-            if "retry after" in err:
-                try:
-                    retry_after = int(re.search(r'retry after (\d+)', err).group(1))
-                    time.sleep(retry_after + 1)
-                except Exception:
-                    time.sleep(5)
-            else:
-                if attempt == 0:
-                    time.sleep(5)  # стандартная пауза если это не лимит
-                else:
-                    raise  # на второй раз просто пробрасываем ошибку дальше
+    filters = {}
+    i = 0
+    while i < len(tokens):
+        key = tokens[i].lower()
+        if key == "find":
+            text = " ".join(tokens[i + 1:])
+            if not text:
+                return None
+            filters["text"] = text
+            break
+        if i + 1 >= len(tokens):
+            return None
+        value = tokens[i + 1]
+        if key == "last":
+            if not value.isdigit() or int(value) == 0:
+                return None
+            filters["last"] = int(value)
+        elif key in ("from", "to"):
+            try:
+                datetime.strptime(value, "%Y-%m-%d")
+            except ValueError:
+                return None
+            filters["since" if key == "from" else "until"] = value
+        else:
+            return None
+        i += 2
+    return filters
+
+
+# Подписи состояний задач рассылки для отчётов
+DELIVERY_STATE_LABELS = {
+    "queued": "В плане",
+    "pending": "Ожидает отправки",
+    "sending": "Отправляется",
+    "sent": "Доставлен",
+    "skipped": "Уже получал",
+    "no_ticket": "Нет билета",
+    "blocked": "Заблокировал бота",
+    "failed": "Ошибка",
+    "cancelled": "Отменён",
+}
 
 def register_mass_send_handler(bot):
     @bot.message_handler(commands=['send_tickets'])
@@ -75,316 +107,155 @@ def register_mass_send_handler(bot):
             bot.reply_to(message, "❗️ Текущая волна не найдена.")
             return
 
-        # 2. Подготовка списка пользователей
-        all_users = get_all_user_ids()
-        admins = set(get_admins())
-        user_ids = [uid for uid in all_users if uid not in admins]
-
-        clear_failed_deliveries()
-        failed_dict = dict(get_all_failed_deliveries())
-
-        sent_count = 0
-        failed_count = 0
-        already_count = 0
-        start_time = time.time()
-        failed_this_time = []
-        logger.info("Начало рассылки: волна %d, всего пользователей %d", wave_id, len(user_ids))
-
-        for idx, user_id in enumerate(user_ids, 1):
-            last_ticket = get_user_last_ticket_time(user_id)
-            if last_ticket and last_ticket >= wave_start:
-                already_count += 1
-                continue 
-
-            # 3. Получаем зарезервированный билет или берём новый из текущей волны
-            ticket_path = failed_dict.get(user_id)
-            if not ticket_path:
-                ticket_path = get_free_ticket(wave_id)
-                if not ticket_path:
-                    bot.send_message(
-                        message.chat.id,
-                        f"🎟 Билеты закончились! Рассылка завершена.\n"
-                        f"Успешно: {sent_count}, ошибок: {failed_count}, уже получали: {already_count}"
-                    )
-                    logger.info("Рассылка завершена: билеты закончились.")
-                    break
-                clear_user_assignments(user_id, current_wave_id=wave_id)
-                reserve_ticket_for_user(ticket_path, user_id)
-                add_failed_delivery(user_id, ticket_path)
-
-            if not os.path.isfile(ticket_path):
-                # Шаг 1: файл не найден – регистрируем неудачную доставку и уведомляем админов
-                        logger.error("Файл билета не найден: %s для user_id=%d", ticket_path, user_id)
-                        add_failed_delivery(user_id, ticket_path)
-                        for admin_id in get_admins():
-                            try:
-                                bot.send_message(
-                                    admin_id,
-                                    f"❌ Файл билета для user_id={user_id} не найден: {ticket_path}.\n"
-                                    "Пользователь добавлен в failed_deliveries."
-                                )
-                            except:
-                                pass
-                        bot.send_message(
-                            message.chat.id,
-                            "Извините, билет не найден. Администраторы уведомлены."
-                        )
-                        failed_count += 1
-                        logger.error(f"❌ Файл билета не найден: {ticket_path} для user_id={user_id}")
-                        failed_this_time.append(user_id)
-                        continue
-
-            # 4. Отправка с 3 попытками и экспоненциальным бэкоффом
-            max_retries = 3
-            delay = 5
-            for attempt in range(1, max_retries + 1):
-                try:
-                    with open(ticket_path, 'rb') as pdf:
-                        try_send_with_telegram_limit(bot.send_document, user_id, pdf)
-                    assign_ticket(ticket_path, user_id)
-                    remove_failed_delivery(user_id)
-                    log_chat(user_id, "BOT", f"[DOCUMENT] {os.path.basename(ticket_path)}")
-                    sent_count += 1
-
-                    if sent_count == 1 or sent_count % 20 == 0:
-                        bot.send_message(
-                            message.chat.id,
-                            f"Рассылка: успешно отправлено {sent_count} из {len(user_ids)} билетов."
-                        )
-                    logger.info(f"✅ Билет отправлен user_id={user_id} [{idx}/{len(user_ids)}], попытка {attempt}")
-                    time.sleep(random.uniform(3.5, 5.0))
-                    break
-                except Exception as e:
-                    err = str(e).lower()
-                    # 1) если заблокирован бот или 403 — не повторяем
-                    if "403" in err or "bot was blocked" in err:
-                        add_failed_delivery(user_id, ticket_path)
-                        # пользователь заблокировал бота — возвращаем билет в пул
-                        release_ticket(ticket_path)
-                        bot.send_message(
-                            message.chat.id,
-                            f"❌ user_id={user_id} заблокировал бота. Билет возвращён в пул."
-                        )
-                        logger.error(f"Бот заблокирован user_id={user_id}: {e}")
-                        failed_count += 1
-                        failed_this_time.append(user_id)
-                        break
-                    
-                    # 2) проверяем retry-after для 429
-                    m = re.search(r'retry after (\d+)', err)
-                    wait = (int(m.group(1)) + 1) if m else delay
-                    # 3) если ещё есть попытки — ждём и удваиваем delay
-                    if attempt < max_retries:
-                        logger.warning(f"Попытка {attempt} не удалась для user_id={user_id}: {e}. Ждём {wait} сек.")
-                        time.sleep(wait)
-                        delay *= 2
-                        continue
-                    
-                    # 4) все попытки исчерпаны — решаем по наличию файла
-                    if not os.path.isfile(ticket_path):
-                        add_failed_delivery(user_id, ticket_path)
-                        mark_ticket_lost(ticket_path)
-                        bot.send_message(
-                            message.chat.id,
-                            f"❌ Файл не найден: {ticket_path}. Билет помечен LOST."
-                        )
-                    else:
-                        add_failed_delivery(user_id, ticket_path)
-                        release_ticket(ticket_path)
-                        bot.send_message(
-                            message.chat.id,
-                            f"❌ Не удалось доставить ticket для user_id={user_id} после {max_retries} попыток. Билет возвращён в пул."
-                        )
-                    
-            # после цикла, если не break, loop пойдет дальше
-
-        total_time = int(time.time() - start_time)
-        pending_after = get_all_failed_deliveries()
-        pending_count = len(pending_after)
-
-        result_msg = (
-            f"📦 Рассылка завершена!\n"
-            f"Всего пользователей: {len(user_ids)}\n"
-            f"✅ Отправлено: {sent_count}\n"
-            f"❌ Ошибок: {failed_count}\n"
-            f"⏭ Пропущено (уже получали): {already_count}\n"
-            f"🕓 Время: {total_time} сек.\n"
-            f"📭 Ожидают доставки: {pending_count}"
-        )
-        bot.send_message(message.chat.id, result_msg)
-        logger.info(result_msg)
-
-        # Автоматическая повторная рассылка с 3 попытками и экспоненциальным бэкоффом
-        if pending_count > 0:
-            bot.send_message(message.chat.id, "♻️ Авторассылка недоставленных билетов...")
-            retry_sent = retry_failed = 0
-            start_time_retry = time.time()
-
-            for user_id, ticket_path in get_all_failed_deliveries():
-                # Если файл полностью отсутствует — помечаем как LOST и пропускаем
-                if not os.path.isfile(ticket_path):
-                    release_ticket(ticket_path)
-                    mark_ticket_lost(ticket_path)
-                    add_failed_delivery(user_id, ticket_path)
-                    bot.send_message(message.chat.id,
-                        f"❌ Файл не найден: {ticket_path}. Билет помечен LOST для user_id={user_id}."
-                    )
-                    logger.error(f"[AUTO-RETRY] Файл не найден: {ticket_path} для user_id={user_id}")
-                    retry_failed += 1
-                    continue
-
-                # Пытаемся отправить до 3 раз
-                max_retries = 3
-                delay = 5
-                sent = False
-                for attempt in range(1, max_retries + 1):
-                    try:
-                        with open(ticket_path, 'rb') as pdf:
-                            try_send_with_telegram_limit(bot.send_document, user_id, pdf)
-                        assign_ticket(ticket_path, user_id)
-                        remove_failed_delivery(user_id)
-                        log_chat(user_id, "BOT", f"[DOCUMENT] {os.path.basename(ticket_path)}")
-                        retry_sent += 1
-                        logger.info(f"[AUTO-RETRY] Успешно для user_id={user_id}, попытка {attempt}")
-                        sent = True
-                        break
-                    except Exception as e:
-                        err = str(e).lower()
-                        # Критические ошибки — сразу помечаем LOST
-                        
-                        if any(k in err for k in ["403", "bot was blocked"]):
-                            add_failed_delivery(user_id, ticket_path)
-                            release_ticket(ticket_path)
-                            bot.send_message(
-                                message.chat.id,
-                                f"❌ user_id={user_id} заблокировал бота. Билет возвращён в пул."
-                            )
-                            logger.error(f"[AUTO-RETRY] Критическая ошибка для {user_id}: {e}")
-                            retry_failed += 1
-                            sent = True
-                            break
-                        # Обработка 429 Retry-After
-                        m = re.search(r"retry after (\d+)", err)
-                        wait = (int(m.group(1)) + 1) if m else delay
-                        if attempt < max_retries:
-                            logger.warning(f"[AUTO-RETRY] Попытка {attempt} не удалась для {user_id}: {e}. Ждём {wait}s.")
-                            time.sleep(wait)
-                            delay *= 2
-                            continue
-                        # Все попытки исчерпаны
-                        if not os.path.isfile(ticket_path):
-                            release_ticket(ticket_path)
-                            mark_ticket_lost(ticket_path)
-                            add_failed_delivery(user_id, ticket_path)
-                            bot.send_message(
-                                message.chat.id,
-                                f"❌ Файл не найден: {ticket_path}. Билет помечен LOST."
-                            )
-                        else:
-                            add_failed_delivery(user_id, ticket_path)
-                            release_ticket(ticket_path)
-                            bot.send_message(
-                                message.chat.id,
-                                f"❌ Не удалось доставить ticket для user_id={user_id}. Билет возвращён в пул."
-                            )
-                    
-                        logger.error(f"[AUTO-RETRY] Потерян билет {ticket_path} для {user_id}")
-                        retry_failed += 1
-                        # конец цикла попыток
-                time.sleep(5)
-
-            total_time_retry = int(time.time() - start_time_retry)
-            pending_after_retry = get_all_failed_deliveries()
-            bot.send_message(message.chat.id,
-                f"♻️ Авторассылка завершена!\n"
-                f"Доп. отправлено: {retry_sent}\n"
-                f"Ошибок: {retry_failed}\n"
-                f"Осталось: {len(pending_after_retry)}\n"
-                f"Время: {total_time_retry}s"
-            )
-            logger.info(
-                "Рассылка завершена: отправлено=%d, ошибок=%d, скипнуто=%d, общее время=%ds",
-                sent_count, failed_count, already_count, int(time.time() - start_time)
+        # 2. Сначала занимаем слот рассылки: пока он наш, второй /send_tickets не тронет очередь
+        worker = TicketDeliveryWorker(bot, wave_id, wave_start, [message.chat.id])
+        if not claim_active_worker(worker):
+            bot.reply_to(message, busy_text(get_active_worker()))
+            return
+
+        # 3. Очередь волны заполнена при /confirm_wave: запускаем всё, что ещё не доставлено
+        try:
+            clear_failed_deliveries()
+            total = start_delivery_jobs(wave_id)
+        except Exception:
+            release_active_worker(worker)
+            raise
+        if total == 0:
+            release_active_worker(worker)
+            bot.send_message(message.chat.id, "📭 В очереди рассылки нет пользователей, ожидающих билет.")
+            return
+        logger.info("Рассылка волны %d: в очереди %d пользователей", wave_id, total)
+
+        # 4. Разбираем очередь в фоне; при перезапуске бота она продолжится с того же места
+        worker.launch()
+
+    @bot.message_handler(commands=['send_status'])
+    @admin_required(bot)
+    @admin_error_catcher(bot)
+    def handle_send_status(message):
+        worker = get_active_worker()
+        wave_id = worker.wave_id if worker else get_current_wave_id()
+        if not wave_id:
+            bot.reply_to(message, "📭 Активной рассылки нет, текущая волна не найдена.")
+            return
+
+        counts = get_delivery_job_counts(wave_id)
+        if worker:
+            elapsed = time.time() - worker.started_at
+            sent = worker.stats["sent"]
+            rate = sent / elapsed * 60 if elapsed > 0 else 0
+            head = (
+                f"⏳ Идёт рассылка {worker.job_id} (волна №{wave_id})\n"
+                f"Прошло: {format_duration(elapsed)}, скорость: {rate:.0f} билетов/мин\n"
             )
+        else:
+            head = f"📭 Сейчас рассылка не идёт. Очередь волны №{wave_id}:\n"
+
+        lines = [
+            f"В очереди (ждут /send_tickets): {counts.get('queued', 0)}",
+            f"Ожидают отправки: {counts.get('pending', 0) + counts.get('sending', 0)}",
+            f"✅ Доставлено: {counts.get('sent', 0)}",
+            f"⏭ Уже получали: {counts.get('skipped', 0)}",
+            f"🎟 Без билета: {counts.get('no_ticket', 0)}",
+            f"🚫 Заблокировали бота: {counts.get('blocked', 0)}",
+            f"❌ Ошибок: {counts.get('failed', 0)}",
+        ]
+        bot.send_message(message.chat.id, head + "\n".join(lines))
+
+    @bot.message_handler(commands=['send_cancel'])
+    @admin_required(bot)
+    @admin_error_catcher(bot)
+    def handle_send_cancel(message):
+        worker = get_active_worker()
+        if worker is None:
+            bot.reply_to(message, "📭 Сейчас рассылка не идёт.")
+            return
+
+        args = message.text.strip().split()
+        if len(args) > 1 and args[1] != worker.job_id:
+            bot.reply_to(message, f"❗️ Рассылка {args[1]} не найдена. Сейчас идёт {worker.job_id}.")
+            return
+
+        worker.cancel(message.from_user.id)
+        logger.info("Рассылка %s остановлена пользователем %d", worker.job_id, message.from_user.id)
+        bot.reply_to(
+            message,
+            f"🛑 Останавливаем рассылку {worker.job_id}: начатые отправки завершатся, "
+            "остальные задачи останутся в очереди до следующего /send_tickets."
+        )
+
+    @bot.message_handler(commands=['delivery_plan'])
+    @admin_required(bot)
+    @admin_error_catcher(bot)
+    def handle_delivery_plan(message):
+        wave_id = get_current_wave_id()
+        if not wave_id:
+            bot.reply_to(message, "❗️ Текущая волна не найдена. План рассылки составляется при /confirm_wave.")
+            return
+
+        counts = get_delivery_job_counts(wave_id)
+        if not counts:
+            bot.reply_to(message, f"📭 План рассылки волны №{wave_id} пуст.")
+            return
+
+        with_ticket = 0
+
+        def plan_rows():
+            nonlocal with_ticket
+            for user_id, username, state, ticket_path, original_name, attempts, last_error in iter_cursor(get_delivery_plan(wave_id)):
+                if ticket_path:
+                    with_ticket += 1
+                yield [
+                    user_id,
+                    f"@{username}" if username else "",
+                    DELIVERY_STATE_LABELS.get(state, state),
+                    ticket_path or "",
+                    original_name or "",
+                    attempts,
+                    last_error or "",
+                ]
+
+        workbook, path = create_workbook()
+        _, total = write_sheet(
+            workbook, "Delivery Plan",
+            ["user_id", "username", "статус", "ticket_path", "original_name", "попыток", "последняя ошибка"],
+            plan_rows(),
+            [14, 20, 20, 60, 30, 10, 40],
+        )
+        workbook.close()
+
+        caption = (
+            f"📋 План рассылки волны №{wave_id}: {total} пользователей, "
+            f"с билетом {with_ticket}, без билета {counts.get('no_ticket', 0)}"
+        )
+        with open(path, "rb") as doc:
+            bot.send_document(message.chat.id, doc, caption=caption)
+        os.remove(path)
 
     @bot.message_handler(commands=['failed_report'])
     @admin_required(bot)
     @admin_error_catcher(bot)
     def handle_failed_report(message):
-        failed = dict(get_all_failed_deliveries())  # {user_id: ticket_path}
-
-        if not failed:
+        if not count_failed_deliveries():
             bot.send_message(message.chat.id, "✅ Нет пользователей с неудачной доставкой билетов.")
             return
 
-        conn = sqlite3.connect("users.db")
-        cur = conn.cursor()
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            workbook = xlsxwriter.Workbook(tmp.name)
-            worksheet = workbook.add_worksheet("Failed Deliveries")
-
-            worksheet.write_row(0, 0, [
-                "user_id", "username", "ticket_path", "original_name", "статус", "Не доставлено"
-            ])
-
-            for idx, (user_id, ticket_path) in enumerate(failed.items(), 1):
-                cur.execute("SELECT username FROM users WHERE user_id=?", (user_id,))
-                row = cur.fetchone()
-                username = f"@{row[0]}" if row and row[0] else ""
-
-                cur.execute("""
-                    SELECT original_name, lost, archived_unused, assigned_to
-                    FROM tickets
-                    WHERE file_path=?
-                """, (ticket_path,))
-                row = cur.fetchone()
-
-                if row:
-                    original_name, lost, archived, assigned = row
-                    if lost:
-                        status = "Утраченный"
-                    elif archived:
-                        status = "Архивный"
-                    elif assigned:
-                        status = "Выдан"
-                    else:
-                        status = "Активный"
-                else:
-                    original_name = "❓ не найден"
-                    status = "❌ нет данных"
-
-                worksheet.write_row(idx, 0, [
-                    user_id,
-                    username,
-                    ticket_path,
-                    original_name,
-                    status,
-                    "Да"  # раз запись есть в failed_deliveries — значит не доставлено
-                ])
-
-            worksheet.set_column(0, 0, 14)
-            worksheet.set_column(1, 1, 20)
-            worksheet.set_column(2, 2, 60)
-            worksheet.set_column(3, 3, 30)
-            worksheet.set_column(4, 4, 20)
-            worksheet.set_column(5, 5, 18)
-
-            workbook.close()
-
-            doc = open(tmp.name, "rb")
-            bot.send_document(message.chat.id, doc, caption="📄 Отчёт о неудачных доставках билетов")
-            doc.close()
+        workbook, path = create_workbook()
+        write_sheet(workbook, "Failed Deliveries", FAILED_HEADERS, iter_failed_rows(), FAILED_COLUMN_WIDTHS)
+        workbook.close()
 
-        os.remove(tmp.name)        
+        with open(path, "rb") as doc:
+            bot.send_document(message.chat.id, doc, caption="📄 Отчёт о неудачных доставках билетов")
+        os.remove(path)
 
     @bot.message_handler(commands=['chatlog'])
     @admin_required(bot)
     @admin_error_catcher(bot)
     def handle_chatlog(message):
         args = message.text.strip().split()
-        if len(args) != 2:
-            bot.reply_to(message, "Использование: /chatlog user_id или /chatlog @username")
+        filters = parse_chatlog_filters(args[2:]) if len(args) >= 2 else None
+        if filters is None:
+            bot.reply_to(message, CHATLOG_USAGE)
             return
 
         user_ref = args[1]
@@ -393,6 +264,29 @@ def register_mass_send_handler(bot):
             bot.reply_to(message, "Пользователь не найден.")
             return
 
+        if not chat_log_writer.flush():  # дописываем строки, которые ещё в очереди
+            bot.reply_to(message, "⚠️ Журнал переписки отстаёт от очереди — последние сообщения могут не попасть в выгрузку.")
+
+        if filters:
+            # Выборка из индекса переписки (chat_log.db)
+            rows = query_chat_log(user_id, **filters)
+            if not rows:
+                bot.reply_to(message, "По заданным фильтрам сообщений не найдено.")
+                return
+            text = "\n".join(f"[{ts}] {role}: {content}" for ts, role, content in rows)
+            if len(text) <= CHATLOG_MESSAGE_LIMIT:
+                bot.send_message(message.chat.id, f"📄 Переписка с user_id {user_id} ({len(rows)} сообщ.):\n\n{text}")
+                return
+            with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=".txt", encoding="utf-8") as tmp:
+                tmp.write(text + "\n")
+            with open(tmp.name, "rb") as f:
+                bot.send_document(
+                    message.chat.id, f,
+                    caption=f"📄 Переписка с user_id {user_id}: {len(rows)} сообщений по фильтру"
+                )
+            os.remove(tmp.name)
+            return
+
         log_path = os.path.join("logs", f"{user_id}.txt")
         if not os.path.isfile(log_path):
             bot.reply_to(message, "Для этого пользователя ещё нет переписки.")
@@ -1,29 +1,36 @@
 import os
-import sqlite3
 import tempfile
-import xlsxwriter
 from zipfile import ZipFile
 import shutil
 import hashlib
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime
+from telebot import apihelper
 from .utils import (
     admin_error_catcher, load_admins, upload_waiting, logger, admin_required,
     upload_files_received, upload_files_time, log_chat
 )
+from .excel_export import create_workbook, write_sheet, iter_ticket_rows, TICKET_HEADERS
+from .admin_alerts import admin_alerts
 import time  # понадобится для таймаута
+import config
 from config import DEFAULT_TICKET_FOLDER
 from database import (
-    is_duplicate_hash,
-    insert_ticket,
+    get_known_hashes,
+    insert_tickets_batch,
     resolve_user_id,
     get_user_last_ticket_time,
     get_current_wave_id,
-    get_free_ticket,
+    claim_ticket,
     assign_ticket,
+    release_ticket,
     is_registered,
     get_wave_state,
-    DB_PATH,
+    get_connection,
+    transaction,
     archive_missing_tickets,
     mark_ticket_lost,
     mark_ticket_archived_unused
@@ -58,44 +65,16 @@ def register_tickets_handlers(bot):
             return
         # Актуализируем: помечаем в базе как LOST все отсутствующие файлы
         archive_missing_tickets()
-        # 1) Получаем все записи из таблицы tickets
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT file_path, original_name, assigned_to, assigned_at, archived_unused, lost, wave_id
-            FROM tickets
-        """)
-        rows = cur.fetchall()
-        conn.close()  
-        if not rows:
+        # 1) Есть ли что выгружать
+        cur = get_connection().cursor()
+        cur.execute("SELECT EXISTS (SELECT 1 FROM tickets)")
+        if not cur.fetchone()[0]:
             bot.send_message(message.chat.id, "Нет загруженных билетов.")
             return
-        # 2) Генерируем Excel-файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-            wb = xlsxwriter.Workbook(tmp.name)
-            ws = wb.add_worksheet("Tickets Status")
-            # Заголовки
-            headers = ["File Path", "Original Name", "Status", "Assigned To", "Assigned At", "Wave ID"]
-            for col, hdr in enumerate(headers):
-                ws.write(0, col, hdr) 
-            # Данные
-            for i, (path, orig, assigned_to, assigned_at, archived_unused, lost, wave_id) in enumerate(rows, start=1):
-                if lost:
-                    status = "LOST"
-                elif assigned_to is not None:
-                    status = "SENT"
-                elif archived_unused:
-                    status = "ARCHIVED"
-                else:
-                    status = "AVAILABLE"  
-                ws.write(i, 0, path)
-                ws.write(i, 1, orig)
-                ws.write(i, 2, status)
-                ws.write(i, 3, assigned_to or "")
-                ws.write(i, 4, assigned_at or "")
-                ws.write(i, 5, wave_id or "") 
-            wb.close()
-            report_path = tmp.name
+        # 2) Генерируем Excel-файл: строки идут из курсора прямо в файл
+        wb, report_path = create_workbook()
+        write_sheet(wb, "Tickets Status", TICKET_HEADERS, iter_ticket_rows())
+        wb.close()
         # 3) Отправляем отчёт администратору
         with open(report_path, 'rb') as doc:
             bot.send_document(message.chat.id, doc, caption="📊 Список билетов с их статусами")
@@ -113,8 +92,7 @@ def register_tickets_handlers(bot):
 
         # ⛔️ Запрещаем повторную загрузку в рамках одной волны
         if state["status"] == "awaiting_confirm":
-            conn = sqlite3.connect("users.db")
-            cur = conn.cursor()
+            cur = get_connection().cursor()
             cur.execute("""
                 SELECT COUNT(*) FROM tickets
                 WHERE assigned_to IS NULL
@@ -123,7 +101,6 @@ def register_tickets_handlers(bot):
                 AND wave_id IS NULL
             """)
             existing = cur.fetchone()[0]
-            conn.close()
 
             if existing > 0:
                 bot.send_message(
@@ -214,12 +191,10 @@ def register_tickets_handlers(bot):
             upload_files_time.pop(user_id, None)
             return
 
+        zip_path = f"temp_upload_{user_id}.zip"
         try:
             file_info = bot.get_file(doc.file_id)
-            data = bot.download_file(file_info.file_path)
-            zip_path = f"temp_upload_{user_id}.zip"
-            with open(zip_path, 'wb') as f:
-                f.write(data)
+            download_to_file(bot, file_info.file_path, zip_path)
 
             if mode is True:
                 report_path = process_zip(zip_path, uploaded_by=user_id, bot=bot)
@@ -230,11 +205,12 @@ def register_tickets_handlers(bot):
                 with open(report_path, 'rb') as rep:
                     bot.send_document(message.chat.id, rep, caption="📄 Отчёт")
                 os.remove(report_path)
-            os.remove(zip_path)
         except Exception as e:
             bot.send_message(message.chat.id, "❗️ Ошибка при обработке архива.")
             logger.error(f"Ошибка архива для {user_id}: {e}", exc_info=True)
         finally:
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
             upload_waiting[user_id] = False
             upload_files_received.pop(user_id, None)
             upload_files_time.pop(user_id, None)
@@ -295,35 +271,34 @@ def register_tickets_handlers(bot):
             bot.reply_to(message, "Пользователь уже получил билет в этой волне.")
             return
 
-        ticket_path = get_free_ticket(wave_id)
+        ticket_path = claim_ticket(wave_id, user_id)
         if not ticket_path:
             bot.reply_to(message, "Нет доступных билетов для выдачи.")
             return
 
+        sent = False
         try:
             with open(ticket_path, "rb") as pdf:
                 bot.send_document(user_id, pdf, caption="🎟 Ваш билет выдан вручную администратором.")
+            sent = True
             assign_ticket(ticket_path, user_id)
             log_chat(user_id, "BOT", f"[DOCUMENT] {os.path.basename(ticket_path)} (ручная выдача)")
             bot.reply_to(message, f"✅ Билет отправлен пользователю {user_ref}.")
             logger.info(f"Админ {message.from_user.id} выдал билет пользователю {user_id} через /force_give.")
 
-    # ✅ Оповещаем остальных админов
-            from database import get_admins
-            admins = get_admins()
-            for admin_id in admins:
-                if admin_id != message.from_user.id:
-                    try:
-                        bot.send_message(
-                            admin_id,
-                            f"🔔 Админ <b>{message.from_user.id}</b> (@{getattr(message.from_user, 'username', 'без username')}) "
-                            f"выдал билет вручную пользователю <b>{user_id}</b> через <code>/force_give</code>.",
-                            parse_mode="HTML"
-                        )
-                    except Exception:
-                        pass  # если кто-то из админов заблокировал бота
+            # ✅ Оповещаем остальных админов (в фоне)
+            admin_alerts.notify(
+                bot,
+                f"🔔 Админ <b>{message.from_user.id}</b> (@{getattr(message.from_user, 'username', 'без username')}) "
+                f"выдал билет вручную пользователю <b>{user_id}</b> через <code>/force_give</code>.",
+                exclude={message.from_user.id},
+                parse_mode="HTML"
+            )
 
         except Exception as e:
+            if not sent:
+                # Билет так и не ушёл пользователю — возвращаем резерв в пул
+                release_ticket(ticket_path, user_id)
             bot.reply_to(message, f"Ошибка при отправке билета: {e}")
             logger.error(f"Ошибка выдачи билета через /force_give: {e}", exc_info=True)
 
@@ -381,92 +356,162 @@ def archive_old_tickets():
 
     return zip_path
 
-def process_zip(zip_path, uploaded_by, bot):
-    added, duplicates, not_pdf = [], [], []
+CHUNK_SIZE = 1024 * 1024  # 1 МБ — столько архива/PDF держим в памяти за раз
+INGEST_WORKERS = getattr(config, "INGEST_WORKERS", 1)  # потоков распаковки и хеширования ZIP (1 — по очереди)
+PDF_MAGIC = b"%PDF-"
+
+
+def download_to_file(bot, file_path, dest_path):
+    """
+    Скачивает файл из Telegram по кускам прямо на диск (bot.download_file держит весь файл в памяти).
+    Учитывает apihelper.FILE_URL (локальный Bot API сервер) и apihelper.proxy.
+    """
+    if apihelper.FILE_URL is None:
+        url = "https://api.telegram.org/file/bot{0}/{1}".format(bot.token, file_path)
+    else:
+        url = apihelper.FILE_URL.format(bot.token, file_path)
+
+    with requests.get(url, stream=True, proxies=apihelper.proxy, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        with open(dest_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+
+
+def stage_member(zip_path, file_info, staging_dir, archives):
+    """
+    Распаковывает один PDF из архива во временную папку, считая SHA-256 по кускам.
+    Возвращает (staged_path, file_hash, is_pdf); is_pdf — начинается ли файл с сигнатуры %PDF-.
+    archives — {id потока: ZipFile}: у каждого потока свой открытый архив.
+    """
+    thread_id = threading.get_ident()
+    zip_ref = archives.get(thread_id)
+    if zip_ref is None:
+        zip_ref = archives[thread_id] = ZipFile(zip_path, 'r')
+
+    staged_path = os.path.join(staging_dir, f"{uuid4()}.pdf")
+    sha256 = hashlib.sha256()
+    head = b""
+    with zip_ref.open(file_info) as src, open(staged_path, "wb") as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+            if len(head) < len(PDF_MAGIC):
+                head += chunk[:len(PDF_MAGIC)]
+            sha256.update(chunk)
+            dst.write(chunk)
+    return staged_path, sha256.hexdigest(), head.startswith(PDF_MAGIC)
+
+
+def stage_zip(zip_path, workers=None):
+    """
+    Распаковывает PDF из архива во временную папку внутри DEFAULT_TICKET_FOLDER, считая SHA-256 по кускам,
+    так что в памяти никогда не лежит больше одного куска файла (на поток).
+    При workers > 1 распаковка и хеширование идут в пуле потоков (zlib и hashlib отпускают GIL),
+    а результаты разбираются строго в порядке архива — дедупликация та же, что и при обработке по одному.
+    Дубликаты (в базе или внутри архива) и файлы без сигнатуры PDF сразу удаляются из временной папки.
+    Возвращает (staging_dir, staged, duplicates, not_pdf), где staged — [(staged_path, hash, original_name)].
+    """
+    workers = max(1, int(workers or INGEST_WORKERS))
+    staging_dir = os.path.join(DEFAULT_TICKET_FOLDER, f".staging_{uuid4().hex}")
+    os.makedirs(staging_dir)
+    staged, duplicates, not_pdf = [], [], []
+    known_hashes = get_known_hashes()  # хеши из базы — одним запросом, а не по запросу на файл
     seen_hashes = set()  # для уникальности внутри одного архива
-    temp_store = []
-
-    # 1) Сканируем архив, собираем только новые и уникальные файлы
-    with ZipFile(zip_path, 'r') as zip_ref:
-        for file_info in zip_ref.infolist():
-            original_name = file_info.filename
-            if not original_name.lower().endswith(".pdf"):
-                not_pdf.append(original_name)
-                continue
-
-            content = zip_ref.read(file_info)
-            file_hash = hashlib.sha256(content).hexdigest()
-
-            # пропускаем, если в базе уже есть
-            if is_duplicate_hash(file_hash):
-                duplicates.append(original_name)
-                continue
-
-            # пропускаем, если уже встретили такой же файл в этом же архиве
-            if file_hash in seen_hashes:
-                duplicates.append(original_name)
-                continue
-
-            seen_hashes.add(file_hash)
-            uuid_name = f"{uuid4()}.pdf"
-            full_path = os.path.join(DEFAULT_TICKET_FOLDER, uuid_name)
-            temp_store.append((content, file_hash, original_name, full_path, uuid_name))
+    archives = {}
+
+    try:
+        with ZipFile(zip_path, 'r') as zip_ref:
+            members = []
+            for file_info in zip_ref.infolist():
+                if file_info.filename.lower().endswith(".pdf"):
+                    members.append(file_info)
+                else:
+                    not_pdf.append(file_info.filename)
 
-    # 2) Если нет новых PDF — отменяем весь процесс
-    if not temp_store:
-        bot.send_message(
-            uploaded_by,
-            "⛔️ В архиве нет новых PDF-файлов (все либо дубликаты, либо не PDF).",
-            parse_mode="HTML"
-        )
-        return None
+        def stage(file_info):
+            return stage_member(zip_path, file_info, staging_dir, archives)
 
-    # 3) Архивируем старые билеты (только раз, перед добавлением новых)
-    archive_result = archive_old_tickets()
-    if archive_result:
-        bot.send_message(
-            uploaded_by,
-            f"📦 Старые билеты перемещены в архив:\n<code>{archive_result}</code>",
-            parse_mode="HTML"
-        )
-        logger.info(f"Архив старых билетов создан: {archive_result}")
+        if workers > 1 and len(members) > 1:
+            executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+            results = executor.map(stage, members)  # map отдаёт результаты в порядке архива
+        else:
+            executor = None
+            results = map(stage, members)
 
-    # 4) Сохраняем новые файлы и вносим запись в БД
-    
-    for content, file_hash, original_name, full_path, uuid_name in temp_store:
         try:
-            # Сохраняем файл на диск
-            with open(full_path, "wb") as f:
-                f.write(content)
-
-             # 🟢 Вставляем запись о новом билете
-            insert_ticket(full_path, file_hash, original_name, uploaded_by)
+            for file_info, (staged_path, file_hash, is_pdf) in zip(members, results):
+                original_name = file_info.filename
+                if not is_pdf:
+                    os.remove(staged_path)
+                    not_pdf.append(f"{original_name} (не PDF по содержимому)")
+                    continue
+
+                # пропускаем, если в базе уже есть или уже встретили такой же файл в этом архиве
+                if file_hash in seen_hashes or file_hash in known_hashes:
+                    os.remove(staged_path)
+                    duplicates.append(original_name)
+                    continue
+
+                seen_hashes.add(file_hash)
+                staged.append((staged_path, file_hash, original_name))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            for zip_ref in archives.values():
+                zip_ref.close()
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    return staging_dir, staged, duplicates, not_pdf
+
+
+def commit_staged_tickets(staging_dir, staged, uploaded_by):
+    """
+    Переносит файлы из временной папки в DEFAULT_TICKET_FOLDER и вносит их в базу одной транзакцией
+    (один executemany на всю партию). Если что-то пошло не так — перенесённые файлы удаляются,
+    в базе не остаётся ни одной записи партии.
+    Возвращает (added, duplicates): added — [(original_name, uuid_name)].
+    """
+    # Привязываем билеты к текущей волне сразу (если волна не ждёт подтверждения) — один раз на партию
+    state = get_wave_state()
+    wave_id = None if state["status"] == "awaiting_confirm" else get_current_wave_id()
+
+    added, duplicates, rows, moves, moved = [], [], [], [], []
+    uploaded_at = datetime.now().isoformat()
+    try:
+        with transaction(immediate=True) as cur:
+            # Под блокировкой перепроверяем хеши: параллельная загрузка могла успеть добавить те же файлы
+            known_hashes = get_known_hashes(cur)
+            for staged_path, file_hash, original_name in staged:
+                if file_hash in known_hashes:
+                    duplicates.append(original_name)
+                    continue
+                uuid_name = os.path.basename(staged_path)
+                full_path = os.path.join(DEFAULT_TICKET_FOLDER, uuid_name)
+                rows.append((full_path, file_hash, original_name, uploaded_by, uploaded_at, wave_id))
+                moves.append((staged_path, full_path))
+                added.append((original_name, uuid_name))
+            insert_tickets_batch(cur, rows)
+
+            for staged_path, full_path in moves:
+                os.replace(staged_path, full_path)
+                moved.append(full_path)
+    except BaseException:
+        for full_path in moved:
+            try:
+                os.remove(full_path)
+            except OSError:
+                pass
+        raise
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
-             # 🟢 Привязываем билет к текущей волне сразу при первичной загрузке
-            state = get_wave_state()
-            if state["status"] == "awaiting_confirm":
-                wave_id = None  # волна не подтверждена — не привязываем
-            else:
-                wave_id = get_current_wave_id()
-            if wave_id is not None:
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute(
-                    "UPDATE tickets SET wave_id = ? WHERE file_path = ?",
-                    (wave_id, full_path)
-                )
-                conn.commit()
-                conn.close()
+    return added, duplicates
 
-             # Фиксируем успех
-            added.append((original_name, uuid_name))
-        except sqlite3.IntegrityError:
-            # Если такой хеш уже в базе — считаем дубликатом
-            duplicates.append(original_name)    
 
-    # 5) Формируем и возвращаем отчёт
+def build_upload_report(title, added, duplicates, not_pdf):
     report_lines = [
-        "=== Отчёт по загрузке билетов ===",
+        title,
         f"Добавлено новых файлов: {len(added)}",
         f"Пропущено дубликатов: {len(duplicates)}",
         f"Пропущено не PDF: {len(not_pdf)}",
@@ -486,68 +531,48 @@ def process_zip(zip_path, uploaded_by, bot):
     with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt', encoding='utf-8') as temp_file:
         temp_file.write(report_text)
         return temp_file.name
-    
 
-def process_zip_add(zip_path, uploaded_by, bot):
-    added, duplicates, not_pdf = [], [], []
-    seen_hashes = set()
-
-    with ZipFile(zip_path, 'r') as zip_ref:
-        for file_info in zip_ref.infolist():
-            original_name = file_info.filename
-            if not original_name.lower().endswith(".pdf"):
-                not_pdf.append(original_name)
-                continue
-            content = zip_ref.read(file_info)
-            file_hash = hashlib.sha256(content).hexdigest()
-            if is_duplicate_hash(file_hash):
-                duplicates.append(original_name)
-                continue
-            if file_hash in seen_hashes:
-                duplicates.append(original_name)
-                continue
-            seen_hashes.add(file_hash)
-            uuid_name = f"{uuid4()}.pdf"
-            full_path = os.path.join(DEFAULT_TICKET_FOLDER, uuid_name)
-            with open(full_path, "wb") as f:
-                f.write(content)
-            # Вставляем запись о новом билете и сразу привязываем её к текущей волне
-            insert_ticket(full_path, file_hash, original_name, uploaded_by)
-
-            state = get_wave_state()
-            if state["status"] == "awaiting_confirm":
-                wave_id = None  # волна не подтверждена — не привязываем
-            else:
-                wave_id = get_current_wave_id()
-            if wave_id is not None:
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute(
-                    "UPDATE tickets SET wave_id = ? WHERE file_path = ?",
-                    (wave_id, full_path),
-                )
-                conn.commit()
-                conn.close()
-            added.append((original_name, uuid_name))
 
-    report_lines = [
-        "=== Отчёт по ДОЗАГРУЗКЕ билетов ===",
-        f"Добавлено новых файлов: {len(added)}",
-        f"Пропущено дубликатов: {len(duplicates)}",
-        f"Пропущено не PDF: {len(not_pdf)}",
-        ""
-    ]
-    if added:
-        report_lines.append("✅ Добавлены:")
-        report_lines += [f"- {orig} → {new}" for orig, new in added]
-    if duplicates:
-        report_lines.append("\n♻️ Дубликаты:")
-        report_lines += [f"- {name}" for name in duplicates]
-    if not_pdf:
-        report_lines.append("\n❌ Не PDF:")
-        report_lines += [f"- {name}" for name in not_pdf]
+def process_zip(zip_path, uploaded_by, bot):
+    # 1) Распаковываем во временную папку только новые и уникальные PDF
+    staging_dir, staged, duplicates, not_pdf = stage_zip(zip_path)
 
-    report_text = "\n".join(report_lines)
-    with tempfile.NamedTemporaryFile(mode='w+', delete=False, suffix='.txt', encoding='utf-8') as temp_file:
-        temp_file.write(report_text)
-        return temp_file.name
+    # 2) Если нет новых PDF — отменяем весь процесс
+    if not staged:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        bot.send_message(
+            uploaded_by,
+            "⛔️ В архиве нет новых PDF-файлов (все либо дубликаты, либо не PDF).",
+            parse_mode="HTML"
+        )
+        return None
+
+    # 3) Архивируем старые билеты (только раз, перед добавлением новых)
+    try:
+        archive_result = archive_old_tickets()
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    if archive_result:
+        bot.send_message(
+            uploaded_by,
+            f"📦 Старые билеты перемещены в архив:\n<code>{archive_result}</code>",
+            parse_mode="HTML"
+        )
+        logger.info(f"Архив старых билетов создан: {archive_result}")
+
+    # 4) Переносим новые файлы на место и вносим записи в БД одной партией
+    added, late_duplicates = commit_staged_tickets(staging_dir, staged, uploaded_by)
+
+    # 5) Формируем и возвращаем отчёт
+    return build_upload_report(
+        "=== Отчёт по загрузке билетов ===", added, duplicates + late_duplicates, not_pdf
+    )
+
+
+def process_zip_add(zip_path, uploaded_by, bot):
+    staging_dir, staged, duplicates, not_pdf = stage_zip(zip_path)
+    added, late_duplicates = commit_staged_tickets(staging_dir, staged, uploaded_by)
+    return build_upload_report(
+        "=== Отчёт по ДОЗАГРУЗКЕ билетов ===", added, duplicates + late_duplicates, not_pdf
+    )
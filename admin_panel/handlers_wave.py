@@ -1,9 +1,10 @@
-import sqlite3
 import os
 import logging
 logger = logging.getLogger(__name__)
 from datetime import datetime
 from .utils import admin_error_catcher, load_admins, admin_required
+from .ticket_delivery import get_active_worker, STOP_TIMEOUT
+from .wave_stats import get_cached_wave_stats, invalidate_wave_stats
 from database import (
     create_new_wave,
     get_all_user_ids,
@@ -11,10 +12,14 @@ from database import (
     clear_failed_deliveries,
     set_wave_state,
     get_wave_state,
-    get_admins,
+    get_admin_set,
     get_current_wave_id,
+    get_wave_stats,
     archive_all_old_free_tickets,
-    DB_PATH,
+    plan_delivery_jobs,
+    cancel_delivery_jobs,
+    get_connection,
+    transaction,
 )
 
 
@@ -43,8 +48,7 @@ def register_wave_handlers(bot):
 
         # 🚫 Запрет, если в idle уже загружены билеты без волны
         if state["status"] == "idle":
-            conn = sqlite3.connect("users.db")
-            cur = conn.cursor()
+            cur = get_connection().cursor()
             cur.execute("""
                 SELECT COUNT(*) FROM tickets
                 WHERE assigned_to IS NULL
@@ -53,7 +57,6 @@ def register_wave_handlers(bot):
                 AND wave_id IS NULL
             """)
             pending = cur.fetchone()[0]
-            conn.close()
 
             if pending > 0:
                 bot.send_message(
@@ -100,13 +103,12 @@ def register_wave_handlers(bot):
 
         prepared_at = datetime.fromisoformat(state["prepared_at"])
         all_users = get_all_user_ids()
-        admins = set(get_admins())
+        admins = get_admin_set()
         user_count = len([uid for uid in all_users if uid not in admins])
 
         lost_count = archive_missing_tickets()
 
-        conn = sqlite3.connect("users.db")
-        cur = conn.cursor()
+        cur = get_connection().cursor()
         cur.execute("""
             SELECT COUNT(*) FROM tickets
             WHERE assigned_to IS NULL
@@ -126,29 +128,34 @@ def register_wave_handlers(bot):
                 msg += f"⚠️ Также обнаружено {lost_count} утраченных билетов.\n"
             msg += "Для загрузки билетов используйте /upload_zip_add"
             bot.send_message(message.chat.id, msg)
-            conn.close()
             return
 
         wave_start, wave_id = create_new_wave(message.from_user.id)
 
         # Обновим wave_id для всех загруженных файлов, включая lost
-        cur.execute("""
-            UPDATE tickets
-            SET assigned_at = NULL, wave_id = ?
-            WHERE wave_id IS NULL AND uploaded_at > ?
-        """, (wave_id, prepared_at.isoformat()))
-        conn.commit()
-        conn.close()
+        with transaction() as cur:
+            cur.execute("""
+                UPDATE tickets
+                SET assigned_at = NULL, wave_id = ?
+                WHERE wave_id IS NULL AND uploaded_at > ?
+            """, (wave_id, prepared_at.isoformat()))
 
         set_wave_state("active", wave_start=wave_start)
 
+        # План рассылки: задача на каждого пользователя волны с закреплённым билетом
+        plan = plan_delivery_jobs(wave_id, wave_start)
+        lost_count += plan["lost"]
+
         msg = (
             f"✅ Волна №{wave_id} подтверждена и активирована!\n"
             f"Время начала: {wave_start}\n"
+            f"📬 План рассылки: {plan['queued']} пользователей, билеты закреплены за {plan['reserved']}\n"
         )
+        if plan["no_ticket"] > 0:
+            msg += f"🎟 Без билета останутся: {plan['no_ticket']}\n"
         if lost_count > 0:
             msg += f"⚠️ Также во время запуска обнаружено {lost_count} утраченных билетов.\n"
-        msg += "Теперь можно использовать /send_tickets."
+        msg += "Проверить план: /delivery_plan. Запуск рассылки: /send_tickets."
 
         bot.send_message(message.chat.id, msg)
 
@@ -173,28 +180,25 @@ def register_wave_handlers(bot):
         # Если волна НЕ была подтверждена — удаляем «сирот» и сбрасываем в одном шаге 
         if status == "awaiting_confirm":
             # 1) Собираем сиротские билеты
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT file_path FROM tickets
-                WHERE wave_id IS NULL
-                AND assigned_to IS NULL
-                AND archived_unused = 0
-                AND lost = 0
-            """)
-            orphans = [row[0] for row in cur.fetchall()]
-
-            # 2) Удаляем их из БД
-            if orphans:
+            with transaction() as cur:
                 cur.execute("""
-                    DELETE FROM tickets
+                    SELECT file_path FROM tickets
                     WHERE wave_id IS NULL
                     AND assigned_to IS NULL
                     AND archived_unused = 0
                     AND lost = 0
                 """)
-                conn.commit()
-            conn.close()
+                orphans = [row[0] for row in cur.fetchall()]
+
+                # 2) Удаляем их из БД
+                if orphans:
+                    cur.execute("""
+                        DELETE FROM tickets
+                        WHERE wave_id IS NULL
+                        AND assigned_to IS NULL
+                        AND archived_unused = 0
+                        AND lost = 0
+                    """)
 
             # 3) Стираем файлы
             removed = 0
@@ -223,6 +227,22 @@ def register_wave_handlers(bot):
             return
 
         # Если волна была подтверждена и активна 
+        # 0) Останавливаем рассылку и ждём начатые отправки: задачи и волну сбрасываем,
+        #    только когда никто больше не пишет результаты доставки
+        worker = get_active_worker()
+        if worker is not None:
+            worker.engine.stop()
+            bot.send_message(message.chat.id, f"🛑 Останавливаем рассылку {worker.job_id}, ждём завершения начатых отправок…")
+            if not worker.wait(STOP_TIMEOUT):
+                bot.send_message(
+                    message.chat.id,
+                    f"⏳ Рассылка {worker.job_id} ещё завершает отправки — волна не завершена. "
+                    "Повторите /end_wave через минуту."
+                )
+                return
+        wave_id = get_current_wave_id()
+        cancelled = cancel_delivery_jobs(wave_id) if wave_id else 0
+
         # 1) Архивируем пропавшие билеты
         lost_count = archive_missing_tickets()
 
@@ -231,6 +251,8 @@ def register_wave_handlers(bot):
 
         # 3) Сообщение об успешном завершении
         msg = "✅ Волна завершена и сброшена. Теперь можно: /new_wave"
+        if cancelled > 0:
+            msg += f"\n📭 Снято из очереди рассылки: {cancelled}."
         if lost_count > 0:
             msg += f"\n⚠️ Помечено утраченных файлов: {lost_count}."
         bot.send_message(message.chat.id, msg)
@@ -241,45 +263,16 @@ def register_wave_handlers(bot):
             bot.send_message(message.chat.id, "📊 Статистика недоступна: волна не запущена.")
             return
 
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-
-        # Всего в этой волне
-        cur.execute("SELECT COUNT(*) FROM tickets WHERE wave_id = ?", (wave_id,))
-        total_tickets = cur.fetchone()[0]
-
-        # Свободные
-        cur.execute("""
-            SELECT COUNT(*) FROM tickets
-            WHERE wave_id = ? AND assigned_to IS NULL AND archived_unused = 0 AND lost = 0
-        """, (wave_id,))
-        free_tickets = cur.fetchone()[0]
-
-        # Выданные
-        cur.execute("""
-            SELECT COUNT(*) FROM tickets
-            WHERE wave_id = ? AND assigned_to IS NOT NULL AND lost = 0
-        """, (wave_id,))
-        issued_tickets = cur.fetchone()[0]
-
-        # Утраченные
-        cur.execute("SELECT COUNT(*) FROM tickets WHERE wave_id = ? AND lost = 1", (wave_id,))
-        lost_tickets = cur.fetchone()[0]
-
-        conn.close()
-
-        # Пользователей (не админов)
-        all_users = get_all_user_ids()
-        admins_set = set(get_admins())
-        user_count = len([u for u in all_users if u not in admins_set])
-
+        # Файлы уже проверены выше — считаем без кеша, одним запросом
+        invalidate_wave_stats()
+        stats = get_wave_stats(wave_id)
         stats_msg = (
             f"<b>📊 Статистика прошлой волны (ID {wave_id}):</b>\n\n"
-            f"👥 Пользователей: <b>{user_count}</b>\n"
-            f"🎟 Всего билетов: <b>{total_tickets}</b>\n"
-            f"📬 Выдано: <b>{issued_tickets}</b>\n"
-            f"📦 Свободных: <b>{free_tickets}</b>\n"
-            f"❌ Утраченных: <b>{lost_tickets}</b>\n"
+            f"👥 Пользователей: <b>{stats['users']}</b>\n"
+            f"🎟 Всего билетов: <b>{stats['total']}</b>\n"
+            f"📬 Выдано: <b>{stats['issued']}</b>\n"
+            f"📦 Свободных: <b>{stats['free']}</b>\n"
+            f"❌ Утраченных: <b>{stats['lost']}</b>\n"
         )
         bot.send_message(message.chat.id, stats_msg, parse_mode="HTML")
 
@@ -293,65 +286,34 @@ def register_wave_handlers(bot):
             bot.reply_to(message, "У вас нет доступа к этой функции.")
             return
 
-        # 1. Актуализация: проверка файлов на утрату
-        lost_count = archive_missing_tickets()
-
-        # 2. Получаем статус волны и ID
+        # 1. Статус волны: до подтверждения считаем ещё не привязанные к волне билеты
         state = get_wave_state()
         wave_status = state["status"]
-        wave_id = get_current_wave_id()
-
-        # 3. Получаем список пользователей (без админов)
-        all_users = get_all_user_ids()
-        admins = set(get_admins())
-        user_count = len([uid for uid in all_users if uid not in admins])
-
-        # 4. Подсчёт билетов в зависимости от стадии волны
-        conn = sqlite3.connect("users.db")
-        cur = conn.cursor()
+        wave_id = get_current_wave_id() if wave_status == "active" else None
 
+        # 2. Все счётчики одним запросом (кеш на несколько секунд, с проверкой файлов на утрату)
+        stats = get_cached_wave_stats(wave_id)
+        lost_count = stats["newly_lost"]
+        user_count = stats["users"]
+        lost_tickets = stats["lost"]
         if wave_status == "active":
-            cur.execute("SELECT COUNT(*) FROM tickets WHERE wave_id=?", (wave_id,))
-            total_tickets = cur.fetchone()[0]
-
-            cur.execute("""
-                SELECT COUNT(*) FROM tickets
-                WHERE wave_id=? AND assigned_to IS NULL AND archived_unused=0 AND lost=0
-            """, (wave_id,))
-            free_tickets = cur.fetchone()[0]
-
-            cur.execute("""
-                SELECT COUNT(*) FROM tickets
-                WHERE wave_id=? AND assigned_to IS NOT NULL AND lost=0
-            """, (wave_id,))
-            issued_tickets = cur.fetchone()[0]
-
-            cur.execute("SELECT COUNT(*) FROM tickets WHERE wave_id=? AND lost=1", (wave_id,))
-            lost_tickets = cur.fetchone()[0]
+            total_tickets = stats["total"]
+            free_tickets = stats["free"]
+            issued_tickets = stats["issued"]
+            reserved_tickets = stats["reserved"]
         else:
-            cur.execute("""
-                SELECT COUNT(*) FROM tickets
-                WHERE wave_id IS NULL AND assigned_to IS NULL AND archived_unused=0 AND lost=0
-            """)
-            total_tickets = cur.fetchone()[0]
-            free_tickets = total_tickets
+            total_tickets = free_tickets = stats["free"]
             issued_tickets = 0
+            reserved_tickets = 0
 
-            cur.execute("""
-                SELECT COUNT(*) FROM tickets
-                WHERE wave_id IS NULL AND lost=1
-            """)
-            lost_tickets = cur.fetchone()[0]
-
-        conn.close()
-
-        # 5. Формируем отчёт
+        # 3. Формируем отчёт
         msg = (
             f"<b>📊 Актуальная статистика волны:</b>\n\n"
             f"🔄 Статус волны: <code>{wave_status}</code>\n"
             f"👥 Пользователей (без админов): <b>{user_count}</b>\n"
             f"🎟 Всего билетов: <b>{total_tickets}</b>\n"
             f"📬 Выдано: <b>{issued_tickets}</b>\n"
+            f"⏳ Зарезервировано под рассылку: <b>{reserved_tickets}</b>\n"
             f"📦 Свободных: <b>{free_tickets}</b>\n"
             f"❌ Утраченных: <b>{lost_tickets}</b>\n"
         )
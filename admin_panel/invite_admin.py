@@ -1,67 +1,67 @@
 import sqlite3
 import secrets
-import tempfile
-import xlsxwriter
+import logging
 from config import BOT_USERNAME
-from database import DB_PATH as DB_FILE
+from database import transaction, get_connection, activate_invite, InviteActivation
+from .excel_export import create_workbook, write_sheet, iter_cursor
+from .admin_alerts import NO_USERNAME_SUMMARY, SECOND_INVITE_SUMMARY
+from .flood import flood_control, BAD_INVITE_TEXT
+
+logger = logging.getLogger(__name__)
 
 
 def generate_invites(count):
     codes = set()
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS invite_codes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        invite_code TEXT UNIQUE,
-        username TEXT,
-        user_id INTEGER,
-        is_used INTEGER DEFAULT 0
-    )
-    ''')
-    conn.commit()
+    with transaction() as cur:
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS invite_codes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            invite_code TEXT UNIQUE,
+            username TEXT,
+            user_id INTEGER,
+            is_used INTEGER DEFAULT 0
+        )
+        ''')
 
     def generate_code():
         return 'inv_' + secrets.token_hex(4)
 
-    while len(codes) < count:
-        code = generate_code()
-        try:
-            cur.execute("INSERT INTO invite_codes (invite_code, is_used) VALUES (?, 0)", (code,))
-            codes.add(code)
-        except sqlite3.IntegrityError:
-            continue
-
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        while len(codes) < count:
+            code = generate_code()
+            try:
+                cur.execute("INSERT INTO invite_codes (invite_code, is_used) VALUES (?, 0)", (code,))
+                codes.add(code)
+            except sqlite3.IntegrityError:
+                continue
+
+    # Код мог раньше попасть в кеш несуществующих (кто-то пробовал его до генерации)
+    flood_control.forget_bad_invites(codes)
     return codes
 
 def export_invites_xlsx(codes):
     # Создаем временный .xlsx-файл
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-        workbook = xlsxwriter.Workbook(tmp.name)
-        worksheet = workbook.add_worksheet("Invite Codes")
-
-        # Заголовки
-        worksheet.write(0, 0, "invite_code")
-        worksheet.write(0, 1, "invite_link")
-
-        # Данные
-        for idx, code in enumerate(codes, 1):
-            link = f"https://t.me/{BOT_USERNAME}?start={code}"
-            worksheet.write(idx, 0, code)
-            worksheet.write(idx, 1, link)
-
-        # Автоширина
-        worksheet.set_column(0, 0, 22)
-        worksheet.set_column(1, 1, 60)
-
-        workbook.close()
-        return tmp.name
-
-def export_users_xlsx():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
+    workbook, path = create_workbook()
+    write_sheet(
+        workbook, "Invite Codes", ["invite_code", "invite_link"],
+        ([code, f"https://t.me/{BOT_USERNAME}?start={code}"] for code in codes),
+        column_widths=[22, 60],
+    )
+    workbook.close()
+    return path
+
+def write_users_sheet(workbook):
+    """
+    Лист Users: пользователи с активированным invite-кодом, под таблицей — итоги.
+    Возвращает (user_count, admin_count).
+    """
+    cur = get_connection().cursor()
+
+    # Итоги считаем в SQL, чтобы не держать строки в памяти
+    cur.execute("SELECT COUNT(DISTINCT user_id) FROM invite_codes WHERE user_id IS NOT NULL")
+    user_count = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM admins")
+    admin_count = cur.fetchone()[0]
 
     # Получаем пользователей с активированным invite-кодом
     cur.execute("""
@@ -69,42 +69,81 @@ def export_users_xlsx():
         FROM invite_codes
         WHERE user_id IS NOT NULL
     """)
-    rows = cur.fetchall()
-
-    # Считаем уникальных пользователей
-    user_count = len({row[2] for row in rows if row[2] is not None})
-
-    # Считаем админов
-    cur.execute("SELECT COUNT(*) FROM admins")
-    admin_count = cur.fetchone()[0]
+    worksheet, idx = write_sheet(
+        workbook, "Users", ["invite_code", "username", "user_id"],
+        ([invite_code, f"@{username}" if username else "", user_id]
+         for invite_code, username, user_id in iter_cursor(cur)),
+        column_widths=[22, 32, 18],
+    )
 
-    conn.close()
+    # Числа пользователей и админов внизу (можно и в caption при отправке)
+    worksheet.write(idx + 2, 0, f"Пользователей: {user_count}")
+    worksheet.write(idx + 3, 0, f"Админов: {admin_count}")
+    return user_count, admin_count
 
+def export_users_xlsx():
     # Генерируем .xlsx
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-        workbook = xlsxwriter.Workbook(tmp.name)
-        worksheet = workbook.add_worksheet("Users")
-
-        # Заголовки
-        worksheet.write(0, 0, "invite_code")
-        worksheet.write(0, 1, "username")
-        worksheet.write(0, 2, "user_id")
-
-        # Если пользователей нет, гарантируем idx для итоговых строк
-        idx = 0
-
-        for idx, (invite_code, username, user_id) in enumerate(rows, 1):
-            worksheet.write(idx, 0, invite_code)
-            worksheet.write(idx, 1, f"@{username}" if username else "")
-            worksheet.write(idx, 2, user_id)
-
-        worksheet.set_column(0, 0, 22)
-        worksheet.set_column(1, 1, 32)
-        worksheet.set_column(2, 2, 18)
-
-        # Числа пользователей и админов внизу (можно и в caption при отправке)
-        worksheet.write(idx + 2, 0, f"Пользователей: {user_count}")
-        worksheet.write(idx + 3, 0, f"Админов: {admin_count}")
-
-        workbook.close()
-        return tmp.name, user_count, admin_count
+    workbook, path = create_workbook()
+    user_count, admin_count = write_users_sheet(workbook)
+    workbook.close()
+    return path, user_count, admin_count
+
+
+def start_response(message):
+    """
+    Вся логика пользовательского /start (bot.py и bot_async.py): проверки, активация invite одной
+    транзакцией и тексты. Возвращает (текст ответа, писать ли его в журнал переписки, уведомление
+    админам — kwargs для admin_alerts.notify или None). Ходит в БД, поэтому в асинхронном
+    рантайме вызывается через run_db.
+    """
+    args = message.text.split()
+    user_id = message.from_user.id
+    username = message.from_user.username
+
+    # ---------- ПРОВЕРКА USERNAME ----------
+    if not username:
+        alert = {
+            "text": f"⚠️ Пользователь {user_id} не смог активироваться по инвайту {args[1] if len(args)>1 else '[нет кода]'} — у него нет username.\n"
+                    f"Инвайт не сожжён. Пользователь не добавлен в базу.",
+            "kind": "start_no_username",
+            "summary": NO_USERNAME_SUMMARY,
+        }
+        return (
+            "⛔️ У вас не установлен username в Telegram.\n\n"
+            "Без него вы не сможете получить билет.\n\n"
+            "Что делать:\n"
+            "1. Откройте настройки Telegram.\n"
+            "2. Установите имя пользователя (username).\n"
+            "3. Снова перейдите по вашей пригласительной ссылке."
+        ), False, alert
+
+    # 1) Без INVITE_CODE или неправильный формат
+    if len(args) < 2 or not args[1].startswith("inv_"):
+        return "Вы пытаетесь начать общение с ботом без приглашения. Для получения приглоашения свяжитесь с администратором.", True, None
+    invite_code = args[1]
+    logger.info("Пользователь %d пытается активировать код %s", user_id, invite_code)
+
+    # 2-4) Одной транзакцией: проверка подписки, погашение кода и регистрация пользователя
+    result = activate_invite(invite_code, user_id, username)
+
+    if result is InviteActivation.ALREADY_REGISTERED:
+        # Пользователь пытается активировать второй код: invite сожжён, уведомляем администраторов
+        alert = {
+            "text": f"⚠️ Пользователь {user_id} попытался активировать второй инвайт-код {invite_code}. Код заблокирован.",
+            "kind": "start_second_invite",
+            "summary": SECOND_INVITE_SUMMARY,
+        }
+        return "Вы уже подписаны на рассылку. Ваше действие заблокировано и админы уведомлены.", True, alert
+    if result is InviteActivation.NOT_FOUND:
+        # Повторы с этим кодом отсечёт FloodControlMiddleware, не обращаясь к БД
+        flood_control.remember_bad_invite(invite_code)
+        return BAD_INVITE_TEXT, True, None
+    if result is InviteActivation.ALREADY_USED:
+        return "⛔️ Эта ссылка уже использована. Пожалуйста, Свяжитесь с администратором.", True, None
+    logger.info("Код %s активирован пользователем %d", invite_code, user_id)
+
+    # 5) Приветственное сообщение
+    return (
+        f"Привет, {message.from_user.first_name}! Спасибо, что подписались на рассылку билетов. "
+        "Скоро вы получите информацию о доступных матчах⚽."
+    ), True, None
@@ -0,0 +1,131 @@
+import time
+import logging
+
+import config
+from async_db import run_db
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+from telebot.asyncio_handler_backends import BaseMiddleware as AsyncBaseMiddleware
+from telebot.asyncio_handler_backends import CancelUpdate as AsyncCancelUpdate
+
+from .utils import log_chat, describe_message
+from .flood import flood_control, ALLOW, BLOCK_NOTIFY, BAD_INVITE, FLOOD_TEXT, BAD_INVITE_TEXT
+
+logger = logging.getLogger(__name__)
+
+SLOW_HANDLER_SECONDS = getattr(config, "SLOW_HANDLER_SECONDS", 2.0)  # дольше — пишем предупреждение в лог
+
+
+class InboundMessageMiddleware(BaseMiddleware):
+    """
+    Единый конвейер входящих сообщений: тип содержимого определяется один раз,
+    в журнал переписки пишется одна запись, время обработки замеряется от pre_process до post_process.
+    Хуки времени: add_timing_hook(hook), hook(message, elapsed_seconds, exception).
+    """
+    def __init__(self, slow_threshold=SLOW_HANDLER_SECONDS):
+        super().__init__()
+        self.update_types = ['message']
+        self.slow_threshold = slow_threshold
+        self.timing_hooks = []
+
+    def add_timing_hook(self, hook):
+        self.timing_hooks.append(hook)
+
+    def pre_process(self, message, data):
+        data["received_at"] = time.perf_counter()
+        data["content"] = describe_message(message)
+        log_chat(message.from_user.id, "USER", data["content"])
+
+    def post_process(self, message, data, exception):
+        received_at = data.get("received_at")
+        if received_at is None:
+            return
+        elapsed = time.perf_counter() - received_at
+
+        if elapsed >= self.slow_threshold:
+            logger.warning(
+                "Медленная обработка сообщения от %d (%s): %.2f сек.",
+                message.from_user.id, data["content"][:50], elapsed
+            )
+        for hook in self.timing_hooks:
+            try:
+                hook(message, elapsed, exception)
+            except Exception as e:
+                logger.error(f"Ошибка в хуке замера времени {hook}: {e}", exc_info=True)
+
+
+class AsyncInboundMessageMiddleware(AsyncBaseMiddleware):
+    """
+    Тот же конвейер для AsyncTeleBot (bot_async.py): хуки InboundMessageMiddleware
+    не блокируют (журнал пишется фоновым потоком), поэтому вызываются прямо из корутин.
+    """
+    def __init__(self, inbound=None):
+        super().__init__()
+        self.update_types = ['message']
+        self.inbound = inbound or InboundMessageMiddleware()
+
+    async def pre_process(self, message, data):
+        self.inbound.pre_process(message, data)
+
+    async def post_process(self, message, data, exception):
+        self.inbound.post_process(message, data, exception)
+
+
+def flood_reply_text(decision):
+    # Что ответить на отклонённое сообщение (None — промолчать)
+    if decision == BLOCK_NOTIFY:
+        return FLOOD_TEXT
+    if decision == BAD_INVITE:
+        return BAD_INVITE_TEXT
+    return None
+
+
+class FloodControlMiddleware(BaseMiddleware):
+    """
+    Отсекает флуд до обработчиков, журнала переписки и БД (см. flood.FloodControl).
+    Должен подключаться первым: CancelUpdate останавливает и остальные middleware.
+    """
+    def __init__(self, bot, flood=flood_control):
+        super().__init__()
+        self.update_types = ['message']
+        self.bot = bot
+        self.flood = flood
+
+    def pre_process(self, message, data):
+        decision = self.flood.check(message)
+        if decision == ALLOW:
+            return None
+        text = flood_reply_text(decision)
+        if text:
+            try:
+                self.bot.send_message(message.chat.id, text)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить пользователю {message.from_user.id}: {e}")
+        return CancelUpdate()
+
+    def post_process(self, message, data, exception):
+        pass
+
+
+class AsyncFloodControlMiddleware(AsyncBaseMiddleware):
+    # То же для AsyncTeleBot. Проверка в основном идёт по памяти, но get_admin_set() при истёкшем
+    # кеше читает SQLite, поэтому она выполняется в пуле async_db, а не в event loop
+    def __init__(self, bot, flood=flood_control):
+        super().__init__()
+        self.update_types = ['message']
+        self.bot = bot
+        self.flood = flood
+
+    async def pre_process(self, message, data):
+        decision = await run_db(self.flood.check, message)
+        if decision == ALLOW:
+            return None
+        text = flood_reply_text(decision)
+        if text:
+            try:
+                await self.bot.send_message(message.chat.id, text)
+            except Exception as e:
+                logger.warning(f"Не удалось ответить пользователю {message.from_user.id}: {e}")
+        return AsyncCancelUpdate()
+
+    async def post_process(self, message, data, exception):
+        pass
@@ -0,0 +1,472 @@
+import os
+import time
+import uuid
+import threading
+import logging
+from datetime import datetime
+
+from database import (
+    get_admins,
+    get_wave_state,
+    get_current_wave_id,
+    release_ticket,
+    mark_ticket_lost,
+    add_failed_delivery,
+    count_failed_deliveries,
+    prepare_delivery_jobs,
+    take_delivery_job,
+    get_next_delivery_attempt,
+    finish_delivery_job,
+    retry_delivery_job,
+    complete_delivery_job,
+    reset_stale_delivery_jobs,
+    get_delivery_job_counts,
+    pause_delivery_jobs,
+    close_connection,
+)
+from .delivery import DeliveryEngine, send_with_limits
+from .utils import log_chat
+
+logger = logging.getLogger(__name__)
+
+MAX_DELIVERY_ATTEMPTS = 6   # попыток на одного пользователя (раньше: 3 в основном проходе + 3 в авторассылке)
+RETRY_BASE_DELAY = 5        # сек., задержка перед повтором удваивается с каждой попыткой
+PROGRESS_INTERVAL = 5      # сек., не чаще этого обновляем сообщение о прогрессе
+STOP_TIMEOUT = 30           # сек., сколько /end_wave ждёт, пока остановленная рассылка доведёт начатые отправки
+
+# Рассылка волны, которая выполняется прямо сейчас (в процессе может идти только одна)
+_active_lock = threading.Lock()
+_active_worker = None
+
+
+def get_active_worker():
+    return _active_worker
+
+
+def claim_active_worker(worker):
+    # Занимает слот активной рассылки; False — уже идёт другая
+    global _active_worker
+    with _active_lock:
+        if _active_worker is not None:
+            return False
+        _active_worker = worker
+        return True
+
+
+def release_active_worker(worker):
+    global _active_worker
+    with _active_lock:
+        if _active_worker is worker:
+            _active_worker = None
+
+
+def busy_text(active):
+    # Ответ на /send_tickets, когда слот рассылки занят (active может уже завершиться — тогда None)
+    if active is None:
+        return "⏳ Рассылка уже идёт. Статус: /send_status."
+    return f"⏳ Рассылка {active.job_id} уже идёт. Статус: /send_status, остановить: /send_cancel."
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}" if hours else f"{rest // 60}:{rest % 60:02d}"
+
+
+class TicketDeliveryWorker:
+    """
+    Разбирает очередь delivery_jobs волны: берёт готовые задачи, резервирует билет,
+    отправляет его через DeliveryEngine и записывает результат в очередь.
+    Неудачные попытки не ждут в потоке, а возвращаются в очередь с next_attempt_at,
+    поэтому после перезапуска бота рассылка продолжается с того же места.
+    Запускается в фоне (start), прогресс показывается одним сообщением, которое редактируется.
+    """
+    def __init__(self, bot, wave_id, wave_start, report_chat_ids):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.bot = bot
+        self.wave_id = wave_id
+        self.wave_start = wave_start
+        self.report_chat_ids = list(report_chat_ids)
+        self.engine = DeliveryEngine()
+        self.limiter = self.engine.limiter
+        self.lock = threading.Lock()
+        self.stats = {"sent": 0, "failed": 0, "blocked": 0, "already": 0}
+        self.in_flight = 0
+        self.out_of_tickets = False
+        self.cancelled = False
+        self.cancelled_by = None
+        self.total = 0
+        self.started_at = None
+        self.finished_at = None
+        self.progress_messages = []   # [(chat_id, message_id)] — живое сообщение о прогрессе
+        self.progress_updated_at = 0.0
+        self.thread = None
+        self.finished = threading.Event()   # run() завершился, слот рассылки освобождён
+
+    # --- сообщения админам ---
+    def notify(self, chat_id, text):
+        # Служебные сообщения тоже идут через лимитер, чтобы не словить 429 в чате админа
+        try:
+            send_with_limits(self.limiter, chat_id, lambda: self.bot.send_message(chat_id, text))
+        except Exception as e:
+            logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+    def report(self, text):
+        for chat_id in self.report_chat_ids:
+            self.notify(chat_id, text)
+
+    # --- прогресс ---
+    def progress_text(self):
+        with self.lock:
+            stats = dict(self.stats)
+            out_of_tickets = self.out_of_tickets
+        done = stats["sent"] + stats["failed"] + stats["blocked"] + stats["already"]
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        if self.finished_at:
+            if self.cancelled:
+                status = "⛔ отменена"
+            elif self.engine.stopped:
+                status = "⛔ остановлена"
+            else:
+                status = "✅ завершена"
+        else:
+            status = "🛑 останавливается" if self.engine.stopped else "⏳ идёт"
+        lines = [
+            f"📦 Рассылка {self.job_id} (волна №{self.wave_id}): {status}",
+            f"Обработано: {done} из {self.total}",
+            f"✅ Отправлено: {stats['sent']}",
+            f"⏭ Уже получали: {stats['already']}",
+            f"❌ Ошибок: {stats['failed']}, 🚫 заблокировали бота: {stats['blocked']}",
+            f"🕓 Прошло: {format_duration(elapsed)}",
+        ]
+        if out_of_tickets:
+            lines.append("🎟 Билеты закончились")
+        if not self.finished_at:
+            lines.append("/send_status — подробнее, /send_cancel — остановить")
+        return "\n".join(lines)
+
+    def start_progress(self):
+        text = self.progress_text()
+        for chat_id in self.report_chat_ids:
+            try:
+                sent = send_with_limits(self.limiter, chat_id, lambda: self.bot.send_message(chat_id, text))
+                self.progress_messages.append((chat_id, sent.message_id))
+            except Exception as e:
+                logger.warning(f"Не удалось отправить прогресс рассылки в чат {chat_id}: {e}")
+        self.progress_updated_at = time.monotonic()
+
+    def progress_update_text(self, force=False):
+        # Текст для обновления прогресса или None: редактируем сообщение не чаще раза
+        # в PROGRESS_INTERVAL сек., чтобы не тратить лимит отправки
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.progress_updated_at < PROGRESS_INTERVAL:
+                return None
+            self.progress_updated_at = now
+        return self.progress_text()
+
+    def update_progress(self, force=False):
+        text = self.progress_update_text(force)
+        if text is None:
+            return
+        for chat_id, message_id in self.progress_messages:
+            try:
+                send_with_limits(
+                    self.limiter, chat_id,
+                    lambda: self.bot.edit_message_text(text, chat_id, message_id)
+                )
+            except Exception as e:
+                if "message is not modified" not in str(e):
+                    logger.warning(f"Не удалось обновить прогресс рассылки в чате {chat_id}: {e}")
+
+    # --- очередь ---
+    def jobs(self):
+        # Выдаёт задачи, пока в очереди волны есть pending или кто-то ещё отправляет
+        # (его задача может вернуться в очередь на повтор). Вызывается под замком движка.
+        while not self.engine.stopped:
+            job, wait = self.next_job()
+            if job:
+                yield job
+            elif wait is None:
+                return
+            else:
+                time.sleep(wait)
+
+    def next_job(self):
+        """
+        Берёт из очереди готовую задачу: (job, None). Если готовых нет — (None, сколько подождать),
+        а (None, None) — очередь разобрана.
+        """
+        job = take_delivery_job(self.wave_id)
+        if job:
+            with self.lock:
+                self.in_flight += 1
+            return job, None
+        next_at = get_next_delivery_attempt(self.wave_id)
+        with self.lock:
+            in_flight = self.in_flight
+        if next_at is None and in_flight == 0:
+            return None, None
+        wait = 1.0 if next_at is None else (next_at - datetime.now()).total_seconds()
+        return None, min(max(wait, 0.05), 1.0)
+
+    def process(self, job):
+        try:
+            self.deliver(job)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.update_progress()
+
+    def deliver(self, job):
+        ticket_path, user_id = job["ticket_path"], job["user_id"]
+        should_send, notices = self.before_send(job)
+        if should_send:
+            def send_ticket():
+                with open(ticket_path, 'rb') as pdf:
+                    return self.bot.send_document(user_id, pdf)
+            # 429 обрабатывает лимитер, остальные ошибки — повтор через очередь
+            try:
+                send_with_limits(self.limiter, user_id, send_ticket)
+            except Exception as e:
+                notices = self.after_error(job, e)
+            else:
+                self.after_sent(job)
+        for chat_id, text in notices:
+            self.notify(chat_id, text)
+
+    # Решения по задаче и учёт в БД — общие для потоковой и асинхронной (async_delivery) рассылки.
+    # Отправкой они не занимаются: возвращают уведомления [(chat_id, текст)], которые шлёт вызывающий.
+
+    def before_send(self, job):
+        """
+        Проверки до отправки. Возвращает (отправлять ли билет, уведомления).
+        Билет зарезервирован за задачей при подготовке очереди (prepare_delivery_jobs).
+        """
+        job_id, user_id, ticket_path = job["id"], job["user_id"], job["ticket_path"]
+        if not ticket_path:
+            finish_delivery_job(job_id, "no_ticket")
+            return False, []
+
+        if not os.path.isfile(ticket_path):
+            # Файл не найден – регистрируем неудачную доставку и уведомляем админов
+            logger.error("Файл билета не найден: %s для user_id=%d", ticket_path, user_id)
+            add_failed_delivery(user_id, ticket_path)
+            release_ticket(ticket_path, user_id)
+            mark_ticket_lost(ticket_path)
+            finish_delivery_job(job_id, "failed", "файл билета не найден")
+            with self.lock:
+                self.stats["failed"] += 1
+            text = (
+                f"❌ Файл билета для user_id={user_id} не найден: {ticket_path}.\n"
+                "Пользователь добавлен в failed_deliveries."
+            )
+            return False, [(admin_id, text) for admin_id in get_admins()]
+        return True, []
+
+    def after_sent(self, job):
+        ticket_path, user_id = job["ticket_path"], job["user_id"]
+        complete_delivery_job(job["id"], ticket_path, user_id)
+        log_chat(user_id, "BOT", f"[DOCUMENT] {os.path.basename(ticket_path)}")
+        with self.lock:
+            self.stats["sent"] += 1
+        logger.info(f"✅ Билет отправлен user_id={user_id}, попытка {job['attempts'] + 1}")
+
+    def after_error(self, job, error):
+        # Отправка не удалась: повтор, блокировка или окончательная неудача. Возвращает уведомления.
+        job_id, user_id, ticket_path = job["id"], job["user_id"], job["ticket_path"]
+        attempt = job["attempts"] + 1
+        err = str(error).lower()
+        # 1) если заблокирован бот или 403 — не повторяем
+        if "403" in err or "bot was blocked" in err:
+            add_failed_delivery(user_id, ticket_path)
+            # пользователь заблокировал бота — возвращаем билет в пул
+            release_ticket(ticket_path, user_id)
+            finish_delivery_job(job_id, "blocked", str(error))
+            logger.error(f"Бот заблокирован user_id={user_id}: {error}")
+            with self.lock:
+                self.stats["blocked"] += 1
+            return self.report_notices(f"❌ user_id={user_id} заблокировал бота. Билет возвращён в пул.")
+
+        # 2) если ещё есть попытки — возвращаем задачу в очередь с удвоенной задержкой
+        if attempt < MAX_DELIVERY_ATTEMPTS:
+            delay = RETRY_BASE_DELAY * 2 ** (attempt - 1)
+            logger.warning(f"Попытка {attempt} не удалась для user_id={user_id}: {error}. Повтор через {delay} сек.")
+            retry_delivery_job(job_id, delay, str(error))
+            return []
+
+        # 3) все попытки исчерпаны — решаем по наличию файла
+        add_failed_delivery(user_id, ticket_path)
+        release_ticket(ticket_path, user_id)
+        finish_delivery_job(job_id, "failed", str(error))
+        if not os.path.isfile(ticket_path):
+            mark_ticket_lost(ticket_path)
+            text = f"❌ Файл не найден: {ticket_path}. Билет помечен LOST."
+        else:
+            text = (
+                f"❌ Не удалось доставить ticket для user_id={user_id} после {MAX_DELIVERY_ATTEMPTS} попыток. "
+                "Билет возвращён в пул."
+            )
+        logger.error(f"Не удалось доставить билет {ticket_path} для {user_id}: {error}")
+        with self.lock:
+            self.stats["failed"] += 1
+        return self.report_notices(text)
+
+    def report_notices(self, text):
+        return [(chat_id, text) for chat_id in self.report_chat_ids]
+
+    # --- запуск ---
+    def start(self):
+        """
+        Запускает разбор очереди в фоновом потоке, чтобы не блокировать обработку команд.
+        Возвращает False, если в процессе уже идёт другая рассылка.
+        """
+        if not claim_active_worker(self):
+            return False
+        self.launch()
+        return True
+
+    def launch(self):
+        # Запуск потока рассылки; слот активной рассылки уже занят этим worker (claim_active_worker)
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.run, name=f"ticket-delivery-{self.job_id}", daemon=True)
+        self.thread.start()
+
+    def prepare(self):
+        for text in self.prepare_jobs():
+            self.report(text)
+
+    def prepare_jobs(self):
+        """
+        Вся работа с БД до первой отправки: отсев получивших и резерв билетов одной транзакцией.
+        Возвращает тексты предупреждений для админов.
+        """
+        prepared = prepare_delivery_jobs(self.wave_id, self.wave_start)
+        counts = get_delivery_job_counts(self.wave_id)
+        self.total = counts.get("pending", 0) + counts.get("sending", 0)
+        with self.lock:
+            self.stats["already"] += prepared["skipped"]
+            self.out_of_tickets = prepared["no_ticket"] > 0
+        logger.info(
+            "Рассылка %s: к отправке %d, уже получали %d, без билета %d, не найдено файлов %d",
+            self.job_id, self.total, prepared["skipped"], prepared["no_ticket"], prepared["lost"]
+        )
+        warnings = []
+        if prepared["no_ticket"]:
+            warnings.append(
+                f"🎟 Билетов не хватает: {prepared['no_ticket']} пользователей останутся без билета.\n"
+                "После дозагрузки билетов повторите /send_tickets."
+            )
+        if prepared["lost"]:
+            warnings.append(f"❌ Не найдено файлов билетов: {prepared['lost']}. Они помечены LOST.")
+        return warnings
+
+    def cancel(self, admin_id=None):
+        # Потоки доводят начатые отправки до конца, остальные задачи возвращаются в queued
+        self.cancelled = True
+        self.cancelled_by = admin_id
+        self.engine.stop()
+
+    def wait(self, timeout=None):
+        # Ждёт окончания run() (из потока, не из event loop). True — рассылка завершилась.
+        return self.finished.wait(timeout)
+
+    def run(self):
+        try:
+            self.prepare()
+            logger.info(
+                "Начало рассылки %s: волна %d, задач %d, потоков %d",
+                self.job_id, self.wave_id, self.total, self.engine.workers
+            )
+            self.start_progress()
+            self.engine.run(self.jobs(), self.process)
+            self.finished_at = time.time()
+            cancel_text = self.pause_if_cancelled()
+            self.update_progress(force=True)
+            if cancel_text:
+                self.report(cancel_text)
+            elif not self.engine.stopped:
+                self.report_summary()
+        except Exception as e:
+            logger.error(f"Рассылка {self.job_id} прервана ошибкой: {e}", exc_info=True)
+            self.report(self.error_text(e))
+        finally:
+            release_active_worker(self)
+            close_connection()
+            self.finished.set()
+
+    def pause_if_cancelled(self):
+        # После /send_cancel возвращает оставшиеся задачи в queued и текст отчёта; иначе None
+        if not self.cancelled:
+            return None
+        paused = pause_delivery_jobs(self.wave_id)
+        logger.info("Рассылка %s отменена (admin_id=%s), в очереди осталось %d", self.job_id, self.cancelled_by, paused)
+        return (
+            f"⛔ Рассылка {self.job_id} остановлена. Не отправлено: {paused}.\n"
+            "Продолжить можно командой /send_tickets."
+        )
+
+    def error_text(self, error):
+        return f"❌ Рассылка {self.job_id} прервана ошибкой: {error}"
+
+    def report_summary(self):
+        result_msg = self.summary_text()
+        self.report(result_msg)
+        logger.info(result_msg)
+
+    def summary_text(self):
+        total_time = int(time.time() - self.started_at)
+        counts = get_delivery_job_counts(self.wave_id)
+        pending_count = count_failed_deliveries()
+        result_msg = (
+            f"📦 Рассылка {self.job_id} завершена!\n"
+            f"Всего пользователей в волне: {sum(counts.values())}\n"
+            f"✅ Отправлено: {self.stats['sent']}\n"
+            f"❌ Ошибок: {self.stats['failed']}\n"
+            f"🚫 Заблокировали бота: {self.stats['blocked']}\n"
+            f"⏭ Пропущено (уже получали): {self.stats['already']}\n"
+            f"🕓 Время: {total_time} сек.\n"
+            f"📭 Ожидают доставки: {pending_count}"
+        )
+        return result_msg
+
+
+def find_interrupted_delivery():
+    """
+    Ищет рассылку, прерванную перезапуском: возвращает (wave_id, wave_start, pending) или None.
+    Задачи, застрявшие в sending, возвращаются в очередь.
+    """
+    state = get_wave_state()
+    if state["status"] != "active" or not state["wave_start"]:
+        return None
+    wave_id = get_current_wave_id()
+    if not wave_id:
+        return None
+
+    reset_stale_delivery_jobs()
+    counts = get_delivery_job_counts(wave_id)
+    if not counts.get("pending"):
+        return None
+    return wave_id, datetime.fromisoformat(state["wave_start"]), counts["pending"]
+
+
+def resume_ticket_delivery(bot):
+    """
+    Продолжает прерванную рассылку после перезапуска бота (в фоновом потоке).
+    Отчёт получают все админы. Возвращает worker или None, если продолжать нечего.
+    """
+    interrupted = find_interrupted_delivery()
+    if interrupted is None:
+        return None
+    wave_id, wave_start, pending = interrupted
+
+    logger.info("Продолжаем прерванную рассылку волны %d: в очереди %d", wave_id, pending)
+    worker = TicketDeliveryWorker(bot, wave_id, wave_start, get_admins())
+    if not worker.start():
+        return None
+    worker.report(resume_text(wave_id, pending))
+    return worker
+
+
+def resume_text(wave_id, pending):
+    return f"♻️ Бот перезапущен — продолжаем рассылку волны №{wave_id}. В очереди: {pending}."
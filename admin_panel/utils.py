@@ -1,6 +1,8 @@
 import logging
 from datetime import datetime
-from database import get_admins, is_registered
+from database import get_admin_set, is_registered
+from .chat_log import chat_log_writer
+from .admin_alerts import admin_alerts, UNAUTHORIZED_SUMMARY
 
 LOG_FILE = "bot_errors.log"
 
@@ -25,9 +27,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def load_admins() -> list[int]:
-    """Возвращает список ID админов из БД."""
-    return get_admins()
+def load_admins() -> frozenset[int]:
+    """Возвращает множество ID админов (из кеша, см. database.get_admin_set)."""
+    return get_admin_set()
+
+def unauthorized_response(message):
+    """
+    Админ-команда не от админа (общая часть admin_required и bot_async.py):
+    возвращает (текст ответа, уведомление админам для admin_alerts.notify) или (None, None),
+    если пользователь не зарегистрирован — тогда просто молчим.
+    """
+    user_id = message.from_user.id
+    if not is_registered(user_id):
+        return None, None
+
+    username = getattr(message.from_user, "username", None)
+    command = message.text.split()[0] if message.text else ""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    logger.info(
+        f"[SECURITY] User {user_id} (@{username}) попытался вызвать команду {command} "
+        f"в {now} — прав нет"
+    )
+    # Частые попытки сводятся в одно сообщение админам
+    alert = {
+        "text": (
+            f"⚠️ User <b>{user_id}</b> (@{username}) попытался использовать админ-команду <b>{command}</b> "
+            f"\nВремя: {now}"
+        ),
+        "kind": "unauthorized_command",
+        "summary": UNAUTHORIZED_SUMMARY,
+        "parse_mode": "HTML",
+    }
+    return "У вас нет доступа к этой функции.", alert
 
 def admin_required(bot):
     """
@@ -35,46 +66,25 @@ def admin_required(bot):
     - Если user_id в admins: разрешаем.
     - Если user_id не в admins, но есть в users: пишем 'Нет прав', логируем и уведомляем.
     - Если user_id нет нигде: просто молчим.
+    Обёртка помечена admin_only: bot_async.py отвечает не-админам сам, не занимая пул потоков.
     """
     def decorator(func):
         def wrapper(message, *args, **kwargs):
-            ADMINS = get_admins()
-            user_id = message.from_user.id
-            username = getattr(message.from_user, "username", None)
-            command = message.text.split()[0] if message.text else ""
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-            if user_id in ADMINS:
+            if message.from_user.id in get_admin_set():
                 # Всё ок, админ — пускаем дальше
                 return func(message, *args, **kwargs)
-            elif is_registered(user_id):
-                # Не админ, но зарегистрированный пользователь — логируем и отвечаем
-                logger.info(
-                    f"[SECURITY] User {user_id} (@{username}) попытался вызвать команду {command} "
-                    f"в {now} — прав нет"
-                )
 
-                # Сообщение всем админам
-                for admin_id in ADMINS:
-                    try:
-                        bot.send_message(
-                            admin_id,
-                            f"⚠️ User <b>{user_id}</b> (@{username}) попытался использовать админ-команду <b>{command}</b> "
-                            f"\nВремя: {now}",
-                            parse_mode="HTML"
-                        )
-                    except Exception:
-                        pass
-                
+            text, alert = unauthorized_response(message)
+            if alert:
+                # Сообщение всем админам — в фоне
+                admin_alerts.notify(bot, **alert)
+            if text:
                 try:
-                    log_chat(user_id, "BOT", "Нет прав для этой команды.")
-                    bot.reply_to(message, "У вас нет доступа к этой функции.")
+                    log_chat(message.from_user.id, "BOT", "Нет прав для этой команды.")
+                    bot.reply_to(message, text)
                 except Exception:
                     pass
-                return
-            else:
-                # Вообще не авторизован — просто молчим
-                return
+        wrapper.admin_only = True
         return wrapper
     return decorator
 
@@ -101,17 +111,26 @@ def log_chat(user_id: int, role: str, content: str):
     Логирует любое сообщение в logs/{user_id}.txt
     role: 'USER' или 'BOT'
     content: текст сообщения, имя файла или короткое описание (например, '[DOCUMENT] file.pdf')
+    Запись идёт в фоновом потоке (chat_log.ChatLogWriter), вызов не ждёт диска.
     """
-    from datetime import datetime  # если вызываешь не в начале файла
-    import os
+    chat_log_writer.write(user_id, role, content)
 
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    folder = "logs"
-    os.makedirs(folder, exist_ok=True)
-    path = os.path.join(folder, f"{user_id}.txt")
-    line = f"[{now}] {role.upper()}: {str(content).strip()}\n"
-    try:
-        with open(path, "a", encoding="utf-8") as f:
-            f.write(line)
-    except Exception as e:
-        logger.error(f"Ошибка логирования в {path}: {e}")
+# Метки для сообщений без текста (в журнале переписки)
+CONTENT_TYPE_LABELS = {
+    "photo": "[PHOTO]",
+    "audio": "[AUDIO]",
+    "video": "[VIDEO]",
+    "voice": "[VOICE]",
+    "sticker": "[STICKER]",
+}
+
+def describe_message(message) -> str:
+    """
+    Однострочное описание входящего сообщения для журнала переписки:
+    текст как есть, '[DOCUMENT] имя_файла' для документов, метка типа для остальных.
+    """
+    if message.text:
+        return message.text
+    if message.content_type == "document" and message.document:
+        return f"[DOCUMENT] {message.document.file_name}"
+    return CONTENT_TYPE_LABELS.get(message.content_type, "[UNKNOWN TYPE]")
@@ -0,0 +1,32 @@
+import time
+import threading
+
+import config
+from database import archive_missing_tickets, get_wave_stats
+
+# Админы часто повторяют /stats во время волны — результат держим в памяти несколько секунд
+STATS_CACHE_TTL = getattr(config, "STATS_CACHE_TTL", 5.0)  # сек.
+
+_cache = {}  # wave_id -> (время расчёта, статистика)
+_lock = threading.Lock()
+
+
+def get_cached_wave_stats(wave_id):
+    """
+    Статистика волны (см. database.get_wave_stats) не старше STATS_CACHE_TTL секунд.
+    При пересчёте сначала помечаются пропавшие файлы; сколько их нашлось — в "newly_lost"
+    (для ответа из кеша — 0, эти билеты уже учтены в "lost").
+    """
+    with _lock:
+        cached = _cache.get(wave_id)
+        if cached and time.monotonic() - cached[0] < STATS_CACHE_TTL:
+            return {**cached[1], "newly_lost": 0}
+        newly_lost = archive_missing_tickets()
+        stats = get_wave_stats(wave_id)
+        _cache[wave_id] = (time.monotonic(), stats)
+    return {**stats, "newly_lost": newly_lost}
+
+
+def invalidate_wave_stats():
+    with _lock:
+        _cache.clear()
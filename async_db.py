@@ -0,0 +1,28 @@
+"""
+Доступ к БД из асинхронного рантайма (bot_async.py).
+
+sqlite3 блокирует поток, поэтому функции database.py выполняются в отдельном
+пуле потоков, а корутина только ждёт результат: await run_db(get_wave_state).
+У каждого потока пула своё соединение (database.get_connection), пул небольшой —
+SQLite всё равно пишет по одному.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+ASYNC_DB_WORKERS = getattr(config, "ASYNC_DB_WORKERS", 4)  # потоков для запросов к БД
+
+_executor = ThreadPoolExecutor(max_workers=ASYNC_DB_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    # Выполняет func(*args, **kwargs) в пуле БД и возвращает результат
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown_db_executor():
+    # Дожидается начатых запросов и останавливает пул (при остановке бота)
+    _executor.shutdown(wait=True)
@@ -0,0 +1,220 @@
+"""
+Асинхронный рантайм бота на AsyncTeleBot: python bot_async.py
+
+Нужен aiohttp (pip install aiohttp). Асинхронный рантайм с синхронным мостом:
+- корутины: всё, что приходит от пользователей, — /start, защита от флуда, ответ «нет доступа»
+  на админ-команды не от админа — и рассылка билетов (/send_tickets, продолжение после
+  перезапуска). Запросы к БД идут через пул async_db, отправки ограничены asyncio.Semaphore,
+  а не числом потоков;
+- через SyncBotBridge (пул ASYNC_HANDLER_WORKERS потоков): остальные админские команды и меню —
+  те же обработчики, что в bot.py, вызовы Bot API из них передаются в event loop.
+  На корутины они не переписаны: их вызывают только админы, и поток на команду здесь не узкое место.
+"""
+import asyncio
+import logging
+import functools
+from datetime import datetime
+from inspect import iscoroutinefunction
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from config import BOT_TOKEN
+from database import (
+    init_db,
+    get_wave_state,
+    get_current_wave_id,
+    clear_failed_deliveries,
+    start_delivery_jobs,
+    is_admin,
+    get_admin_set,
+)
+from async_db import run_db, shutdown_db_executor
+from admin_panel import register_admin_handlers
+from admin_panel.admin_menu import register_admin_menu
+from admin_panel.utils import log_chat, unauthorized_response
+from admin_panel.chat_log import chat_log_writer
+from admin_panel.admin_alerts import admin_alerts
+from admin_panel.invite_admin import start_response
+from admin_panel.middleware import AsyncInboundMessageMiddleware, AsyncFloodControlMiddleware
+from admin_panel.ticket_delivery import (
+    get_active_worker,
+    claim_active_worker,
+    release_active_worker,
+    busy_text,
+)
+from admin_panel.async_delivery import AsyncTicketDeliveryWorker, resume_ticket_delivery_async
+
+try:
+    from telebot.async_telebot import AsyncTeleBot
+except ImportError:  # aiohttp не установлен
+    AsyncTeleBot = None
+
+logger = logging.getLogger(__name__)
+
+ASYNC_HANDLER_WORKERS = getattr(config, "ASYNC_HANDLER_WORKERS", 8)  # потоков для синхронных админских команд
+
+
+class SyncBotBridge:
+    """
+    Синхронный «бот» для обработчиков admin_panel поверх AsyncTeleBot.
+    Обработчик выполняется в пуле потоков; вызов метода Bot API (send_message, reply_to, ...)
+    из него отправляется в event loop и ждёт результата, как в обычном TeleBot.
+    """
+    def __init__(self, async_bot, loop, executor):
+        self.async_bot = async_bot
+        self.loop = loop
+        self.executor = executor
+
+    def _wrap_handler(self, func):
+        # Админ-команды (admin_required) не от админа отклоняются здесь же, в event loop:
+        # пользователи не занимают потоки пула
+        admin_only = getattr(func, "admin_only", False)
+
+        async def handler(update):
+            if admin_only and update.from_user.id not in await run_db(get_admin_set):
+                await self.deny(update)
+                return
+            await self.loop.run_in_executor(self.executor, func, update)
+        handler.__name__ = func.__name__
+        return handler
+
+    async def deny(self, message):
+        # Как admin_required для не-админа (admin_panel.utils.unauthorized_response)
+        text, alert = await run_db(unauthorized_response, message)
+        if alert:
+            admin_alerts.notify(self, **alert)
+        if text:
+            log_chat(message.from_user.id, "BOT", "Нет прав для этой команды.")
+            try:
+                await self.async_bot.reply_to(message, text)
+            except Exception:
+                pass
+
+    def message_handler(self, **filters):
+        def decorator(func):
+            self.async_bot.message_handler(**filters)(self._wrap_handler(func))
+            return func
+        return decorator
+
+    def callback_query_handler(self, **filters):
+        def decorator(func):
+            self.async_bot.callback_query_handler(**filters)(self._wrap_handler(func))
+            return func
+        return decorator
+
+    def process_new_messages(self, messages):
+        # Как в TeleBot с пулом потоков: сообщения ставятся в обработку, ответ не ждём
+        asyncio.run_coroutine_threadsafe(self.async_bot.process_new_messages(messages), self.loop)
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_bot, name)
+        if not iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self.loop).result()
+        return call
+
+
+def register_start_handler(bot, sync_bot):
+    # /start как в bot.py (admin_panel.invite_admin.start_response), но БД — через пул async_db.
+    # Уведомления админам уходят из потока admin_alerts, поэтому через синхронный мост sync_bot
+
+    @bot.message_handler(commands=['start'])
+    async def handle_start(message):
+        text, log, alert = await run_db(start_response, message)
+        await bot.send_message(message.chat.id, text)
+        if log:
+            log_chat(message.from_user.id, "BOT", text)
+        if alert:
+            admin_alerts.notify(sync_bot, **alert)
+
+
+def register_send_tickets_handler(bot):
+    # Регистрируется раньше админских обработчиков и перекрывает синхронный /send_tickets
+
+    @bot.message_handler(commands=['send_tickets'])
+    async def handle_send_tickets(message):
+        logger.info("Команда /send_tickets вызвана пользователем %d", message.from_user.id)
+        if not await run_db(is_admin, message.from_user.id):
+            await bot.reply_to(message, "У вас нет доступа к этой функции.")
+            return
+
+        state = await run_db(get_wave_state)
+        if state["status"] != "active":
+            await bot.reply_to(message, "⚠️ Волна ещё не активирована. Сначала выполните /confirm_wave.")
+            return
+
+        wave_start = datetime.fromisoformat(state["wave_start"])
+        wave_id = await run_db(get_current_wave_id)
+        if not wave_id:
+            await bot.reply_to(message, "❗️ Текущая волна не найдена.")
+            return
+
+        # Как в handlers_mass_send: слот рассылки занимаем до того, как трогать очередь
+        worker = AsyncTicketDeliveryWorker(bot, wave_id, wave_start, [message.chat.id])
+        if not claim_active_worker(worker):
+            await bot.reply_to(message, busy_text(get_active_worker()))
+            return
+
+        try:
+            await run_db(clear_failed_deliveries)
+            total = await run_db(start_delivery_jobs, wave_id)
+        except Exception:
+            release_active_worker(worker)
+            raise
+        if total == 0:
+            release_active_worker(worker)
+            await bot.send_message(message.chat.id, "📭 В очереди рассылки нет пользователей, ожидающих билет.")
+            return
+        logger.info("Рассылка волны %d: в очереди %d пользователей", wave_id, total)
+        worker.launch()
+
+
+async def main():
+    if AsyncTeleBot is None:
+        raise SystemExit("Для асинхронного режима установите aiohttp: pip install aiohttp")
+
+    loop = asyncio.get_running_loop()
+    bot = AsyncTeleBot(BOT_TOKEN)
+    bot.setup_middleware(AsyncFloodControlMiddleware(bot))
+    bot.setup_middleware(AsyncInboundMessageMiddleware())
+
+    # Порядок важен: обработчики проверяются по очереди, первыми — асинхронные
+    handler_executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_WORKERS, thread_name_prefix="handler")
+    bridge = SyncBotBridge(bot, loop, handler_executor)
+    register_start_handler(bot, bridge)
+    register_send_tickets_handler(bot)
+    register_admin_menu(bridge)
+    register_admin_handlers(bridge)
+
+    await run_db(init_db)
+    logger.info("Бот запущен (asyncio) и готов принимать команды")
+    await resume_ticket_delivery_async(bot)
+    await bot.remove_webhook()
+    try:
+        await bot.infinity_polling(timeout=10, request_timeout=30)
+    finally:
+        await stop_ticket_delivery()
+        # Ждём пулы вне event loop: синхронный обработчик или уведомление может ждать
+        # ответа Bot API, который выполняется в этом же loop
+        await loop.run_in_executor(None, handler_executor.shutdown)
+        await loop.run_in_executor(None, admin_alerts.stop)
+        await loop.run_in_executor(None, shutdown_db_executor)
+        chat_log_writer.stop()
+        await bot.close_session()
+
+
+async def stop_ticket_delivery():
+    # Прерывает идущую рассылку; недоставленные задачи продолжатся после перезапуска
+    worker = get_active_worker()
+    task = getattr(worker, "task", None)
+    if task is None or task.done():
+        return
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,55 +1,121 @@
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from enum import Enum
 from uuid import uuid4
 import os
 from config import FOUNDER_IDS
+from migrations import apply_migrations
 
 
 DB_PATH = "users.db"
+DB_BUSY_TIMEOUT = 5.0  # сек. ожидания блокировки, прежде чем вернуть "database is locked"
+
+# === СОЕДИНЕНИЯ ===
+# Одно соединение на поток: sqlite3-соединение нельзя делить между потоками,
+# а открывать новое на каждый запрос слишком дорого при массовой рассылке.
+_local = threading.local()
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT)
+    # WAL: читатели не блокируют писателя и наоборот
+    conn.execute("PRAGMA journal_mode=WAL")
+    # В режиме WAL NORMAL безопасен и заметно быстрее FULL
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def get_connection():
+    """
+    Возвращает соединение с БД для текущего потока (создаётся при первом обращении).
+    Соединение не закрывается после запроса — им пользуются все функции модуля.
+    """
+    conns = getattr(_local, "connections", None)
+    if conns is None:
+        conns = _local.connections = {}
+    conn = conns.get(DB_PATH)
+    if conn is None:
+        conn = conns[DB_PATH] = _open_connection(DB_PATH)
+    return conn
+
+def close_connection():
+    # Закрыть соединения текущего потока (например, при завершении рабочего потока).
+    conns = getattr(_local, "connections", None)
+    if not conns:
+        return
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+@contextmanager
+def transaction(immediate=False):
+    """
+    Транзакция на соединении текущего потока: commit при успехе, rollback при ошибке.
+    immediate=True сразу берёт блокировку на запись (BEGIN IMMEDIATE).
+    """
+    conn = get_connection()
+    if immediate:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
 
 def init_failed_deliveries_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS failed_deliveries (
-        user_id INTEGER PRIMARY KEY,
-        ticket_path TEXT NOT NULL
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS failed_deliveries (
+            user_id INTEGER PRIMARY KEY,
+            ticket_path TEXT NOT NULL
+        )
+        """)
 
 def add_failed_delivery(user_id, ticket_path):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT OR REPLACE INTO failed_deliveries (user_id, ticket_path)
-        VALUES (?, ?)
-    """, (user_id, ticket_path))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+            INSERT OR REPLACE INTO failed_deliveries (user_id, ticket_path)
+            VALUES (?, ?)
+        """, (user_id, ticket_path))
 
 def remove_failed_delivery(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM failed_deliveries WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM failed_deliveries WHERE user_id=?", (user_id,))
 
 def get_all_failed_deliveries():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT user_id, ticket_path FROM failed_deliveries")
     rows = cur.fetchall()
-    conn.close()
     return rows
 
+def count_failed_deliveries():
+    cur = get_connection().cursor()
+    cur.execute("SELECT COUNT(*) FROM failed_deliveries")
+    return cur.fetchone()[0]
+
+def get_failed_deliveries_report():
+    """
+    Неудачные доставки для отчёта одним запросом:
+    (user_id, username, ticket_path, ticket_found, original_name, lost, archived_unused, assigned_to).
+    Если билета в tickets нет — ticket_found = 0, остальные его поля NULL. Возвращает курсор.
+    """
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT f.user_id, u.username, f.ticket_path, t.id IS NOT NULL,
+               t.original_name, t.lost, t.archived_unused, t.assigned_to
+        FROM failed_deliveries f
+        LEFT JOIN users u ON u.user_id = f.user_id
+        LEFT JOIN tickets t ON t.file_path = f.ticket_path
+        ORDER BY f.user_id
+    """)
+    return cur
+
 def clear_failed_deliveries():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM failed_deliveries")
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM failed_deliveries")
 
 def init_db():
     init_user_table()
@@ -59,100 +125,89 @@ def init_db():
     init_admins_table()
     init_wave_meta_table()
     init_invite_codes_table()
+    init_delivery_jobs_table()
+    # Индексы и изменения схемы существующих БД — через версионированные миграции
+    apply_migrations(get_connection())
     for founder in FOUNDER_IDS:
         add_admin(founder)
 
 # === USERS ===
 def init_user_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        last_ticket_at TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-def init_invite_codes_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS invite_codes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            invite_code TEXT UNIQUE,
+    with transaction() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
             username TEXT,
-            user_id INTEGER,
-            is_used INTEGER DEFAULT 0
+            last_ticket_at TEXT
         )
-    """)
-    conn.commit()
-    conn.close()
+        """)
+
+def init_invite_codes_table():
+    with transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS invite_codes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                invite_code TEXT UNIQUE,
+                username TEXT,
+                user_id INTEGER,
+                is_used INTEGER DEFAULT 0
+            )
+        """)
 
 
 def add_user(user_id, username):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
 
 def is_registered(user_id: int) -> bool:
     """
     Проверяет, есть ли user_id в таблице users.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
     result = cur.fetchone()
-    conn.close()
     return result is not None
 
 def delete_user_everywhere(user_id: int, username: str) -> bool:
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    # total_changes у общего соединения накопительный, поэтому считаем rowcount каждого запроса
+    changes = 0
+    with transaction() as cur:
+        # Удаление из основной таблицы пользователей
+        cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        changes += cur.rowcount
 
-    # Удаление из основной таблицы пользователей
-    cur.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        # Удаление из invite_codes
+        cur.execute("DELETE FROM invite_codes WHERE user_id = ?", (user_id,))
+        changes += cur.rowcount
 
-    # Удаление из invite_codes
-    cur.execute("DELETE FROM invite_codes WHERE user_id = ?", (user_id,))
+        # Удаление из failed_deliveries
+        cur.execute("DELETE FROM failed_deliveries WHERE user_id = ?", (user_id,))
+        changes += cur.rowcount
 
-    # Удаление из failed_deliveries
-    cur.execute("DELETE FROM failed_deliveries WHERE user_id = ?", (user_id,))
+        # Удаление из очереди рассылки
+        cur.execute("DELETE FROM delivery_jobs WHERE user_id = ?", (user_id,))
+        changes += cur.rowcount
 
-    # Сбросить assigned_to для всех билетов пользователя
-    cur.execute("UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE assigned_to = ?", (user_id,))
-
-    changes = conn.total_changes
-    conn.commit()
-    conn.close()
+        # Сбросить assigned_to для всех билетов пользователя
+        cur.execute("UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE assigned_to = ?", (user_id,))
+        changes += cur.rowcount
 
     return changes > 0
 
 def get_user_last_ticket_time(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT last_ticket_at FROM users WHERE user_id=?", (user_id,))
     row = cur.fetchone()
-    conn.close()
     return datetime.fromisoformat(row[0]) if row and row[0] else None
 
 def update_user_ticket_time(user_id, assigned_at):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET last_ticket_at=? WHERE user_id=?", (assigned_at, user_id))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE users SET last_ticket_at=? WHERE user_id=?", (assigned_at, user_id))
 
 def get_user_id_by_username(username):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT user_id FROM users WHERE username=?", (username,))
     row = cur.fetchone()
-    conn.close()
     return row[0] if row else None
 
 def resolve_user_id(user_ref):
@@ -166,299 +221,720 @@ def resolve_user_id(user_ref):
     return get_user_id_by_username(username)
 
 def get_all_user_ids():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT user_id FROM users")
     user_ids = [row[0] for row in cur.fetchall()]
-    conn.close()
     return user_ids
 
+# === INVITES ===
+
+class InviteActivation(Enum):
+    ACTIVATED = "activated"                    # код погашен, пользователь добавлен
+    ALREADY_REGISTERED = "already_registered"  # пользователь уже подписан — код сожжён
+    NOT_FOUND = "not_found"
+    ALREADY_USED = "already_used"
+
+def activate_invite(invite_code, user_id, username):
+    """
+    Активирует invite-код для пользователя одной транзакцией и возвращает InviteActivation.
+    Код гасится условным UPDATE ... WHERE is_used = 0, поэтому из нескольких одновременных
+    /start с одним кодом успешен ровно один.
+    """
+    with transaction(immediate=True) as cur:
+        cur.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+        if cur.fetchone():
+            # Второй код для уже подписанного пользователя сжигаем
+            cur.execute("UPDATE invite_codes SET is_used = 1 WHERE invite_code = ?", (invite_code,))
+            return InviteActivation.ALREADY_REGISTERED
+
+        cur.execute(
+            "UPDATE invite_codes SET is_used = 1, user_id = ?, username = ? WHERE invite_code = ? AND is_used = 0",
+            (user_id, username, invite_code)
+        )
+        if cur.rowcount == 1:
+            cur.execute("INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)", (user_id, username))
+            return InviteActivation.ACTIVATED
+
+        cur.execute("SELECT 1 FROM invite_codes WHERE invite_code = ?", (invite_code,))
+        return InviteActivation.ALREADY_USED if cur.fetchone() else InviteActivation.NOT_FOUND
+
 # === TICKETS ===
 def init_ticket_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS tickets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        file_path TEXT UNIQUE,
-        hash TEXT UNIQUE,
-        original_name TEXT,
-        uploaded_by INTEGER,
-        uploaded_at TEXT,
-        assigned_to INTEGER,
-        assigned_at TEXT,
-        archived_unused INTEGER DEFAULT 0,
-        lost INTEGER DEFAULT 0,
-        wave_id INTEGER
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_path TEXT UNIQUE,
+            hash TEXT UNIQUE,
+            original_name TEXT,
+            uploaded_by INTEGER,
+            uploaded_at TEXT,
+            assigned_to INTEGER,
+            assigned_at TEXT,
+            archived_unused INTEGER DEFAULT 0,
+            lost INTEGER DEFAULT 0,
+            wave_id INTEGER
+        )
+        """)
 
 def insert_ticket(file_path, file_hash, original_name, uploaded_by):
     uploaded_at = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO tickets (file_path, hash, original_name, uploaded_by, uploaded_at)
-        VALUES (?, ?, ?, ?, ?)
-    """, (file_path, file_hash, original_name, uploaded_by, uploaded_at))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+            INSERT INTO tickets (file_path, hash, original_name, uploaded_by, uploaded_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (file_path, file_hash, original_name, uploaded_by, uploaded_at))
+
+def get_known_hashes(cur=None) -> set:
+    # Все хеши загруженных билетов одним запросом (для пакетной загрузки ZIP)
+    cur = cur or get_connection().cursor()
+    cur.execute("SELECT hash FROM tickets WHERE hash IS NOT NULL")
+    return {row[0] for row in cur.fetchall()}
+
+def insert_tickets_batch(cur, rows):
+    # rows: [(file_path, hash, original_name, uploaded_by, uploaded_at, wave_id)]; транзакцией управляет вызывающий
+    cur.executemany("""
+        INSERT INTO tickets (file_path, hash, original_name, uploaded_by, uploaded_at, wave_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
 
 def is_duplicate_hash(file_hash):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    cur = get_connection().cursor()
     cur.execute("SELECT id FROM tickets WHERE hash=?", (file_hash,))
     row = cur.fetchone()
-    conn.close()
     return row is not None
 
-def get_free_ticket(current_wave_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT file_path FROM tickets
-        WHERE assigned_to IS NULL
-        AND archived_unused = 0
-        AND lost = 0
-        AND wave_id = ?
-    """, (current_wave_id,))
-    files = [row[0] for row in cur.fetchall()]
-    conn.close()
-    for f in files:
-        if os.path.isfile(f):
-            return f
-    return None
-
+def claim_ticket(wave_id, user_id):
+    """
+    Атомарно берёт один свободный билет волны и резервирует его за user_id
+    (assigned_to = user_id, assigned_at = NULL) в одной транзакции.
+    Билеты, чей файл пропал с диска, по пути помечаются как LOST.
+    Возвращает file_path зарезервированного билета или None, если свободных нет.
+    """
+    with transaction(immediate=True) as cur:
+        while True:
+            cur.execute("""
+                SELECT id, file_path FROM tickets
+                WHERE wave_id = ?
+                AND assigned_to IS NULL
+                AND archived_unused = 0
+                AND lost = 0
+                ORDER BY id
+                LIMIT 1
+            """, (wave_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+            ticket_id, file_path = row
+            if not os.path.isfile(file_path):
+                cur.execute("UPDATE tickets SET lost = 1 WHERE id = ?", (ticket_id,))
+                continue
+            cur.execute(
+                "UPDATE tickets SET assigned_to = ?, assigned_at = NULL WHERE id = ?",
+                (user_id, ticket_id)
+            )
+            return file_path
 
 def assign_ticket(file_path, user_id):
     now = datetime.now().isoformat()
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE tickets SET assigned_to=?, assigned_at=? WHERE file_path=?", (user_id, now, file_path))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE tickets SET assigned_to=?, assigned_at=? WHERE file_path=?", (user_id, now, file_path))
     update_user_ticket_time(user_id, now)
 
-def reserve_ticket_for_user(file_path, user_id):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE tickets SET assigned_to=?, assigned_at=NULL WHERE file_path=?", (user_id, file_path))
-    conn.commit()
-    conn.close()
-
 def mark_ticket_archived_unused(file_path):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE tickets SET archived_unused=1 WHERE file_path=? AND assigned_to IS NULL", (file_path,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE tickets SET archived_unused=1 WHERE file_path=? AND assigned_to IS NULL", (file_path,))
 
 def mark_ticket_lost(file_path):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("UPDATE tickets SET lost=1 WHERE file_path=? AND assigned_to IS NULL", (file_path,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE tickets SET lost=1 WHERE file_path=? AND assigned_to IS NULL", (file_path,))
+
+def get_existing_ticket_files(paths):
+    """
+    Возвращает множество тех путей из paths, файлы которых существуют.
+    Каждая папка читается одним os.scandir (обычно это одна DEFAULT_TICKET_FOLDER),
+    а не os.path.isfile на каждый билет.
+    """
+    by_folder = {}
+    for path in paths:
+        by_folder.setdefault(os.path.dirname(path), []).append(path)
+
+    existing = set()
+    for folder, folder_paths in by_folder.items():
+        try:
+            with os.scandir(folder or ".") as entries:
+                names = {entry.name for entry in entries if entry.is_file()}
+        except FileNotFoundError:
+            continue  # папки нет — все её билеты пропали
+        existing.update(path for path in folder_paths if os.path.basename(path) in names)
+    return existing
 
 def archive_missing_tickets():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT file_path FROM tickets WHERE assigned_to IS NULL AND archived_unused=0 AND lost=0")
-    lost_count = 0
-    for (file_path,) in cur.fetchall():
-        if not os.path.isfile(file_path):
-            cur.execute("UPDATE tickets SET lost=1 WHERE file_path=?", (file_path,))
-            lost_count += 1
-    conn.commit()
-    conn.close()
-    return lost_count
+    # Помечает lost=1 свободные билеты, файлов которых нет на диске. Возвращает их число.
+    with transaction() as cur:
+        cur.execute("SELECT id, file_path FROM tickets WHERE assigned_to IS NULL AND archived_unused=0 AND lost=0")
+        tickets = cur.fetchall()
+        existing = get_existing_ticket_files(file_path for _, file_path in tickets)
+        lost = [(ticket_id,) for ticket_id, file_path in tickets if file_path not in existing]
+        cur.executemany("UPDATE tickets SET lost=1 WHERE id=?", lost)
+    return len(lost)
+
+def get_wave_stats(wave_id):
+    """
+    Счётчики билетов волны и число пользователей (без админов) одним запросом.
+    wave_id=None — билеты, ещё не привязанные к волне.
+    """
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT
+            COUNT(*),
+            SUM(CASE WHEN assigned_to IS NULL AND archived_unused = 0 AND lost = 0 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN assigned_at IS NOT NULL AND lost = 0 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN assigned_to IS NOT NULL AND assigned_at IS NULL AND lost = 0 THEN 1 ELSE 0 END),
+            SUM(CASE WHEN lost = 1 THEN 1 ELSE 0 END),
+            (SELECT COUNT(*) FROM users WHERE user_id NOT IN (SELECT user_id FROM admins))
+        FROM tickets
+        WHERE wave_id IS ?
+    """, (wave_id,))
+    total, free, issued, reserved, lost, users = cur.fetchone()
+    return {
+        "total": total,
+        "free": free or 0,
+        "issued": issued or 0,
+        "reserved": reserved or 0,
+        "lost": lost or 0,
+        "users": users,
+    }
 
 def archive_all_old_free_tickets():
     # Отмечает как archived_unused=1 все невыданные билеты (assigned_to IS NULL), lost=0, archived_unused=0, и файл на месте.
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT file_path FROM tickets WHERE assigned_to IS NULL AND archived_unused=0 AND lost=0")
-    for (file_path,) in cur.fetchall():
-        if os.path.isfile(file_path):
-            cur.execute("UPDATE tickets SET archived_unused=1 WHERE file_path=?", (file_path,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("SELECT id, file_path FROM tickets WHERE assigned_to IS NULL AND archived_unused=0 AND lost=0")
+        tickets = cur.fetchall()
+        existing = get_existing_ticket_files(file_path for _, file_path in tickets)
+        cur.executemany(
+            "UPDATE tickets SET archived_unused=1 WHERE id=?",
+            [(ticket_id,) for ticket_id, file_path in tickets if file_path in existing]
+        )
 
-def release_ticket(ticket_path):
+def release_ticket(ticket_path, user_id=None):
     # Освободить один билет: сбросить assigned_to и assigned_at, чтобы он стал вновь доступным.
+    # С user_id билет освобождается, только если он всё ещё закреплён за этим пользователем
+    # (его могли уже вернуть в пул и выдать другому).
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE file_path = ?",
-        (ticket_path,)
-    )
-    conn.commit()
-    conn.close()
-
-def clear_user_assignments(user_id, current_wave_id=None, exclude_path=None):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    if current_wave_id:
-        if exclude_path:
+    with transaction() as cur:
+        if user_id is None:
             cur.execute(
-                "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
-                "WHERE assigned_to = ? AND file_path != ? AND wave_id = ?",
-                (user_id, exclude_path, current_wave_id)
+                "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE file_path = ?",
+                (ticket_path,)
             )
         else:
             cur.execute(
                 "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
-                "WHERE assigned_to = ? AND wave_id = ?",
-                (user_id, current_wave_id)
-            )
-    else:
-        if exclude_path:
-            cur.execute(
-                "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
-                "WHERE assigned_to = ? AND file_path != ?",
-                (user_id, exclude_path)
+                "WHERE file_path = ? AND assigned_to = ?",
+                (ticket_path, user_id)
             )
+
+def clear_user_assignments(user_id, current_wave_id=None, exclude_path=None):
+    with transaction() as cur:
+        if current_wave_id:
+            if exclude_path:
+                cur.execute(
+                    "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
+                    "WHERE assigned_to = ? AND file_path != ? AND wave_id = ?",
+                    (user_id, exclude_path, current_wave_id)
+                )
+            else:
+                cur.execute(
+                    "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
+                    "WHERE assigned_to = ? AND wave_id = ?",
+                    (user_id, current_wave_id)
+                )
         else:
-            cur.execute(
-                "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE assigned_to = ?",
-                (user_id,)
-            )
+            if exclude_path:
+                cur.execute(
+                    "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL "
+                    "WHERE assigned_to = ? AND file_path != ?",
+                    (user_id, exclude_path)
+                )
+            else:
+                cur.execute(
+                    "UPDATE tickets SET assigned_to = NULL, assigned_at = NULL WHERE assigned_to = ?",
+                    (user_id,)
+                )
 
-    conn.commit()
-    conn.close()
 
 # Фильтры для статистики 
 # === WAVES ===
+# Состояние волны (wave_meta + последняя запись waves) читается из памяти: оно нужно почти каждой
+# команде админки, а меняется только через set_wave_state/create_new_wave, которые пишут
+# и в БД, и в кеш (write-through). Бот работает одним процессом, поэтому кеш не устаревает;
+# Словарь кеша не меняется на месте, а заменяется целиком — читатели видят согласованный снимок
+# и не берут замок; он нужен только писателям и первой загрузке.
+# reload_wave_state() перечитывает его из БД принудительно.
+_wave_cache = None
+_wave_cache_lock = threading.RLock()
+
+def _load_wave_cache():
+    cur = get_connection().cursor()
+    cur.execute("SELECT status, prepared_at, wave_start FROM wave_meta WHERE id = 1")
+    status, prepared_at, wave_start = cur.fetchone()
+    cur.execute("SELECT id, wave_start FROM waves ORDER BY wave_start DESC LIMIT 1")
+    row = cur.fetchone()
+    return {
+        "status": status,
+        "prepared_at": prepared_at,
+        "wave_start": wave_start,
+        "wave_id": row[0] if row else None,
+        "wave_started_at": datetime.fromisoformat(row[1]) if row else None,
+    }
+
+def _get_wave_cache():
+    # Читатели берут текущий снимок без блокировки (присваивание словаря атомарно), иначе
+    # каждая команда ждала бы запись set_wave_state в БД. Замок — только для первой загрузки
+    global _wave_cache
+    cache = _wave_cache
+    if cache is not None:
+        return cache
+    with _wave_cache_lock:
+        if _wave_cache is None:
+            _wave_cache = _load_wave_cache()
+        return _wave_cache
+
+def reload_wave_state():
+    global _wave_cache
+    with _wave_cache_lock:
+        _wave_cache = _load_wave_cache()
+
 def init_wave_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS waves (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        wave_start TEXT NOT NULL,
-        created_by INTEGER,
-        confirmed_at TEXT
-    )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS waves (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            wave_start TEXT NOT NULL,
+            created_by INTEGER,
+            confirmed_at TEXT
+        )
+        """)
 
 def create_new_wave(created_by):
     now = datetime.now().replace(microsecond=0).isoformat(" ")
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT INTO waves (wave_start, created_by, confirmed_at) VALUES (?, ?, ?)", (now, created_by, now))
-    wave_id = cur.lastrowid
-    conn.commit()
-    conn.close()
+    global _wave_cache
+    with _wave_cache_lock:
+        cache = _get_wave_cache()
+        with transaction() as cur:
+            cur.execute("INSERT INTO waves (wave_start, created_by, confirmed_at) VALUES (?, ?, ?)", (now, created_by, now))
+            wave_id = cur.lastrowid
+        _wave_cache = {**cache, "wave_id": wave_id, "wave_started_at": datetime.fromisoformat(now)}
     return now, wave_id
 
 def get_latest_wave():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT wave_start FROM waves ORDER BY wave_start DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
-    return datetime.fromisoformat(row[0]) if row else None
+    return _get_wave_cache()["wave_started_at"]
 
 # АДМИНЫ
+# Кеш списка админов: проверка прав на каждую команду и кнопку меню не ходит в БД.
+# add_admin/remove_admin сбрасывают кеш сразу, TTL — страховка на случай правок из другого процесса.
+ADMINS_CACHE_TTL = 30.0  # сек.
+_admins_cache = None
+_admins_cache_at = 0.0
+_admins_cache_version = 0  # растёт при каждом сбросе: чтение, начатое до сброса, не попадёт в кеш
+_admins_cache_lock = threading.Lock()
+
+def invalidate_admins_cache():
+    global _admins_cache, _admins_cache_version
+    with _admins_cache_lock:
+        _admins_cache = None
+        _admins_cache_version += 1
 
 def init_admins_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS admins (
-            user_id    INTEGER PRIMARY KEY,
-            added_at   TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS admins (
+                user_id    INTEGER PRIMARY KEY,
+                added_at   TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
 
 def add_admin(user_id: int):
     # Добавить user_id в таблицу admins (игнорировать, если уже есть).
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+    invalidate_admins_cache()
 
 def remove_admin(user_id: int):
     # Удалить user_id из таблицы admins.
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
+    invalidate_admins_cache()
+
+def get_admin_set() -> frozenset[int]:
+    # Множество user_id админов (из кеша; в БД — не чаще раза в ADMINS_CACHE_TTL сек.).
+    global _admins_cache, _admins_cache_at
+    with _admins_cache_lock:
+        if _admins_cache is not None and time.monotonic() - _admins_cache_at < ADMINS_CACHE_TTL:
+            return _admins_cache
+        version = _admins_cache_version
+    cur = get_connection().cursor()
+    cur.execute("SELECT user_id FROM admins")
+    admins = frozenset(row[0] for row in cur.fetchall())
+    with _admins_cache_lock:
+        if version == _admins_cache_version:
+            _admins_cache, _admins_cache_at = admins, time.monotonic()
+    return admins
 
 def get_admins() -> list[int]:
     # Вернуть список всех user_id из таблицы admins.
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id FROM admins")
-    admins = [row[0] for row in cur.fetchall()]
-    conn.close()
-    return admins
+    return sorted(get_admin_set())
 
 def is_admin(user_id: int) -> bool:
     # Проверяет, является ли пользователь админом (по user_id).
-    
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    return result is not None
+    return user_id in get_admin_set()
 
 def init_wave_meta_table():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS wave_meta (
-            id INTEGER PRIMARY KEY CHECK (id = 1),
-            status TEXT NOT NULL,
-            prepared_at TEXT,
-            wave_start TEXT
-        )
-    """)
-    # вставим одну строку, если её нет
-    cur.execute("INSERT OR IGNORE INTO wave_meta (id, status) VALUES (1, 'idle')")
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS wave_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                status TEXT NOT NULL,
+                prepared_at TEXT,
+                wave_start TEXT
+            )
+        """)
+        # вставим одну строку, если её нет
+        cur.execute("INSERT OR IGNORE INTO wave_meta (id, status) VALUES (1, 'idle')")
 
 def set_wave_state(status, prepared_at=None, wave_start=None):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE wave_meta SET status = ?, prepared_at = ?, wave_start = ? WHERE id = 1
-    """, (status, prepared_at, wave_start))
-    conn.commit()
-    conn.close()
+    # Под блокировкой кеша: порядок записей в БД и в кеш совпадает
+    global _wave_cache
+    with _wave_cache_lock:
+        cache = _get_wave_cache()
+        with transaction() as cur:
+            cur.execute("""
+                UPDATE wave_meta SET status = ?, prepared_at = ?, wave_start = ? WHERE id = 1
+            """, (status, prepared_at, wave_start))
+        _wave_cache = {**cache, "status": status, "prepared_at": prepared_at, "wave_start": wave_start}
 
 def get_wave_state():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT status, prepared_at, wave_start FROM wave_meta WHERE id = 1")
-    row = cur.fetchone()
-    conn.close()
+    # Новый словарь: вызывающий код может его менять, не трогая кеш
+    cache = _get_wave_cache()
     return {
-        "status": row[0],
-        "prepared_at": row[1],
-        "wave_start": row[2]
+        "status": cache["status"],
+        "prepared_at": cache["prepared_at"],
+        "wave_start": cache["wave_start"]
     }
 
 def get_current_wave_id():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM waves ORDER BY wave_start DESC LIMIT 1")
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
\ No newline at end of file
+    return _get_wave_cache()["wave_id"]
+
+def get_current_wave():
+    # (id, время старта как datetime) последней созданной волны или (None, None)
+    cache = _get_wave_cache()
+    return cache["wave_id"], cache["wave_started_at"]
+
+# === ОЧЕРЕДЬ РАССЫЛКИ ===
+# Одна строка на пользователя в волне. Состояния:
+#   queued    — поставлен в очередь при /confirm_wave, ждёт /send_tickets
+#   pending   — ждёт отправки (next_attempt_at — не раньше какого времени)
+#   sending   — взят потоком рассылки; после перезапуска возвращается в pending
+#   sent      — билет доставлен
+#   skipped   — пользователь уже получил билет в этой волне
+#   no_ticket — свободные билеты закончились
+#   blocked   — пользователь заблокировал бота
+#   failed    — все попытки исчерпаны
+#   cancelled — волна завершена до отправки
+DELIVERY_RESTARTABLE_STATES = ("queued", "no_ticket", "blocked", "failed")
+
+def init_delivery_jobs_table():
+    with transaction() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS delivery_jobs (
+                id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                wave_id         INTEGER NOT NULL,
+                user_id         INTEGER NOT NULL,
+                state           TEXT NOT NULL DEFAULT 'queued',
+                ticket_path     TEXT,
+                attempts        INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at TEXT,
+                last_error      TEXT,
+                updated_at      TEXT,
+                UNIQUE (wave_id, user_id)
+            )
+        """)
+
+def _enqueue_delivery_jobs(cur, wave_id, state, now):
+    cur.execute("""
+        INSERT OR IGNORE INTO delivery_jobs (wave_id, user_id, state, updated_at)
+        SELECT ?, u.user_id, ?, ?
+        FROM users u
+        WHERE u.user_id NOT IN (SELECT user_id FROM admins)
+    """, (wave_id, state, now))
+    return cur.rowcount
+
+def start_delivery_jobs(wave_id):
+    """
+    Запуск рассылки волны: дописывает в очередь новых пользователей и переводит в pending
+    всё, что ещё не доставлено (queued, no_ticket, blocked, failed). Возвращает число задач к отправке.
+    """
+    now = datetime.now().isoformat()
+    placeholders = ", ".join("?" for _ in DELIVERY_RESTARTABLE_STATES)
+    with transaction() as cur:
+        _enqueue_delivery_jobs(cur, wave_id, "pending", now)
+        cur.execute(f"""
+            UPDATE delivery_jobs
+            SET state = 'pending', attempts = 0, next_attempt_at = NULL, last_error = NULL, updated_at = ?,
+                -- резерв сохраняется только у приостановленных задач, остальные билеты уже вернулись в пул
+                ticket_path = CASE WHEN state = 'queued' THEN ticket_path ELSE NULL END
+            WHERE wave_id = ? AND state IN ({placeholders})
+        """, (now, wave_id, *DELIVERY_RESTARTABLE_STATES))
+        cur.execute(
+            "SELECT COUNT(*) FROM delivery_jobs WHERE wave_id = ? AND state IN ('pending', 'sending')",
+            (wave_id,)
+        )
+        return cur.fetchone()[0]
+
+def _wave_start_key(wave_start):
+    # Начало волны в формате users.last_ticket_at для сравнения строк в SQL:
+    # last_ticket_at пишется isoformat() с "T", а waves.wave_start — с пробелом,
+    # а " " < "T": без приведения билет, выданный в тот же день до начала волны ("2024-05-01T09:00"),
+    # считался бы выданным в этой волне ("2024-05-01 10:00") и пользователь ошибочно пропускался
+    if not isinstance(wave_start, datetime):
+        wave_start = datetime.fromisoformat(wave_start)
+    return wave_start.isoformat()
+
+def _prepare_delivery_jobs(cur, wave_id, wave_start, state, now):
+    # Отсев получивших и резерв билетов для задач волны в состоянии state (внутри транзакции)
+    # 1. Уже получили билет в этой волне
+    already = """
+        SELECT j.id FROM delivery_jobs j
+        JOIN users u ON u.user_id = j.user_id
+        WHERE j.wave_id = ? AND j.state = ? AND u.last_ticket_at >= ?
+    """
+    cur.execute(f"""
+        UPDATE tickets SET assigned_to = NULL, assigned_at = NULL
+        WHERE assigned_at IS NULL AND file_path IN (
+            SELECT ticket_path FROM delivery_jobs WHERE id IN ({already})
+        )
+    """, (wave_id, state, wave_start))
+    cur.execute(f"""
+        UPDATE delivery_jobs SET state = 'skipped', ticket_path = NULL, updated_at = ?
+        WHERE id IN ({already})
+    """, (now, wave_id, state, wave_start))
+    skipped = cur.rowcount
+
+    # 2. Старые резервы пользователей, которым билет будет назначен заново
+    cur.execute("""
+        UPDATE tickets SET assigned_to = NULL, assigned_at = NULL
+        WHERE wave_id = ? AND assigned_at IS NULL AND assigned_to IN (
+            SELECT user_id FROM delivery_jobs
+            WHERE wave_id = ? AND state = ? AND ticket_path IS NULL
+        )
+    """, (wave_id, wave_id, state))
+
+    # 3. Раздаём свободные билеты по порядку очереди
+    cur.execute("""
+        SELECT id, user_id FROM delivery_jobs
+        WHERE wave_id = ? AND state = ? AND ticket_path IS NULL
+        ORDER BY id
+    """, (wave_id, state))
+    jobs = cur.fetchall()
+    cur.execute("""
+        SELECT id, file_path FROM tickets
+        WHERE wave_id = ? AND assigned_to IS NULL AND archived_unused = 0 AND lost = 0
+        ORDER BY id
+    """, (wave_id,))
+    tickets = iter(cur.fetchall())
+
+    reserved, lost = [], []
+    for job_id, user_id in jobs:
+        for ticket_id, file_path in tickets:
+            if os.path.isfile(file_path):
+                reserved.append((job_id, user_id, ticket_id, file_path))
+                break
+            lost.append((ticket_id,))
+        else:
+            break
+
+    cur.executemany("UPDATE tickets SET lost = 1 WHERE id = ?", lost)
+    cur.executemany(
+        "UPDATE tickets SET assigned_to = ?, assigned_at = NULL WHERE id = ?",
+        [(user_id, ticket_id) for _, user_id, ticket_id, _ in reserved]
+    )
+    cur.executemany(
+        "UPDATE delivery_jobs SET ticket_path = ?, updated_at = ? WHERE id = ?",
+        [(file_path, now, job_id) for job_id, _, _, file_path in reserved]
+    )
+
+    # 4. Кому не хватило билетов
+    cur.execute("""
+        UPDATE delivery_jobs SET state = 'no_ticket', updated_at = ?
+        WHERE wave_id = ? AND state = ? AND ticket_path IS NULL
+    """, (now, wave_id, state))
+    no_ticket = cur.rowcount
+
+    return {"skipped": skipped, "reserved": len(reserved), "no_ticket": no_ticket, "lost": len(lost)}
+
+def prepare_delivery_jobs(wave_id, wave_start):
+    """
+    Готовит очередь волны к отправке одной транзакцией, до первого сообщения:
+    - pending-задачи пользователей, уже получивших билет с начала волны (last_ticket_at >= wave_start),
+      переводятся в skipped, а зарезервированные под них билеты возвращаются в пул;
+    - остальным pending-задачам без билета резервируются свободные билеты волны по порядку
+      (assigned_to = user_id, assigned_at = NULL до фактической доставки);
+    - кому билетов не хватило — в no_ticket.
+    Билеты, файлов которых нет на диске, помечаются lost и не резервируются.
+    Задачи, спланированные при /confirm_wave, уже с билетом — для них здесь ничего не делается.
+    Возвращает {'skipped': ..., 'reserved': ..., 'no_ticket': ..., 'lost': ...}.
+    """
+    with transaction(immediate=True) as cur:
+        return _prepare_delivery_jobs(
+            cur, wave_id, _wave_start_key(wave_start), "pending", datetime.now().isoformat()
+        )
+
+def plan_delivery_jobs(wave_id, wave_start):
+    """
+    План рассылки при /confirm_wave: одной транзакцией ставит в очередь (queued) всех пользователей
+    волны и сразу закрепляет за ними билеты — /send_tickets потом только исполняет план.
+    Возвращает {'queued': ..., 'skipped': ..., 'reserved': ..., 'no_ticket': ..., 'lost': ...}.
+    """
+    now = datetime.now().isoformat()
+    with transaction(immediate=True) as cur:
+        queued = _enqueue_delivery_jobs(cur, wave_id, "queued", now)
+        plan = _prepare_delivery_jobs(cur, wave_id, _wave_start_key(wave_start), "queued", now)
+    plan["queued"] = queued
+    return plan
+
+def get_delivery_plan(wave_id):
+    # Задачи волны с билетами для выгрузки: (user_id, username, state, ticket_path, original_name, attempts, last_error).
+    # Возвращает курсор — строки читаются по мере выгрузки, а не все сразу.
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT j.user_id, u.username, j.state, j.ticket_path, t.original_name, j.attempts, j.last_error
+        FROM delivery_jobs j
+        LEFT JOIN users u ON u.user_id = j.user_id
+        LEFT JOIN tickets t ON t.file_path = j.ticket_path
+        WHERE j.wave_id = ?
+        ORDER BY j.id
+    """, (wave_id,))
+    return cur
+
+def reset_stale_delivery_jobs():
+    # Задачи, которые остались в sending после падения процесса, снова ждут отправки.
+    with transaction() as cur:
+        cur.execute(
+            "UPDATE delivery_jobs SET state = 'pending', updated_at = ? WHERE state = 'sending'",
+            (datetime.now().isoformat(),)
+        )
+        return cur.rowcount
+
+def take_delivery_job(wave_id):
+    """
+    Атомарно берёт первую готовую к отправке задачу волны и переводит её в sending.
+    Возвращает dict (id, user_id, ticket_path, attempts) или None.
+    """
+    now = datetime.now().isoformat()
+    with transaction(immediate=True) as cur:
+        cur.execute("""
+            SELECT id, user_id, ticket_path, attempts FROM delivery_jobs
+            WHERE wave_id = ? AND state = 'pending'
+            AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+            ORDER BY id
+            LIMIT 1
+        """, (wave_id, now))
+        row = cur.fetchone()
+        if not row:
+            return None
+        cur.execute(
+            "UPDATE delivery_jobs SET state = 'sending', updated_at = ? WHERE id = ?",
+            (now, row[0])
+        )
+    return {"id": row[0], "user_id": row[1], "ticket_path": row[2], "attempts": row[3]}
+
+def get_next_delivery_attempt(wave_id):
+    # Ближайшее время следующей попытки среди pending-задач волны (datetime) или None, если их нет.
+    cur = get_connection().cursor()
+    cur.execute("""
+        SELECT COUNT(*), MIN(COALESCE(next_attempt_at, ''))
+        FROM delivery_jobs
+        WHERE wave_id = ? AND state = 'pending'
+    """, (wave_id,))
+    count, next_at = cur.fetchone()
+    if not count:
+        return None
+    return datetime.fromisoformat(next_at) if next_at else datetime.now()
+
+def finish_delivery_job(job_id, state, error=None):
+    with transaction() as cur:
+        cur.execute("""
+            UPDATE delivery_jobs
+            SET state = ?, last_error = ?, next_attempt_at = NULL, updated_at = ?
+            WHERE id = ?
+        """, (state, error, datetime.now().isoformat(), job_id))
+
+def retry_delivery_job(job_id, delay_seconds, error):
+    # Вернуть задачу в очередь с отложенной попыткой.
+    now = datetime.now()
+    next_at = datetime.fromtimestamp(now.timestamp() + delay_seconds).isoformat()
+    with transaction() as cur:
+        cur.execute("""
+            UPDATE delivery_jobs
+            SET state = 'pending', attempts = attempts + 1, next_attempt_at = ?, last_error = ?, updated_at = ?
+            WHERE id = ? AND state = 'sending'
+        """, (next_at, error, now.isoformat(), job_id))
+
+def complete_delivery_job(job_id, ticket_path, user_id):
+    """
+    Фиксирует доставку одной транзакцией: билет выдан, время выдачи у пользователя,
+    задача в состоянии sent, запись в failed_deliveries снята.
+    """
+    now = datetime.now().isoformat()
+    with transaction() as cur:
+        cur.execute("UPDATE tickets SET assigned_to=?, assigned_at=? WHERE file_path=?", (user_id, now, ticket_path))
+        cur.execute("UPDATE users SET last_ticket_at=? WHERE user_id=?", (now, user_id))
+        cur.execute("DELETE FROM failed_deliveries WHERE user_id=?", (user_id,))
+        cur.execute("""
+            UPDATE delivery_jobs
+            SET state = 'sent', ticket_path = ?, last_error = NULL, next_attempt_at = NULL, updated_at = ?
+            WHERE id = ?
+        """, (ticket_path, now, job_id))
+
+def pause_delivery_jobs(wave_id):
+    """
+    Останавливает рассылку волны без отмены: pending-задачи возвращаются в queued,
+    поэтому при перезапуске бота они не подхватываются автоматически и ждут /send_tickets.
+    Зарезервированные под задачи билеты остаются за пользователями. Возвращает число задач.
+    """
+    with transaction() as cur:
+        cur.execute("""
+            UPDATE delivery_jobs SET state = 'queued', next_attempt_at = NULL, updated_at = ?
+            WHERE wave_id = ? AND state = 'pending'
+        """, (datetime.now().isoformat(), wave_id))
+        return cur.rowcount
+
+def cancel_delivery_jobs(wave_id):
+    """
+    Отменяет недоставленные задачи волны и возвращает в пул зарезервированные под них билеты.
+    Возвращает число отменённых задач.
+    """
+    now = datetime.now().isoformat()
+    with transaction() as cur:
+        cur.execute("""
+            UPDATE tickets SET assigned_to = NULL, assigned_at = NULL
+            WHERE wave_id = ? AND assigned_to IS NOT NULL AND assigned_at IS NULL
+        """, (wave_id,))
+        cur.execute("""
+            UPDATE delivery_jobs SET state = 'cancelled', updated_at = ?
+            WHERE wave_id = ? AND state IN ('queued', 'pending', 'sending')
+        """, (now, wave_id))
+        return cur.rowcount
+
+def get_delivery_job_counts(wave_id) -> dict:
+    # Количество задач волны по состояниям: {'sent': 10, 'pending': 5, ...}
+    cur = get_connection().cursor()
+    cur.execute(
+        "SELECT state, COUNT(*) FROM delivery_jobs WHERE wave_id = ? GROUP BY state",
+        (wave_id,)
+    )
+    return dict(cur.fetchall())
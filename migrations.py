@@ -0,0 +1,124 @@
+"""
+Версионированные миграции схемы users.db.
+
+Таблицы создаются в database.init_*_table (CREATE TABLE IF NOT EXISTS), а всё,
+что меняет уже существующую схему (индексы, новые колонки, перенос данных),
+описывается здесь. Каждая миграция применяется ровно один раз, номер и время
+применения записываются в таблицу schema_version — поэтому старые файлы users.db
+обновляются сами при запуске бота.
+"""
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Шаг миграции — SQL-строка или функция, принимающая курсор.
+# Новые миграции добавляются только в конец списка, номера не переиспользуются.
+MIGRATIONS = [
+    (1, "Индексы для выборок по билетам, пользователям и инвайтам", [
+        # Свободные билеты волны: claim_ticket, подсчёт свободных, поиск пропавших файлов
+        """
+        CREATE INDEX IF NOT EXISTS idx_tickets_free_by_wave
+        ON tickets (wave_id, id)
+        WHERE assigned_to IS NULL AND archived_unused = 0 AND lost = 0
+        """,
+        # Статистика по волне (/stats, /end_wave) считается только по индексу
+        """
+        CREATE INDEX IF NOT EXISTS idx_tickets_wave_status
+        ON tickets (wave_id, lost, archived_unused, assigned_to)
+        """,
+        # Билеты конкретного пользователя: clear_user_assignments, delete_user_everywhere
+        """
+        CREATE INDEX IF NOT EXISTS idx_tickets_assigned_to
+        ON tickets (assigned_to, wave_id)
+        WHERE assigned_to IS NOT NULL
+        """,
+        # Новые свободные билеты, загруженные после /new_wave (/confirm_wave)
+        """
+        CREATE INDEX IF NOT EXISTS idx_tickets_free_by_uploaded_at
+        ON tickets (uploaded_at)
+        WHERE assigned_to IS NULL AND archived_unused = 0 AND lost = 0
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+        "CREATE INDEX IF NOT EXISTS idx_invite_codes_user_id ON invite_codes (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_waves_wave_start ON waves (wave_start)",
+    ]),
+    (2, "Индекс очереди рассылки по готовым к отправке задачам", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_delivery_jobs_due
+        ON delivery_jobs (wave_id, state, next_attempt_at)
+        """,
+    ]),
+    (3, "Покрывающий индекс для статистики волны (get_wave_stats)", [
+        # Все счётчики /stats и /end_wave считаются по индексу, без чтения строк tickets;
+        # старый idx_tickets_wave_status — его префикс
+        """
+        CREATE INDEX IF NOT EXISTS idx_tickets_wave_stats
+        ON tickets (wave_id, lost, archived_unused, assigned_to, assigned_at)
+        """,
+        "DROP INDEX IF EXISTS idx_tickets_wave_status",
+    ]),
+    (4, "Индекс очереди рассылки в порядке id", [
+        # take_delivery_job берёт первую готовую задачу по id без сортировки (ORDER BY id LIMIT 1);
+        # next_attempt_at в конце — проверка времени попытки и get_next_delivery_attempt идут по индексу
+        """
+        CREATE INDEX IF NOT EXISTS idx_delivery_jobs_queue
+        ON delivery_jobs (wave_id, state, id, next_attempt_at)
+        """,
+        "DROP INDEX IF EXISTS idx_delivery_jobs_due",
+    ]),
+]
+
+
+def init_schema_version_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version     INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at  TEXT NOT NULL
+        )
+    """)
+    conn.commit()
+
+
+def get_schema_version(conn) -> int:
+    # Номер последней применённой миграции (0 — миграций ещё не было).
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn) -> int:
+    """
+    Применяет все миграции новее текущей версии схемы, каждую в своей транзакции.
+    Возвращает итоговый номер версии.
+    """
+    init_schema_version_table(conn)
+    current = get_schema_version(conn)
+
+    for version, description, steps in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            cur = conn.cursor()
+            for step in steps:
+                if callable(step):
+                    step(cur)
+                else:
+                    cur.execute(step)
+            cur.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat())
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        logger.info("Применена миграция схемы %d: %s", version, description)
+        current = version
+
+    return current
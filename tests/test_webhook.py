@@ -0,0 +1,134 @@
+"""
+Проверка WebhookServer с поддельным ботом вместо Telegram: python -m unittest tests.test_webhook
+(из корня проекта, рядом должен лежать config.py).
+
+Обновления отправляются настоящими HTTP-запросами на локальный сервер; бот только
+записывает, что и в каком потоке обработал.
+"""
+import json
+import time
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from webhook import WebhookServer
+
+SECRET = "test-secret"
+
+
+class FakeBot:
+    # Вместо TeleBot: process_new_updates записывает update_id по чатам и может тормозить/ждать
+    def __init__(self, delays=None, gate=None):
+        self.threaded = True
+        self.delays = delays or {}   # chat_id -> сек. на одно обновление
+        self.gate = gate             # threading.Event: обработка ждёт, пока его не установят
+        self.lock = threading.Lock()
+        self.processed = []          # (chat_id, update_id) в порядке завершения
+        self.active = {}             # chat_id -> сколько его обновлений обрабатывается сейчас
+        self.max_active = {}         # chat_id -> максимум одновременно
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            chat_id = update.message.chat.id
+            with self.lock:
+                self.active[chat_id] = self.active.get(chat_id, 0) + 1
+                self.max_active[chat_id] = max(self.max_active.get(chat_id, 0), self.active[chat_id])
+            if self.gate is not None:
+                self.gate.wait(5)
+            time.sleep(self.delays.get(chat_id, 0))
+            with self.lock:
+                self.active[chat_id] -= 1
+                self.processed.append((chat_id, update.update_id))
+
+    def updates_of(self, chat_id):
+        with self.lock:
+            return [update_id for chat, update_id in self.processed if chat == chat_id]
+
+
+def make_update(update_id, chat_id, text="привет"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "U"},
+        },
+    }
+
+
+class WebhookServerTest(unittest.TestCase):
+    def start_server(self, bot, **kwargs):
+        server = WebhookServer(bot, host="127.0.0.1", port=0, secret=SECRET, **kwargs)
+        server.start()
+        self.addCleanup(lambda: server.threads and server.stop())
+        return server
+
+    def post(self, server, update, secret=SECRET):
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{server.port}{server.path}",
+            data=json.dumps(update).encode(),
+            headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("не дождались обработки обновлений")
+            time.sleep(0.01)
+
+    def test_per_chat_order(self):
+        # Обновления одного чата — строго по порядку и по одному; медленный чат не задерживает быстрый
+        bot = FakeBot(delays={1: 0.05})
+        server = self.start_server(bot, workers=4, queue_size=100)
+        update_id = 0
+        for _ in range(10):
+            for chat_id in (1, 2):
+                update_id += 1
+                self.assertEqual(self.post(server, make_update(update_id, chat_id)), 200)
+
+        self.wait_for(lambda: len(bot.updates_of(1)) == 10 and len(bot.updates_of(2)) == 10)
+        for chat_id in (1, 2):
+            updates = bot.updates_of(chat_id)
+            self.assertEqual(updates, sorted(updates))
+            self.assertEqual(bot.max_active[chat_id], 1)
+        with bot.lock:
+            last_fast = max(i for i, (chat, _) in enumerate(bot.processed) if chat == 2)
+            last_slow = max(i for i, (chat, _) in enumerate(bot.processed) if chat == 1)
+        self.assertLess(last_fast, last_slow)
+
+    def test_overflow_returns_503(self):
+        # Больше queue_size необработанных обновлений — 503, Telegram повторит позже
+        gate = threading.Event()
+        bot = FakeBot(gate=gate)
+        server = self.start_server(bot, workers=1, queue_size=3)
+        codes = [self.post(server, make_update(i, chat_id=i)) for i in range(1, 6)]
+        self.assertEqual(codes, [200, 200, 200, 503, 503])
+
+        gate.set()
+        self.wait_for(lambda: len(bot.processed) == 3)
+        # Место освободилось — обновления снова принимаются
+        self.assertEqual(self.post(server, make_update(6, chat_id=6)), 200)
+        self.assertEqual(self.post(server, make_update(7, chat_id=1), secret="wrong"), 403)
+
+    def test_stop_drains_accepted_updates(self):
+        # stop() не теряет уже принятые (получившие 200) обновления
+        bot = FakeBot(delays={1: 0.02, 2: 0.02})
+        server = self.start_server(bot, workers=2, queue_size=100)
+        for update_id in range(1, 21):
+            self.assertEqual(self.post(server, make_update(update_id, chat_id=1 + update_id % 2)), 200)
+        server.stop()
+        self.assertEqual(sorted(update_id for _, update_id in bot.processed), list(range(1, 21)))
+        self.assertEqual(server.pending, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
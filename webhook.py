@@ -0,0 +1,180 @@
+import json
+import ssl
+import queue
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+from telebot.types import Update
+from database import close_connection
+
+logger = logging.getLogger(__name__)
+
+# Настройки режима webhook (можно переопределить в config.py)
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)                # публичный https-адрес; пусто — работаем через polling
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "127.0.0.1")   # где слушает локальный сервер (обычно за nginx)
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)          # сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SSL_CERT = getattr(config, "WEBHOOK_SSL_CERT", None)      # сертификат и ключ — если TLS без прокси
+WEBHOOK_SSL_KEY = getattr(config, "WEBHOOK_SSL_KEY", None)
+WEBHOOK_WORKERS = getattr(config, "WEBHOOK_WORKERS", 4)           # потоков обработки обновлений
+WEBHOOK_QUEUE_SIZE = getattr(config, "WEBHOOK_QUEUE_SIZE", 1000)  # принятых, но не обработанных обновлений; дальше — 503, Telegram повторит
+
+UPDATE_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post", "callback_query")
+
+
+def get_update_chat_id(data):
+    # chat_id обновления (для callback — чат сообщения с кнопкой), 0 — если чата нет.
+    for key in UPDATE_CHAT_KEYS:
+        obj = data.get(key)
+        if not obj:
+            continue
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat") or obj.get("from") or {}
+        return chat.get("id", 0)
+    return 0
+
+
+class WebhookServer:
+    """
+    Локальный HTTP-сервер для обновлений Telegram. Запрос только кладёт обновление
+    в очередь (не больше queue_size необработанных) и сразу отвечает 200,
+    обработку ведут workers потоков.
+    Обновления одного чата выполняются по порядку: пока чат занят, его новые обновления
+    ждут в отдельной очереди чата и не занимают другие потоки. Поэтому медленная команда
+    одного админа держит один поток, а не всех.
+    """
+    def __init__(self, bot, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                 ssl_cert=WEBHOOK_SSL_CERT, ssl_key=WEBHOOK_SSL_KEY):
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = max(1, int(workers))
+        self.queue_size = queue_size
+        self.updates = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0        # принято и ещё не обработано (в общей очереди и в очередях чатов)
+        self.chat_backlog = {}  # chat_id, который сейчас обрабатывается -> его следующие обновления
+        self.threads = []
+        self.httpd = ThreadingHTTPServer((host, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+        if ssl_cert and ssl_key:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(ssl_cert, ssl_key)
+            self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def _make_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_error(404)
+                    return
+                if server.secret and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != server.secret:
+                    self.send_error(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    data = json.loads(self.rfile.read(length))
+                except (ValueError, UnicodeDecodeError):
+                    self.send_error(400)
+                    return
+                if not server.enqueue(data):
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                # Каждый запрос в лог не пишем — только ошибки (send_error)
+                pass
+
+            def log_error(self, format, *args):
+                logger.warning("Webhook: " + format, *args)
+
+        return RequestHandler
+
+    def enqueue(self, data):
+        # Кладёт обновление в очередь; False — очередь переполнена.
+        with self.lock:
+            if self.pending >= self.queue_size:
+                logger.warning("Очередь webhook переполнена (%d), обновление %s отклонено",
+                               self.queue_size, data.get("update_id"))
+                return False
+            self.pending += 1
+        self.updates.put(data)
+        return True
+
+    def process(self, data):
+        try:
+            self.bot.process_new_updates([Update.de_json(data)])
+        except Exception as e:
+            logger.error(f"Ошибка обработки обновления {data.get('update_id')}: {e}", exc_info=True)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _process_chat(self, data):
+        chat_id = get_update_chat_id(data)
+        if not chat_id:
+            self.process(data)
+            return
+        with self.lock:
+            backlog = self.chat_backlog.get(chat_id)
+            if backlog is not None:
+                # Чат уже обрабатывается другим потоком — он же возьмёт и это обновление
+                backlog.append(data)
+                return
+            backlog = self.chat_backlog[chat_id] = deque()
+        while data is not None:
+            self.process(data)
+            with self.lock:
+                if backlog:
+                    data = backlog.popleft()
+                else:
+                    del self.chat_backlog[chat_id]
+                    data = None
+
+    def _worker(self):
+        try:
+            while True:
+                data = self.updates.get()
+                if data is None:
+                    return
+                self._process_chat(data)
+        finally:
+            # У каждого потока своё соединение с БД — закрываем его вместе с потоком
+            close_connection()
+
+    def start(self):
+        # Запускает потоки обработки и HTTP-сервер в фоне (не блокирует).
+        # Обработчики выполняются прямо в наших потоках, а не в пуле TeleBot
+        self.bot.threaded = False
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self.threads.append(threading.Thread(target=self.httpd.serve_forever, name="webhook-http", daemon=True))
+        for t in self.threads:
+            t.start()
+        logger.info("Webhook-сервер слушает %s:%d%s, потоков обработки: %d",
+                    *self.httpd.server_address[:2], self.path, self.workers)
+
+    def stop(self):
+        # Перестаёт принимать запросы и дожидается обработки уже принятых обновлений
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        for _ in range(self.workers):
+            self.updates.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []